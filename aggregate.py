@@ -0,0 +1,65 @@
+# Streaming aggregation of ensemble probability maps.
+# Fold outputs are folded into a running mean and variance (Welford's algorithm) one at a time,
+# so only two float32 accumulators are held in memory no matter how many members there are.
+import os
+
+import numpy as np
+
+
+def ensemble_members(config):
+    """Folders step3 writes the npz probabilities of every member to: ensemble_<model>_<fold>."""
+    return [f'ensemble_{name}_{fold}' for name, _ in config['model_dirs'] for fold in config['folds']]
+
+
+class RunningMoments:
+    """Running mean and (population) variance of a sequence of equally shaped arrays."""
+
+    def __init__(self, dtype=np.float32):
+        self.dtype = dtype
+        self.count = 0
+        self.mean = None
+        self._m2 = None
+
+    def update(self, values):
+        values = np.asarray(values, dtype=self.dtype)
+        self.count += 1
+        if self.mean is None:
+            self.mean = values.copy()
+            self._m2 = np.zeros_like(self.mean)
+            return
+        delta = values - self.mean
+        self.mean += delta / self.count
+        delta *= values - self.mean
+        self._m2 += delta
+
+    @property
+    def variance(self):
+        """Population variance, the same as np.var(..., axis=0) over all updates."""
+        if self.count == 0:
+            return None
+        return self._m2 / self.count
+
+
+def load_foreground(file_path, channel=1):
+    """Load the foreground channel of one member's probabilities written by step3."""
+    with np.load(file_path) as file_data:
+        return file_data['probabilities'][channel].squeeze()
+
+
+def aggregate_members(base_dir, file_name, members, channel=1):
+    """Return (ensemble mean, ensemble variance, number of members found) of one image."""
+    moments = RunningMoments()
+    for member in members:
+        file_path = os.path.join(base_dir, member, file_name)
+        if not os.path.exists(file_path):
+            continue
+        moments.update(load_foreground(file_path, channel))
+    return moments.mean, moments.variance, moments.count
+
+
+def aggregate_store(store, case_id):
+    """Return (ensemble mean, ensemble variance, number of members) of one image in a ProbabilityStore."""
+    moments = RunningMoments()
+    for foreground in store.iter_members(case_id):
+        moments.update(foreground)
+    return moments.mean, moments.variance, moments.count
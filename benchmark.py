@@ -0,0 +1,346 @@
+# Benchmarks of every pipeline stage on synthetic data, runnable on a CPU-only machine.
+# GPU stages use stand-ins: fake_segmenter.py for TotalSegmentator and StandInModel for nnUNet.
+# Each benchmark reports throughput and peak traced memory (allocations of this process only, so
+# worker processes and subprocesses are not included); results are compared with a stored
+# baseline and slowdowns beyond the tolerance are flagged.
+#
+#   python benchmark.py                                   # run and compare with benchmark_baseline.json
+#   python benchmark.py --save-baseline                   # store the results as the new baseline
+#   python benchmark.py --scale full --only get_pixels_hu group_dicom_files
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+
+import numpy as np
+import pydicom
+
+import synthetic
+from utils import read_dicom_attributes, group_dicom_files, get_pixels_hu, load_hu_volume, MUSCLE_WINDOW
+from config import load_config
+from dicom_index import DicomIndex
+from aggregate import ensemble_members, aggregate_store
+from probability_store import ProbabilityStore
+from ensemble import EnsemblePredictor, StandInModel
+from slice_metrics import batch_metrics
+from identifiers import GroupId, GroupIndex, SliceId, group_name, nifti_name, case_id
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+# slices per series, image size, number of step3/step4 cases
+SCALES = {
+    'small': {'num_slices': 40, 'size': 256, 'num_cases': 20},
+    'full': {'num_slices': 200, 'size': 512, 'num_cases': 100},
+}
+
+
+def measure(run, num_items):
+    """Time run() and record its peak traced memory."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    run()
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'items': num_items,
+        'seconds': seconds,
+        'items_per_second': num_items / seconds if seconds > 0 else float('inf'),
+        'peak_mb': peak / 2 ** 20,
+    }
+
+
+def benchmark_config(workdir, **overrides):
+    """Pipeline config pointing every folder into workdir."""
+    return load_config(
+        subjects_dir=os.path.join(workdir, 'subjects'),
+        group_dir=os.path.join(workdir, 'groups'),
+        nifti_dir=os.path.join(workdir, 'nifti'),
+        index_path=os.path.join(workdir, 'index.sqlite'),
+        queue_path=os.path.join(workdir, 'jobs.sqlite'),
+        segmentation_slots=['cpu'],
+        segmenter_command=[sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_segmenter.py'),
+                           '-i', '{input}', '-o', '{output}', '--ml'],
+        png_dir=os.path.join(workdir, 'png'),
+        prediction_dir=os.path.join(workdir, 'prediction'),
+        stand_in_models=True,
+        output_dir=os.path.join(workdir, 'final'),
+        results_path=os.path.join(workdir, 'final', 'results.sqlite'),
+        csv_path=os.path.join(workdir, 'final', 'results.csv'),
+        variance_threshold=0.01,
+        manifest_dir=os.path.join(workdir, 'manifests'),
+        **overrides
+    )
+
+
+# Every benchmark prepares its data (not timed) and returns (function to time, number of items)
+
+def bench_read_dicom_attributes(workdir, scale):
+    paths = synthetic.make_dicom_series(os.path.join(workdir, 'series'), scale['num_slices'], scale['size'])
+    return lambda: [read_dicom_attributes(path) for path in paths], len(paths)
+
+
+def bench_group_dicom_files(workdir, scale):
+    folder = os.path.join(workdir, 'mixed')
+    synthetic.make_dicom_series(os.path.join(folder, 'axial'), scale['num_slices'], scale['size'])
+    synthetic.make_dicom_series(os.path.join(folder, 'sagittal'), scale['num_slices'] // 4, scale['size'],
+                                orientation='sagittal')
+    num_files = scale['num_slices'] + scale['num_slices'] // 4
+    return lambda: group_dicom_files(folder), num_files
+
+
+def bench_dicom_index_cold(workdir, scale):
+    folder = os.path.join(workdir, 'mixed')
+    synthetic.make_dicom_series(os.path.join(folder, 'axial'), scale['num_slices'], scale['size'])
+    index_path = os.path.join(workdir, 'index.sqlite')
+
+    def run():
+        with DicomIndex(index_path) as index:
+            index.update(folder)
+            group_dicom_files(folder, index=index)
+    return run, scale['num_slices']
+
+
+def bench_dicom_index_warm(workdir, scale):
+    folder = os.path.join(workdir, 'mixed')
+    synthetic.make_dicom_series(os.path.join(folder, 'axial'), scale['num_slices'], scale['size'])
+    index_path = os.path.join(workdir, 'index.sqlite')
+    with DicomIndex(index_path) as index:
+        index.update(folder)
+
+    def run():
+        with DicomIndex(index_path) as index:
+            index.update(folder)
+            group_dicom_files(folder, index=index)
+    return run, scale['num_slices']
+
+
+def bench_get_pixels_hu(workdir, scale):
+    paths = synthetic.make_dicom_series(os.path.join(workdir, 'series'), scale['num_slices'], scale['size'])
+    datasets = [pydicom.dcmread(path) for path in paths]
+    # Decode the pixel data up front, only the HU conversion is timed
+    for ds in datasets:
+        ds.pixel_array
+    return lambda: [get_pixels_hu(ds) for ds in datasets], len(datasets)
+
+
+def bench_load_hu_volume(workdir, scale):
+    paths = synthetic.make_dicom_series(os.path.join(workdir, 'series'), scale['num_slices'], scale['size'])
+    return lambda: load_hu_volume(paths, window=MUSCLE_WINDOW), len(paths)
+
+
+def bench_segment_fake(workdir, scale):
+    import step1
+
+    config = benchmark_config(workdir)
+    group_id = GroupId('BENCH', '1', 1)
+    dicom_paths = synthetic.make_dicom_series(os.path.join(workdir, 'source'), scale['num_slices'], scale['size'])
+    return lambda: step1.run_items(config, {group_name(group_id): dicom_paths}), 1
+
+
+def _segmented_group(workdir, scale):
+    """Group folder and label volume as step1 would leave them."""
+    config = benchmark_config(workdir)
+    group_id = GroupId('BENCH', '1', 1)
+    synthetic.make_dicom_series(os.path.join(config['group_dir'], group_name(group_id)),
+                                scale['num_slices'], scale['size'])
+    os.makedirs(config['nifti_dir'], exist_ok=True)
+    synthetic.make_label_volume(os.path.join(config['nifti_dir'], nifti_name(group_id)),
+                                scale['num_slices'], scale['size'])
+    return config, group_id
+
+
+def bench_step2_extract(workdir, scale):
+    import step2
+
+    config, group_id = _segmented_group(workdir, scale)
+    os.makedirs(config['png_dir'], exist_ok=True)
+    group_index = GroupIndex(config['group_dir'])
+    return lambda: step2.extract_l3_slices(config, nifti_name(group_id), group_index), 1
+
+
+def _prediction_inputs(workdir, scale, probability_format='uint8'):
+    """Group folder and step3 outputs for num_cases slices of one series."""
+    config, group_id = _segmented_group(workdir, scale)
+    config['probability_format'] = probability_format
+    case_ids = [case_id(SliceId(*group_id, k % scale['num_slices'])) for k in range(scale['num_cases'])]
+    synthetic.make_fold_probabilities(config['prediction_dir'], case_ids, ensemble_members(config), scale['size'],
+                                      probability_format=probability_format)
+    return config, case_ids
+
+
+def bench_step3_stand_in(workdir, scale):
+    predictor = EnsemblePredictor([StandInModel('1'), StandInModel('2', seed=10)])
+    rng = np.random.default_rng(0)
+    images = [rng.random((1, 1, scale['size'], scale['size']), dtype=np.float32) for _ in range(scale['num_cases'])]
+    return lambda: predictor.predict_aggregated(images), len(images)
+
+
+def bench_step3_png_round_trip(workdir, scale):
+    import step2
+    import step3
+
+    config, group_id = _segmented_group(workdir, scale)
+    config['stage_workers']['extract'] = 1
+    nifti_items = step2.list_items(config)
+
+    def run():
+        step2.run_items(config, nifti_items, workers=1)
+        step3.run_items(config, step3.list_items(config))
+    return run, len(nifti_items)
+
+
+def bench_step3_stream(workdir, scale):
+    import step3
+
+    config, group_id = _segmented_group(workdir, scale)
+    config['stage_workers']['extract'] = 1
+    config['stream_predict'] = True
+    nifti_items = step3.list_items(config)
+    return lambda: step3.run_items(config, nifti_items), len(nifti_items)
+
+
+def bench_step4_aggregate(workdir, scale):
+    config, case_ids = _prediction_inputs(workdir, scale)
+    store = ProbabilityStore(os.path.join(config['prediction_dir'], 'probabilities'))
+    return lambda: [aggregate_store(store, case) for case in case_ids], len(case_ids)
+
+
+def _metric_inputs(scale):
+    """Ensemble mean and variance maps, HU images and spacings of num_cases slices."""
+    rng = np.random.default_rng(0)
+    shape = (scale['num_cases'], scale['size'], scale['size'])
+    means = rng.random(shape, dtype=np.float32)
+    # Mostly confident pixels, about 5% of them above the 0.01 threshold
+    variances = rng.random(shape, dtype=np.float32) * np.float32(0.005)
+    uncertain = rng.random(shape) < 0.05
+    variances[uncertain] += np.float32(0.01)
+    hu_images = rng.integers(-200, 300, shape).astype(np.int16)
+    return means, variances, hu_images, [[0.7, 0.7]] * shape[0], [2.5] * shape[0]
+
+
+def _per_slice_metrics(mean, variance, hu_image, pixel_spacing, slice_thickness, threshold):
+    """The metrics of one slice the way step4 computed them before slice_metrics.py."""
+    predicted_sm = np.where(mean > 0.5, 1, 0)
+    sm_pixels = np.sum(predicted_sm)
+    sm_area = sm_pixels * pixel_spacing[0] * pixel_spacing[1]
+    sm_hu = np.mean(hu_image[predicted_sm == 1])
+    var_threshold = np.where(variance > threshold, variance, 0)
+    non_zero_values = var_threshold[np.nonzero(var_threshold)]
+    percent = ((non_zero_values - non_zero_values.min())
+               * (100 / (non_zero_values.max() - non_zero_values.min()))).astype(np.uint8)
+    variance_norm = ((variance - variance.min()) * (255 / (variance.max() - variance.min()))).astype(np.uint8)
+    return (len(non_zero_values), np.mean(non_zero_values), np.median(non_zero_values), np.mean(percent),
+            np.median(percent), sm_pixels, sm_area, sm_area * slice_thickness, sm_hu, variance_norm)
+
+
+def bench_slice_metrics_per_slice(workdir, scale):
+    means, variances, hu_images, pixel_spacings, slice_thicknesses = _metric_inputs(scale)
+    return lambda: [_per_slice_metrics(*inputs, 0.01) for inputs in zip(
+        means, variances, hu_images, pixel_spacings, slice_thicknesses)], len(means)
+
+
+def bench_slice_metrics_batched(workdir, scale):
+    inputs = _metric_inputs(scale)
+    # In batches of the size step4's workers use
+    batch_size = load_config()['metrics_batch_size']
+    batches = [[values[start:start + batch_size] for values in inputs]
+               for start in range(0, scale['num_cases'], batch_size)]
+    return lambda: [batch_metrics(*batch, 0.01) for batch in batches], scale['num_cases']
+
+
+def bench_step4_export(workdir, scale):
+    import step4
+
+    config, case_ids = _prediction_inputs(workdir, scale)
+    return lambda: list(step4.iter_rows(config, case_ids, workers=1)), len(case_ids)
+
+
+BENCHMARKS = {
+    'read_dicom_attributes': bench_read_dicom_attributes,
+    'group_dicom_files': bench_group_dicom_files,
+    'dicom_index_cold': bench_dicom_index_cold,
+    'dicom_index_warm': bench_dicom_index_warm,
+    'get_pixels_hu': bench_get_pixels_hu,
+    'load_hu_volume': bench_load_hu_volume,
+    'segment_fake': bench_segment_fake,
+    'step2_extract': bench_step2_extract,
+    'step3_stand_in': bench_step3_stand_in,
+    'step3_png_round_trip': bench_step3_png_round_trip,
+    'step3_stream': bench_step3_stream,
+    'step4_aggregate': bench_step4_aggregate,
+    'slice_metrics_per_slice': bench_slice_metrics_per_slice,
+    'slice_metrics_batched': bench_slice_metrics_batched,
+    'step4_export': bench_step4_export,
+}
+
+
+def run_benchmarks(names, scale, repeat=1):
+    """Run the named benchmarks, each in a fresh temporary folder. Keeps the best of repeat runs."""
+    results = {}
+    for name in names:
+        best = None
+        for _ in range(repeat):
+            workdir = tempfile.mkdtemp(prefix=f'sm_bench_{name}_')
+            try:
+                run, num_items = BENCHMARKS[name](workdir, scale)
+                result = measure(run, num_items)
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+            if best is None or result['seconds'] < best['seconds']:
+                best = result
+        results[name] = best
+    return results
+
+
+def report(results, baseline=None, tolerance=0.2):
+    """Print a table of the results, with the throughput relative to the baseline. Returns the regressed names."""
+    baseline = baseline or {}
+    regressions = []
+    print(f"{'benchmark':<24}{'items':>7}{'seconds':>10}{'items/s':>12}{'peak MB':>10}{'vs baseline':>13}")
+    for name, result in results.items():
+        line = (f"{name:<24}{result['items']:>7}{result['seconds']:>10.3f}"
+                f"{result['items_per_second']:>12.1f}{result['peak_mb']:>10.1f}")
+        if name in baseline:
+            ratio = result['items_per_second'] / baseline[name]['items_per_second']
+            flag = '  SLOWER' if ratio < 1 - tolerance else ''
+            if flag:
+                regressions.append(name)
+            line += f"{ratio:>12.2f}x{flag}"
+        print(line)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic data")
+    parser.add_argument('--scale', choices=SCALES, default='small')
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS, help="benchmarks to run, all by default")
+    parser.add_argument('--repeat', type=int, default=1, help="runs per benchmark, the fastest is kept")
+    parser.add_argument('--baseline', default=BASELINE_PATH, help="baseline results to compare with")
+    parser.add_argument('--save-baseline', action='store_true', help="store the results as the baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed relative throughput loss")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.only or list(BENCHMARKS), SCALES[args.scale], args.repeat)
+
+    stored = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            stored = json.load(f)
+    regressions = report(results, stored.get(args.scale))
+
+    if args.save_baseline:
+        stored.setdefault(args.scale, {}).update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(stored, f, indent=1)
+        print(f"baseline saved to {args.baseline}")
+        return 0
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,109 @@
+# Settings shared by all pipeline stages.
+# The defaults are the cohort paths the steps were written for. A JSON file with any subset of
+# the keys can be passed to the steps and to pipeline.py to run another cohort:
+#   python pipeline.py my_cohort.json
+import os
+import json
+
+DATA_DIR = '/share/dept_machinelearning/Faculty/Rasool, Ghulam/Shared Resources/Pancreatic Cancer Image Data'
+RESULT_DIR = os.path.join(DATA_DIR, 'result_files')
+PREDICTION_DIR = os.path.join(RESULT_DIR, 'nn_unet_sm_additional_unprocessed')
+
+DEFAULT_CONFIG = {
+    # step1: grouping and TotalSegmentator
+    'subjects_dir': os.path.join(DATA_DIR, '10R23000239', 'SUBJECTS'),
+    'group_dir': os.path.join(RESULT_DIR, 'axial_series_groups_all folders'),
+    'nifti_dir': os.path.join(RESULT_DIR, 'nifti_files_all_folders'),
+    'index_path': os.path.join(RESULT_DIR, 'dicom_index.sqlite'),
+    'queue_path': os.path.join(RESULT_DIR, 'segmentation_jobs.sqlite'),
+    # Series folders with this many DICOM files or fewer are skipped
+    'min_dicom_files': 8,
+    # How group folders are built: 'hardlink', 'symlink', 'manifest' or 'copy'
+    'materialize_mode': 'hardlink',
+    # One segmentation worker per slot: a GPU index or 'cpu'. None uses the TotalSegmentator command.
+    'segmentation_slots': ['0'],
+    'segmenter_command': None,
+    'segmentation_max_attempts': 3,
+    'segmentation_backoff': 30.0,
+    # Two-pass mode: a localizer (TotalSegmentator --fast by default) on every localizer_step-th slice
+    # finds L3, then only the slab around it, slab_padding slices on both ends, is segmented
+    'lumbar_slab': False,
+    'localizer_command': None,
+    'localizer_step': 3,
+    'slab_padding': 10,
+    'slab_dir': os.path.join(RESULT_DIR, 'lumbar_slabs'),
+    # Segment groups holding the same SOPInstanceUIDs as another group only once
+    'deduplicate': True,
+
+    # step2: L3 slice extraction
+    'png_dir': os.path.join(RESULT_DIR, 'png_slices_L3_additional_unprocessed'),
+    'vertebra_label': 29,
+    # uint8 encoding of the muscle window for the models: 'legacy' (what the models were trained on,
+    # negative HU wrap around) or 'linear' (the window scaled to 0-255, needs models trained on it)
+    'input_encoding': 'legacy',
+
+    # step3: ensemble prediction
+    'prediction_dir': PREDICTION_DIR,
+    'model_dirs': [
+        ['1', '/home/80024222/projects/nnUNet_results/Dataset501_NatGeSM_/nnUNetTrainer__nnUNetPlans__2d'],
+        ['2', '/home/80024222/projects/nnUNet_results/Dataset502_NatGeSM_/nnUNetTrainer__nnUNetPlans__2d'],
+    ],
+    'folds': [0, 1, 2, 3, 4],
+    'gpu_index': 0,
+    'batch_size': 32,
+    # 'uint8' or 'float16' for the probability store, 'npz' for per-member .npz files
+    'probability_format': 'uint8',
+    # Use the numpy stand-in models instead of nnUNet (testing without a GPU)
+    'stand_in_models': False,
+    # Stream the L3 slices from step2 to the models in memory: the pipeline runs extract and predict
+    # as one stage, up to stream_queue_size segmentations are read ahead, and the PNGs are only
+    # written with debug_png set
+    'stream_predict': False,
+    'stream_queue_size': 4,
+    'debug_png': False,
+
+    # step4: aggregation and export
+    'output_dir': os.path.join(PREDICTION_DIR, 'final_output_HU_refined'),
+    # results are upserted into results_path (SQLite), rows are written in batches of results_batch_size;
+    # the CSV file is exported from it after every run (None to skip the CSV)
+    'results_path': os.path.join(PREDICTION_DIR, 'final_output_HU_refined', 'results.sqlite'),
+    'csv_path': os.path.join(PREDICTION_DIR, 'final_output_HU_refined', 'PancreaticCancer_L3_results_add_unprocessed.csv'),
+    'variance_threshold': 50,
+    'results_batch_size': 100,
+    # images whose metrics a worker computes at once
+    'metrics_batch_size': 16,
+    # background threads writing the PNGs and DICOM SEG files, and how many writes may be queued
+    'export_writers': 2,
+    'export_queue_size': 32,
+
+    # pipeline.py: where the stage manifests live, worker processes per stage (None uses all cores)
+    # and how many independent stages may run at the same time
+    'manifest_dir': os.path.join(RESULT_DIR, 'manifests'),
+    'stage_workers': {'segment': None, 'extract': None, 'predict': 1, 'export': None},
+    'max_parallel_stages': 1,
+    # pipeline.py --worker: items claimed at a time, and seconds after which the lease of a silent worker expires
+    'shard_batch_size': 8,
+    'lease_seconds': 600,
+
+    # instrumentation.py: per-stage metrics are appended to metrics.jsonl and written as a Prometheus textfile
+    'metrics_dir': os.path.join(RESULT_DIR, 'metrics'),
+}
+
+
+def load_config(path=None, **overrides):
+    """Return the default config updated with the keys of a JSON file and keyword overrides."""
+    config = json.loads(json.dumps(DEFAULT_CONFIG))
+    if path is not None:
+        with open(path) as f:
+            user_config = json.load(f)
+        unknown = set(user_config) - set(DEFAULT_CONFIG)
+        if unknown:
+            raise KeyError(f"Unknown config keys in {path}: {sorted(unknown)}")
+        config.update(user_config)
+    config.update(overrides)
+    return config
+
+
+def stage_workers(config, stage):
+    """Number of worker processes for a stage."""
+    return config['stage_workers'].get(stage) or os.cpu_count() or 1
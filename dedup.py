@@ -0,0 +1,89 @@
+# Deduplication of series groups that hold the same images.
+# Re-exports of a series end up in several folders with the same SOPInstanceUIDs. Such groups get
+# the same fingerprint (a hash of their sorted SOPInstanceUIDs); only one of them, the canonical
+# group, is segmented and processed. The others are aliases: they are recorded in duplicates.json
+# in the group directory, their NIfTI is a symlink to the canonical one and step4 writes their
+# result rows from the canonical rows.
+import os
+import json
+import hashlib
+from collections import defaultdict
+
+from identifiers import SliceId, parse_group_name, parse_case_id, slice_group, group_name, case_id
+
+DUPLICATES_FILE = 'duplicates.json'
+
+
+def series_fingerprint(sop_instance_uids):
+    """Hash of the sorted SOPInstanceUIDs of a group, None if any of them is missing."""
+    if not sop_instance_uids or any(uid is None for uid in sop_instance_uids):
+        return None
+    return hashlib.sha1('\n'.join(sorted(sop_instance_uids)).encode()).hexdigest()
+
+
+def find_duplicates(sop_instance_uids, preferred=()):
+    """Map every duplicate group to its canonical group, from {group name: SOPInstanceUIDs}.
+
+    The canonical group of a set of duplicates is the first of them in preferred (e.g. groups
+    that were segmented before), otherwise the first by name.
+    """
+    by_fingerprint = defaultdict(list)
+    for name, uids in sop_instance_uids.items():
+        fingerprint = series_fingerprint(uids)
+        if fingerprint is not None:
+            by_fingerprint[fingerprint].append(name)
+    preferred = set(preferred)
+    duplicates = {}
+    for names in by_fingerprint.values():
+        if len(names) < 2:
+            continue
+        canonical = min(names, key=lambda name: (name not in preferred, name))
+        for name in names:
+            if name != canonical:
+                duplicates[name] = canonical
+    return duplicates
+
+
+def read_duplicates(group_dir):
+    """{alias group name: {'canonical': group name, 'source_dir': folder of its DICOM files}}."""
+    try:
+        with open(os.path.join(group_dir, DUPLICATES_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_duplicates(group_dir, duplicates):
+    os.makedirs(group_dir, exist_ok=True)
+    path = os.path.join(group_dir, DUPLICATES_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(duplicates, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def aliases_of(duplicates):
+    """{canonical group name: [alias group names]}."""
+    aliases = defaultdict(list)
+    for alias, entry in sorted(duplicates.items()):
+        aliases[entry['canonical']].append(alias)
+    return aliases
+
+
+def link_alias(target, link_path):
+    """Point link_path at target with a relative symlink, replacing whatever was there."""
+    tmp_path = link_path + '.tmp'
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    os.symlink(os.path.relpath(target, os.path.dirname(link_path)), tmp_path)
+    os.replace(tmp_path, link_path)
+
+
+def with_alias_rows(rows, duplicates):
+    """Yield the result rows, each followed by a copy for every alias of its group."""
+    aliases = aliases_of(duplicates)
+    for row in rows:
+        yield row
+        slice_id = parse_case_id(row['filename'])
+        for alias in aliases.get(group_name(slice_group(slice_id)), []):
+            alias_case = case_id(SliceId(*parse_group_name(alias), slice_id.slice))
+            yield dict(row, filename=alias_case, dicom_file_path=duplicates[alias]['source_dir'])
@@ -0,0 +1,157 @@
+# Persistent DICOM header index.
+# Parses the grouping attributes of every DICOM file once, across a process pool, and keeps
+# them in a SQLite database keyed by path, size and mtime. Re-running update() on the same
+# directory only re-parses files that are new or have changed since the last run.
+import os
+import json
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+
+from utils import read_dicom_attributes
+from instrumentation import metrics
+
+# Rows are written to the database in batches of this many files
+COMMIT_BATCH_SIZE = 1000
+
+
+def _to_plain(value):
+    """Convert pydicom values (DSfloat, IS, MultiValue, UID) to JSON serializable python values."""
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, str):
+        # UID and PersonName are str subclasses
+        return str(value)
+    if isinstance(value, (list, tuple)) or hasattr(value, '__iter__'):
+        return [_to_plain(v) for v in value]
+    try:
+        if float(value) == int(value):
+            return int(value)
+        return float(value)
+    except (TypeError, ValueError):
+        return str(value)
+
+
+def _parse_file(dicom_path):
+    """Parse one header and return the attributes as a JSON string (None if not DICOM)."""
+    try:
+        attrs = read_dicom_attributes(dicom_path)
+    except Exception as e:
+        # Truncated or otherwise unreadable files must not kill the whole pool
+        print(f"Could not read {dicom_path}: {e}")
+        return None
+    if attrs is None:
+        return None
+    return json.dumps({key: _to_plain(value) for key, value in attrs.items()})
+
+
+def _parse_file_in_worker(dicom_path):
+    """Worker function: like _parse_file, but also hands the worker's metrics back to the parent."""
+    return _parse_file(dicom_path), metrics.drain()
+
+
+def _merge_metrics(results):
+    for attrs, worker_metrics in results:
+        metrics.merge(worker_metrics)
+        yield attrs
+
+
+def _subtree_range(directory):
+    """[low, high) range of the roots below directory, compared case-sensitively like the filesystem."""
+    # Every root below directory starts with directory + os.sep, which sorts before directory + the next character
+    return directory + os.sep, directory + chr(ord(os.sep) + 1)
+
+
+class DicomIndex:
+    """On-disk index of DICOM header attributes, as returned by utils.read_dicom_attributes."""
+
+    def __init__(self, db_path, num_workers=None):
+        self.db_path = db_path
+        self.num_workers = num_workers or os.cpu_count() or 1
+        self.connection = sqlite3.connect(db_path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, root TEXT NOT NULL, size INTEGER NOT NULL, "
+            "mtime_ns INTEGER NOT NULL, attrs TEXT)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS files_root ON files (root)")
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def _select_under(self, columns, directory, extra=""):
+        directory = os.path.normpath(directory)
+        query = (f"SELECT {columns} FROM files WHERE (root = ? OR (root >= ? AND root < ?)) {extra} "
+                 "ORDER BY path")
+        return self.connection.execute(query, (directory,) + _subtree_range(directory))
+
+    def update(self, directory):
+        """Bring the index up to date for every .dcm file below directory.
+
+        Returns a tuple (number of files parsed, number of stale rows removed).
+        """
+        directory = os.path.normpath(directory)
+        known = {path: (size, mtime_ns)
+                 for path, size, mtime_ns in self._select_under("path, size, mtime_ns", directory)}
+
+        changed = []
+        for root, _, files in os.walk(directory):
+            for file in files:
+                if not file.endswith('.dcm'):
+                    continue
+                dicom_path = os.path.join(root, file)
+                try:
+                    stat = os.stat(dicom_path)
+                except OSError:
+                    continue
+                signature = (stat.st_size, stat.st_mtime_ns)
+                if known.pop(dicom_path, None) != signature:
+                    changed.append((dicom_path, root) + signature)
+
+        # Whatever is left in known no longer exists on disk
+        if known:
+            self.connection.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in known])
+
+        if len(changed) < 2 * self.num_workers:
+            parsed = map(_parse_file, [item[0] for item in changed])
+            self._store(changed, parsed)
+        else:
+            with ProcessPoolExecutor(max_workers=self.num_workers) as executor:
+                chunksize = max(1, min(256, len(changed) // (4 * self.num_workers)))
+                parsed = executor.map(_parse_file_in_worker, [item[0] for item in changed], chunksize=chunksize)
+                self._store(changed, _merge_metrics(parsed))
+
+        self.connection.commit()
+        return len(changed), len(known)
+
+    def _store(self, changed, parsed):
+        batch = []
+        for (dicom_path, root, size, mtime_ns), attrs in zip(changed, parsed):
+            batch.append((dicom_path, root, size, mtime_ns, attrs))
+            if len(batch) >= COMMIT_BATCH_SIZE:
+                self._write(batch)
+                batch = []
+        if batch:
+            self._write(batch)
+
+    def _write(self, batch):
+        self.connection.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)", batch)
+        self.connection.commit()
+
+    def records(self, directory):
+        """Yield (dicom_path, attributes) for every indexed DICOM file below directory."""
+        for dicom_path, attrs in self._select_under("path, attrs", directory, "AND attrs IS NOT NULL"):
+            yield dicom_path, json.loads(attrs)
+
+    def lookup(self, dicom_path):
+        """Return the indexed attributes of a single file, or None if it is unknown or not DICOM."""
+        row = self.connection.execute("SELECT attrs FROM files WHERE path = ?", (dicom_path,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return json.loads(row[0])
@@ -0,0 +1,218 @@
+# DICOM Segmentation export of the predicted skeletal muscle masks.
+# All masks of a source series go into a single multi-frame SEG object (BINARY, 1 bit per pixel),
+# one frame per segmented slice, each frame referencing its source image. Only the headers of the
+# source series are read; its pixel data is never loaded or copied.
+import io
+import os
+import datetime
+
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian, SegmentationStorage, generate_uid
+
+from series_order import get_series_order
+from writer_pool import write_file
+
+SEGMENT_LABEL = 'Skeletal muscle'
+SERIES_DESCRIPTION = 'Predicted skeletal muscle'
+# Added to the series number of the source series
+SERIES_NUMBER_OFFSET = 1000
+
+# Copied from the source series as they are
+PATIENT_STUDY_TAGS = [
+    'PatientName', 'PatientID', 'PatientBirthDate', 'PatientSex', 'PatientAge',
+    'StudyInstanceUID', 'StudyDate', 'StudyTime', 'StudyID', 'AccessionNumber',
+    'ReferringPhysicianName', 'StudyDescription', 'FrameOfReferenceUID',
+]
+
+
+def _code(value, scheme, meaning):
+    item = Dataset()
+    item.CodeValue = value
+    item.CodingSchemeDesignator = scheme
+    item.CodeMeaning = meaning
+    return item
+
+
+def pack_mask(mask):
+    """Bit-pack a 2D mask (nonzero = foreground) the way DICOM stores 1 bit pixel data."""
+    return np.packbits(np.asarray(mask, dtype=bool).ravel(), bitorder='little')
+
+
+def unpack_frames(pixel_data, num_frames, rows, columns):
+    """Inverse of pack_mask for num_frames concatenated frames, as a (frames, rows, columns) bool array."""
+    bits = np.unpackbits(np.frombuffer(pixel_data, dtype=np.uint8), count=num_frames * rows * columns,
+                         bitorder='little')
+    return bits.reshape(num_frames, rows, columns).astype(bool)
+
+
+def build_segmentation(source, series_order, frames):
+    """Build the SEG dataset of one series.
+
+    source is a header (no pixel data needed) of any slice of the series, series_order its
+    SeriesOrder, and frames a dict {slice number: 2D mask}. Frames are stored in slice order.
+    """
+    slice_numbers = sorted(frames)
+    rows, columns = np.shape(frames[slice_numbers[0]])
+    now = datetime.datetime.now()
+
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = SegmentationStorage
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = Dataset()
+    ds.file_meta = file_meta
+    for keyword in PATIENT_STUDY_TAGS:
+        if keyword in source:
+            setattr(ds, keyword, source[keyword].value)
+    ds.SOPClassUID = SegmentationStorage
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    # Re-exports of the same source series land in the same derived series
+    ds.SeriesInstanceUID = generate_uid(entropy_srcs=[str(source.SeriesInstanceUID), SERIES_DESCRIPTION])
+    ds.SeriesNumber = int(source.get('SeriesNumber') or 0) + SERIES_NUMBER_OFFSET
+    ds.SeriesDescription = SERIES_DESCRIPTION
+    ds.Modality = 'SEG'
+    ds.InstanceNumber = 1
+    ds.PositionReferenceIndicator = ''
+    ds.Manufacturer = 'SM_Segmentation'
+    ds.ManufacturerModelName = 'nnUNet ensemble'
+    ds.DeviceSerialNumber = '1'
+    ds.SoftwareVersions = '1'
+    ds.ContentDate = now.strftime('%Y%m%d')
+    ds.ContentTime = now.strftime('%H%M%S')
+    ds.ContentLabel = 'SKELETAL_MUSCLE'
+    ds.ContentDescription = 'Skeletal muscle at L3'
+    ds.ContentCreatorName = ''
+    ds.ImageType = ['DERIVED', 'PRIMARY']
+    ds.SegmentationType = 'BINARY'
+    ds.LossyImageCompression = '00'
+
+    # Image pixel module, 1 bit per pixel
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.Rows = rows
+    ds.Columns = columns
+    ds.BitsAllocated = 1
+    ds.BitsStored = 1
+    ds.HighBit = 0
+    ds.PixelRepresentation = 0
+    ds.NumberOfFrames = len(slice_numbers)
+
+    segment = Dataset()
+    segment.SegmentNumber = 1
+    segment.SegmentLabel = SEGMENT_LABEL
+    segment.SegmentAlgorithmType = 'AUTOMATIC'
+    segment.SegmentAlgorithmName = 'nnUNet ensemble'
+    segment.SegmentedPropertyCategoryCodeSequence = Sequence([_code('91723000', 'SCT', 'Anatomical Structure')])
+    segment.SegmentedPropertyTypeCodeSequence = Sequence([_code('127954009', 'SCT', 'Skeletal muscle')])
+    ds.SegmentSequence = Sequence([segment])
+
+    # Frames are indexed by segment number and position
+    dimension_organization = Dataset()
+    dimension_organization.DimensionOrganizationUID = generate_uid()
+    ds.DimensionOrganizationSequence = Sequence([dimension_organization])
+    segment_dimension = Dataset()
+    segment_dimension.DimensionOrganizationUID = dimension_organization.DimensionOrganizationUID
+    segment_dimension.DimensionIndexPointer = pydicom.tag.Tag('ReferencedSegmentNumber')
+    segment_dimension.FunctionalGroupPointer = pydicom.tag.Tag('SegmentIdentificationSequence')
+    position_dimension = Dataset()
+    position_dimension.DimensionOrganizationUID = dimension_organization.DimensionOrganizationUID
+    position_dimension.DimensionIndexPointer = pydicom.tag.Tag('ImagePositionPatient')
+    position_dimension.FunctionalGroupPointer = pydicom.tag.Tag('PlanePositionSequence')
+    ds.DimensionIndexSequence = Sequence([segment_dimension, position_dimension])
+
+    shared = Dataset()
+    pixel_measures = Dataset()
+    pixel_measures.PixelSpacing = source.get('PixelSpacing', [1, 1])
+    pixel_measures.SliceThickness = source.get('SliceThickness', 1)
+    shared.PixelMeasuresSequence = Sequence([pixel_measures])
+    if 'ImageOrientationPatient' in source:
+        orientation = Dataset()
+        orientation.ImageOrientationPatient = source.ImageOrientationPatient
+        shared.PlaneOrientationSequence = Sequence([orientation])
+    ds.SharedFunctionalGroupsSequence = Sequence([shared])
+
+    per_frame = []
+    referenced_instances = []
+    for k, slice_number in enumerate(slice_numbers):
+        sop_instance_uid = series_order.sop_instance_uids[slice_number]
+        item = Dataset()
+
+        source_image = Dataset()
+        source_image.ReferencedSOPClassUID = source.SOPClassUID
+        source_image.ReferencedSOPInstanceUID = sop_instance_uid
+        source_image.PurposeOfReferenceCodeSequence = Sequence(
+            [_code('121322', 'DCM', 'Source image for image processing operation')])
+        derivation = Dataset()
+        derivation.DerivationCodeSequence = Sequence([_code('113076', 'DCM', 'Segmentation')])
+        derivation.SourceImageSequence = Sequence([source_image])
+        item.DerivationImageSequence = Sequence([derivation])
+
+        frame_content = Dataset()
+        frame_content.DimensionIndexValues = [1, k + 1]
+        item.FrameContentSequence = Sequence([frame_content])
+        position = series_order.positions[slice_number]
+        if position is not None:
+            plane_position = Dataset()
+            plane_position.ImagePositionPatient = position
+            item.PlanePositionSequence = Sequence([plane_position])
+        segment_identification = Dataset()
+        segment_identification.ReferencedSegmentNumber = 1
+        item.SegmentIdentificationSequence = Sequence([segment_identification])
+        per_frame.append(item)
+
+        instance = Dataset()
+        instance.ReferencedSOPClassUID = source.SOPClassUID
+        instance.ReferencedSOPInstanceUID = sop_instance_uid
+        referenced_instances.append(instance)
+    ds.PerFrameFunctionalGroupsSequence = Sequence(per_frame)
+
+    referenced_series = Dataset()
+    referenced_series.SeriesInstanceUID = source.SeriesInstanceUID
+    referenced_series.ReferencedInstanceSequence = Sequence(referenced_instances)
+    ds.ReferencedSeriesSequence = Sequence([referenced_series])
+
+    # Frames follow each other without padding, only the end of the pixel data is padded
+    masks = np.stack([np.asarray(frames[slice_number], dtype=bool) for slice_number in slice_numbers])
+    pixel_data = np.packbits(masks.ravel(), bitorder='little').tobytes()
+    ds.PixelData = pixel_data + b'\0' * (len(pixel_data) % 2)
+    return ds
+
+
+def encode_segmentation(ds):
+    """The SEG dataset as DICOM file bytes."""
+    buffer = io.BytesIO()
+    ds.save_as(buffer, enforce_file_format=True)
+    return buffer.getvalue()
+
+
+def read_segmentation_frames(seg_path, series_order):
+    """Masks stored in an existing SEG file as {slice number: mask}, matched to series_order by SOPInstanceUID."""
+    ds = pydicom.dcmread(seg_path)
+    masks = unpack_frames(ds.PixelData, int(ds.NumberOfFrames), ds.Rows, ds.Columns)
+    slice_numbers = {uid: k for k, uid in enumerate(series_order.sop_instance_uids)}
+    frames = {}
+    for item, mask in zip(ds.PerFrameFunctionalGroupsSequence, masks):
+        uid = item.DerivationImageSequence[0].SourceImageSequence[0].ReferencedSOPInstanceUID
+        if uid in slice_numbers:
+            frames[slice_numbers[uid]] = mask
+    return frames
+
+
+def export_series_segmentation(seg_path, dicom_folder, packed_frames):
+    """Write the SEG file of one series from {slice number: pack_mask(mask)}.
+
+    Frames already stored in an existing seg_path are kept unless they are replaced, so
+    re-running only some slices of a series does not lose the others.
+    """
+    series_order = get_series_order(dicom_folder)
+    source = pydicom.dcmread(series_order[min(packed_frames)], stop_before_pixels=True)
+    frames = {}
+    if os.path.exists(seg_path):
+        frames.update(read_segmentation_frames(seg_path, series_order))
+    for slice_number, packed in packed_frames.items():
+        frames[slice_number] = unpack_frames(packed.tobytes(), 1, source.Rows, source.Columns)[0]
+    write_file(seg_path, encode_segmentation(build_segmentation(source, series_order, frames)), 'dicom_write')
@@ -0,0 +1,155 @@
+# In-memory ensemble inference for the skeletal muscle models (step3).
+# Every fold checkpoint of every model is loaded once. Each batch of images is preprocessed
+# once per model, then every fold runs over the whole batch before the next fold's weights are
+# swapped in. Probabilities are returned as arrays instead of being written to disk.
+#
+# Images follow the nnUNet 2D convention: arrays of shape (channels, 1, height, width) with a
+# properties dict holding 'spacing'. StandInModel can replace NnUNetModel on machines without
+# a GPU or without nnUNet installed.
+import os
+
+import numpy as np
+
+from aggregate import RunningMoments
+
+# Spacing nnUNet's NaturalImage2DIO reports for PNG inputs, which is what the models were trained on
+PNG_SPACING = (999, 1, 1)
+
+
+class NnUNetModel:
+    """All folds of one trained nnUNet model folder, loaded once."""
+
+    def __init__(self, model_folder, name, folds=(0, 1, 2, 3, 4), checkpoint_name='checkpoint_final.pth',
+                 device=None, use_mirroring=True):
+        import torch
+        from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+
+        if device is None:
+            device = torch.device('cuda', 0) if torch.cuda.is_available() else torch.device('cpu')
+        self.device = device
+        self.predictor = nnUNetPredictor(
+            tile_step_size=0.5,
+            use_gaussian=True,
+            use_mirroring=use_mirroring,
+            perform_everything_on_device=device.type == 'cuda',
+            device=device,
+            verbose=False,
+            verbose_preprocessing=False,
+            allow_tqdm=False
+        )
+        self.predictor.initialize_from_trained_model_folder(model_folder, use_folds=tuple(folds),
+                                                            checkpoint_name=checkpoint_name)
+        self.fold_parameters = list(self.predictor.list_of_parameters)
+        self.member_names = [f'{name}_{fold}' for fold in folds]
+        self.preprocessor = self.predictor.configuration_manager.preprocessor_class(verbose=False)
+
+    def _preprocess(self, image, properties):
+        import torch
+
+        predictor = self.predictor
+        data, _, properties = self.preprocessor.run_case_npy(image, None, dict(properties), predictor.plans_manager,
+                                                             predictor.configuration_manager, predictor.dataset_json)
+        return torch.from_numpy(data).contiguous().float(), properties
+
+    def predict_batch(self, images, properties):
+        """Yield (member_name, probabilities of every image) for each fold."""
+        import torch
+        from nnunetv2.inference.export_prediction import convert_predicted_logits_to_segmentation_with_correct_shape
+
+        predictor = self.predictor
+        preprocessed = [self._preprocess(image, props) for image, props in zip(images, properties)]
+        network = getattr(predictor.network, '_orig_mod', predictor.network)
+        for member_name, parameters in zip(self.member_names, self.fold_parameters):
+            network.load_state_dict(parameters)
+            probabilities = []
+            with torch.no_grad():
+                for data, props in preprocessed:
+                    logits = predictor.predict_sliding_window_return_logits(data).to('cpu')
+                    _, probs = convert_predicted_logits_to_segmentation_with_correct_shape(
+                        logits, predictor.plans_manager, predictor.configuration_manager,
+                        predictor.label_manager, props, return_probabilities=True)
+                    probabilities.append(probs)
+            yield member_name, probabilities
+
+
+class StandInModel:
+    """Numpy stand-in for a trained model: a soft intensity threshold with a per-fold perturbation."""
+
+    def __init__(self, name, folds=(0, 1, 2, 3, 4), threshold=0.5, scale=0.1, seed=0):
+        self.member_names = [f'{name}_{fold}' for fold in folds]
+        self.threshold = threshold
+        self.scale = scale
+        self.seed = seed
+
+    def predict_batch(self, images, properties):
+        """Yield (member_name, probabilities of every image) for each fold."""
+        for k, member_name in enumerate(self.member_names):
+            rng = np.random.default_rng(self.seed + k)
+            shift = rng.normal(0, self.scale)
+            probabilities = []
+            for image in images:
+                image = np.asarray(image, dtype=np.float32)
+                # Scale the first channel to [0, 1] so the stand-in works for PNG and HU inputs
+                low, high = float(image[0].min()), float(image[0].max())
+                normalized = (image[0] - low) / (high - low) if high > low else np.zeros_like(image[0])
+                foreground = 1 / (1 + np.exp(-(normalized - self.threshold - shift) / self.scale))
+                probabilities.append(np.stack([1 - foreground, foreground]).astype(np.float32))
+            yield member_name, probabilities
+
+
+class EnsemblePredictor:
+    """Runs every member of a list of models over batches of in-memory images."""
+
+    def __init__(self, models):
+        self.models = list(models)
+
+    @property
+    def member_names(self):
+        return [name for model in self.models for name in model.member_names]
+
+    def predict(self, images, properties=None):
+        """Yield (member_name, list of probability arrays, one per image) for every ensemble member."""
+        if properties is None:
+            properties = [{'spacing': PNG_SPACING} for _ in images]
+        for model in self.models:
+            yield from model.predict_batch(images, properties)
+
+    def predict_aggregated(self, images, properties=None, channel=1):
+        """Return a list of (mean, variance) of the ensemble's probabilities of channel, one per image."""
+        moments = [RunningMoments() for _ in images]
+        for _, probabilities in self.predict(images, properties):
+            for running, probs in zip(moments, probabilities):
+                running.update(np.asarray(probs[channel]).squeeze())
+        return [(running.mean, running.variance) for running in moments]
+
+
+def slice_image(pixels, pixel_spacing=None):
+    """Model input of an in-memory 2D slice, the same as read_png_image of the slice saved as PNG.
+
+    The models were trained on PNGs, so nnUNet gets PNG_SPACING; the DICOM pixel spacing is
+    kept in the properties as 'pixel_spacing'.
+    """
+    image = np.asarray(pixels, dtype=np.float32)
+    if image.ndim == 2:
+        image = image[None]
+    else:
+        image = image.transpose(2, 0, 1)
+    properties = {'spacing': PNG_SPACING}
+    if pixel_spacing is not None:
+        properties['pixel_spacing'] = tuple(pixel_spacing)
+    return image[:, None], properties
+
+
+def read_png_image(png_path):
+    """Read a PNG the way nnUNet's NaturalImage2DIO does: (channels, 1, height, width) float32 and its properties."""
+    from PIL import Image
+
+    return slice_image(Image.open(png_path))
+
+
+def save_member_probabilities(output_dir, case_ids, member_name, probabilities):
+    """Write one member's probabilities in the layout step4 reads: ensemble_<member>/<case>.npz."""
+    member_dir = os.path.join(output_dir, f'ensemble_{member_name}')
+    os.makedirs(member_dir, exist_ok=True)
+    for case_id, probs in zip(case_ids, probabilities):
+        np.savez_compressed(os.path.join(member_dir, case_id + '.npz'), probabilities=probs)
@@ -0,0 +1,59 @@
+# Stand-in for the TotalSegmentator command line, for testing the pipeline without a GPU.
+# Accepts the same -i/-o/--ml/-d arguments and writes a multilabel NIfTI of the size of the
+# input series with a band of vertebra labels, L3 (29) in the middle of the volume.
+#
+#   scheduler = SegmentationScheduler(queue_path, slots=['cpu', 'cpu'],
+#                                     command=[sys.executable, 'fake_segmenter.py', '-i', '{input}', '-o', '{output}'])
+import os
+import sys
+import time
+import argparse
+
+import nibabel as nib
+import numpy as np
+import pydicom
+
+# TotalSegmentator labels of the lumbar vertebrae L5..L1
+LUMBAR_LABELS = [27, 28, 29, 30, 31]
+
+
+def fake_segmentation(num_slices, rows, columns, l3_fraction=0.5, band=None):
+    """Label volume (columns, rows, slices) with the lumbar vertebrae stacked around l3_fraction."""
+    data = np.zeros((columns, rows, num_slices), dtype=np.uint8)
+    band = band or max(1, num_slices // 20)
+    center = int(l3_fraction * num_slices)
+    x0, x1 = columns // 3, 2 * columns // 3
+    y0, y1 = rows // 3, 2 * rows // 3
+    for offset, label in zip(range(-2, 3), LUMBAR_LABELS):
+        z0 = max(0, center + (offset * band) - band // 2)
+        z1 = min(num_slices, z0 + band)
+        data[x0:x1, y0:y1, z0:z1] = label
+    return data
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fake TotalSegmentator for testing")
+    parser.add_argument('-i', dest='input', required=True)
+    parser.add_argument('-o', dest='output', required=True)
+    parser.add_argument('--ml', action='store_true')
+    parser.add_argument('-d', dest='device', default='cpu')
+    parser.add_argument('--delay', type=float, default=0.0, help="seconds to sleep, to mimic inference time")
+    parser.add_argument('--fail', action='store_true', help="exit with an error instead of writing output")
+    args, _ = parser.parse_known_args(argv)
+
+    time.sleep(args.delay)
+    if args.fail:
+        print("fake segmenter failing on purpose", file=sys.stderr)
+        return 1
+
+    dicom_files = sorted(f for f in os.listdir(args.input) if f.endswith('.dcm'))
+    first = pydicom.dcmread(os.path.join(args.input, dicom_files[0]), stop_before_pixels=True)
+    data = fake_segmentation(len(dicom_files), int(first.Rows), int(first.Columns))
+    output = args.output if args.output.endswith(('.nii', '.nii.gz')) else args.output + '.nii'
+    nib.save(nib.Nifti1Image(data, np.eye(4)), output)
+    print(f"fake segmentation of {len(dicom_files)} slices written to {output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
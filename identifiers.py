@@ -0,0 +1,120 @@
+# One identifier scheme for a slice, carried through all stages:
+#   group folder (step1)     <subject>__<series>__group<n>
+#   NIfTI file (step1)       nnUNet_total_seg_l3_<subject>__<series>__group<n>.nii
+#   case id (step2..step4)   <subject>__<series>__group<n>__<slice:04d>
+# The parts are separated by a double underscore, which is not allowed inside a part, nor is an
+# underscore at either end of a part (it would run into the separator), so every name can be
+# parsed back without guessing. GroupIndex maps group ids to their folders.
+import os
+import re
+from collections import namedtuple, defaultdict
+
+SEPARATOR = '__'
+NIFTI_PREFIX = 'nnUNet_total_seg_l3_'
+
+GroupId = namedtuple('GroupId', ['subject', 'series', 'group'])
+SliceId = namedtuple('SliceId', ['subject', 'series', 'group', 'slice'])
+
+_GROUP_PATTERN = re.compile(r'^(?P<subject>.+?)__(?P<series>.+?)__group(?P<group>\d+)$')
+_CASE_PATTERN = re.compile(r'^(?P<subject>.+?)__(?P<series>.+?)__group(?P<group>\d+)__(?P<slice>\d+)$')
+
+
+class AmbiguousMatchError(LookupError):
+    """More than one folder matches an identifier."""
+
+
+def _check_part(name, value):
+    value = str(value)
+    if not value or SEPARATOR in value or os.sep in value or value.startswith('_') or value.endswith('_'):
+        raise ValueError(f"Invalid {name} {value!r} for an identifier")
+    return value
+
+
+def group_name(group_id):
+    """Folder name of a group, e.g. 'SUBJ01__3__group1'."""
+    subject = _check_part('subject', group_id.subject)
+    series = _check_part('series', group_id.series)
+    return f"{subject}{SEPARATOR}{series}{SEPARATOR}group{int(group_id.group)}"
+
+
+def parse_group_name(name):
+    """GroupId of a group folder name. Raises ValueError if name does not follow the scheme."""
+    match = _GROUP_PATTERN.match(name)
+    if match is None:
+        raise ValueError(f"{name!r} is not a group name")
+    return GroupId(_check_part('subject', match['subject']), _check_part('series', match['series']), int(match['group']))
+
+
+def nifti_name(group_id):
+    """File name of the TotalSegmentator output of a group."""
+    return NIFTI_PREFIX + group_name(group_id) + '.nii'
+
+
+def parse_nifti_name(filename):
+    """GroupId of a TotalSegmentator output file name (.nii or .nii.gz)."""
+    name = os.path.basename(filename)
+    if not name.startswith(NIFTI_PREFIX):
+        raise ValueError(f"{filename!r} is not a segmentation output name")
+    for extension in ('.nii.gz', '.nii'):
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+            break
+    return parse_group_name(name[len(NIFTI_PREFIX):])
+
+
+def case_id(slice_id):
+    """Case identifier of one slice, used for the PNG, probability and result file names."""
+    return f"{group_name(slice_id)}{SEPARATOR}{int(slice_id.slice):04d}"
+
+
+def parse_case_id(name):
+    """SliceId of a case identifier, e.g. from '<case>.npz' or '<case>_0000.png' with the suffix removed."""
+    match = _CASE_PATTERN.match(name)
+    if match is None:
+        raise ValueError(f"{name!r} is not a case id")
+    return SliceId(_check_part('subject', match['subject']), _check_part('series', match['series']),
+                   int(match['group']), int(match['slice']))
+
+
+def slice_group(slice_id):
+    """GroupId of the group a slice belongs to."""
+    return GroupId(slice_id.subject, slice_id.series, slice_id.group)
+
+
+class GroupIndex:
+    """Hash index from GroupId to group folder, built once from one or more group directories."""
+
+    def __init__(self, directories):
+        if isinstance(directories, str):
+            directories = [directories]
+        self.folders = defaultdict(list)
+        self.unrecognized = []
+        for directory in directories:
+            for entry in os.scandir(directory):
+                if not entry.is_dir():
+                    continue
+                try:
+                    self.folders[parse_group_name(entry.name)].append(entry.path)
+                except ValueError:
+                    self.unrecognized.append(entry.path)
+
+    def __len__(self):
+        return len(self.folders)
+
+    def __contains__(self, group_id):
+        return group_id in self.folders
+
+    @property
+    def ambiguous(self):
+        """Group ids that more than one folder claims."""
+        return {group_id: paths for group_id, paths in self.folders.items() if len(paths) > 1}
+
+    def resolve(self, group_id):
+        """Folder of a group. Raises KeyError if there is none and AmbiguousMatchError if there are several."""
+        group_id = GroupId(group_id.subject, group_id.series, group_id.group)
+        paths = self.folders.get(group_id)
+        if not paths:
+            raise KeyError(f"No group folder for {group_name(group_id)}")
+        if len(paths) > 1:
+            raise AmbiguousMatchError(f"{group_name(group_id)} matches several folders: {paths}")
+        return paths[0]
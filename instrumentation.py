@@ -0,0 +1,183 @@
+# Lightweight per-stage metrics for long cohort runs.
+# Code wraps units of work in metrics.timed(stage); per stage we keep the item count, total and
+# maximum latency, bytes read and written, the wall-clock span, and the peak RSS the process had
+# reached by the end of the stage's items (ru_maxrss covers the whole process, not the stage).
+# Recording is a couple of clock reads and a dict update, cheap enough to leave on.
+#
+# Worker processes hand their numbers back to the parent with metrics.drain() / metrics.merge().
+# At the end of a run export_metrics() appends a JSON line per stage to metrics.jsonl, rewrites the
+# run's Prometheus textfile (one per run name, so step1..step4 and the pipeline do not overwrite
+# each other) and prints a summary table.
+import os
+import json
+import time
+import resource
+import threading
+import contextlib
+
+# Metric files written by export_metrics
+JSON_LOG_FILE = 'metrics.jsonl'
+PROMETHEUS_FILE = 'sm_segmentation_{run}.prom'
+
+
+def process_peak_rss_mb():
+    """Peak resident set size of this process since it started, in MB."""
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Measurement:
+    """Byte counters of one timed unit of work, filled in by the instrumented code."""
+    __slots__ = ('bytes_read', 'bytes_written')
+
+    def __init__(self, bytes_read=0, bytes_written=0):
+        self.bytes_read = bytes_read
+        self.bytes_written = bytes_written
+
+
+class Metrics:
+    """Per-stage counters of the current process."""
+
+    def __init__(self):
+        self.enabled = True
+        self._lock = threading.Lock()
+        self._stages = {}
+
+    def record(self, stage, seconds, items=1, bytes_read=0, bytes_written=0, start=None):
+        if not self.enabled:
+            return
+        end = time.time()
+        start = end - seconds if start is None else start
+        rss = process_peak_rss_mb()
+        with self._lock:
+            stats = self._stages.get(stage)
+            if stats is None:
+                stats = self._stages[stage] = {
+                    'items': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'bytes_read': 0, 'bytes_written': 0,
+                    'start': start, 'end': end, 'process_peak_rss_mb': 0.0,
+                }
+            stats['items'] += items
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            stats['bytes_read'] += bytes_read
+            stats['bytes_written'] += bytes_written
+            stats['start'] = min(stats['start'], start)
+            stats['end'] = max(stats['end'], end)
+            stats['process_peak_rss_mb'] = max(stats['process_peak_rss_mb'], rss)
+
+    @contextlib.contextmanager
+    def timed(self, stage, items=1, bytes_read=0, bytes_written=0):
+        """Time the enclosed block as items of stage. The yielded Measurement takes byte counts."""
+        measurement = Measurement(bytes_read, bytes_written)
+        start_wall = time.time()
+        start = time.perf_counter()
+        try:
+            yield measurement
+        finally:
+            self.record(stage, time.perf_counter() - start, items, measurement.bytes_read,
+                        measurement.bytes_written, start_wall)
+
+    def snapshot(self):
+        with self._lock:
+            return {stage: dict(stats) for stage, stats in self._stages.items()}
+
+    def drain(self):
+        """Return the counters collected so far and reset them (used to ship them out of worker processes)."""
+        with self._lock:
+            stages = self._stages
+            self._stages = {}
+        return stages
+
+    def merge(self, stages):
+        """Add counters drained from another process."""
+        with self._lock:
+            for stage, other in stages.items():
+                stats = self._stages.get(stage)
+                if stats is None:
+                    self._stages[stage] = dict(other)
+                    continue
+                for key in ('items', 'seconds', 'bytes_read', 'bytes_written'):
+                    stats[key] += other[key]
+                for key in ('max_seconds', 'end', 'process_peak_rss_mb'):
+                    stats[key] = max(stats[key], other[key])
+                stats['start'] = min(stats['start'], other['start'])
+
+    def reset(self):
+        with self._lock:
+            self._stages = {}
+
+    def _after_fork(self):
+        # Forked workers start empty, otherwise draining them would count the parent's numbers again
+        self._lock = threading.Lock()
+        self._stages = {}
+
+
+# Metrics of this process
+metrics = Metrics()
+os.register_at_fork(after_in_child=metrics._after_fork)
+
+
+def _derived(stats):
+    wall = max(stats['end'] - stats['start'], 1e-9)
+    return {
+        'items_per_second': stats['items'] / wall,
+        'mean_seconds': stats['seconds'] / stats['items'] if stats['items'] else 0.0,
+        'wall_seconds': wall,
+    }
+
+
+def summary_table(stages):
+    """Text table of the per-stage metrics."""
+    lines = [f"{'stage':<22}{'items':>8}{'items/s':>10}{'mean ms':>10}{'max ms':>10}"
+             f"{'read MB':>10}{'written MB':>12}{'proc peak MB':>14}"]
+    for stage, stats in sorted(stages.items()):
+        derived = _derived(stats)
+        lines.append(f"{stage:<22}{stats['items']:>8}{derived['items_per_second']:>10.1f}"
+                     f"{1000 * derived['mean_seconds']:>10.1f}{1000 * stats['max_seconds']:>10.1f}"
+                     f"{stats['bytes_read'] / 2 ** 20:>10.1f}{stats['bytes_written'] / 2 ** 20:>12.1f}"
+                     f"{stats['process_peak_rss_mb']:>14.1f}")
+    return '\n'.join(lines)
+
+
+def write_json_log(path, stages, run):
+    """Append one JSON line per stage to path."""
+    timestamp = time.strftime('%Y-%m-%dT%H:%M:%S')
+    with open(path, 'a') as f:
+        for stage, stats in sorted(stages.items()):
+            f.write(json.dumps(dict(stats, **_derived(stats), stage=stage, run=run, timestamp=timestamp)) + '\n')
+
+
+def write_prometheus(path, stages, run):
+    """Write the metrics in the Prometheus textfile collector format (atomically)."""
+    metric_defs = [
+        ('sm_stage_items_total', 'counter', 'Items processed by the stage', lambda s: s['items']),
+        ('sm_stage_seconds_total', 'counter', 'Time spent in stage items', lambda s: s['seconds']),
+        ('sm_stage_max_seconds', 'gauge', 'Slowest item of the stage', lambda s: s['max_seconds']),
+        ('sm_stage_items_per_second', 'gauge', 'Stage throughput over its wall-clock span',
+         lambda s: _derived(s)['items_per_second']),
+        ('sm_stage_bytes_read_total', 'counter', 'Bytes read by the stage', lambda s: s['bytes_read']),
+        ('sm_stage_bytes_written_total', 'counter', 'Bytes written by the stage', lambda s: s['bytes_written']),
+        ('sm_process_peak_rss_bytes', 'gauge', 'Peak resident set size of the process by the end of the stage',
+         lambda s: int(s['process_peak_rss_mb'] * 2 ** 20)),
+    ]
+    lines = []
+    for name, kind, help_text, value in metric_defs:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for stage, stats in sorted(stages.items()):
+            lines.append(f'{name}{{run="{run}",stage="{stage}"}} {value(stats)}')
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp_path, path)
+
+
+def export_metrics(metrics_dir, run):
+    """Write the collected metrics of this process and print the summary table."""
+    stages = metrics.snapshot()
+    if not stages:
+        return
+    os.makedirs(metrics_dir, exist_ok=True)
+    write_json_log(os.path.join(metrics_dir, JSON_LOG_FILE), stages, run)
+    write_prometheus(os.path.join(metrics_dir, PROMETHEUS_FILE.format(run=run)), stages, run)
+    print(summary_table(stages))
@@ -0,0 +1,130 @@
+# Two-pass segmentation of the lumbar slab instead of the whole series.
+# Pass 1 runs a cheap localizer (TotalSegmentator --fast) on every localizer_step-th slice of a
+# group to estimate where L3 is. Pass 2 segments only the slices around it, padded by
+# slab_padding slices on both ends. The slab is written next to the NIfTI output as a sidecar
+# (<nifti>.slab.json) holding its first slice in the group's InstanceNumber order, which step2
+# uses to map the slab's slice indices back to the full series.
+#
+# Any command with the {input}, {output} and {device} placeholders can be the localizer, e.g.
+# fake_segmenter.py for testing without a GPU.
+import os
+import json
+
+import nibabel as nib
+
+from utils import locate_label_slices
+from materialize import materialize_group
+from series_order import get_series_order
+from scheduler import SegmentationScheduler, nifti_output_valid
+
+LOCALIZER_COMMAND = ["TotalSegmentator", "-i", "{input}", "-o", "{output}", "--ml", "--fast", "-d", "{device}"]
+SLAB_SUFFIX = '.slab.json'
+
+
+def slab_sidecar_path(nifti_path):
+    return nifti_path + SLAB_SUFFIX
+
+
+def read_slab(nifti_path):
+    """The slab a NIfTI output was segmented from, {'first_slice', 'num_slices', 'series_slices'}, or None."""
+    try:
+        with open(slab_sidecar_path(nifti_path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_slab(nifti_path, first_slice, num_slices, series_slices):
+    slab = {'first_slice': first_slice, 'num_slices': num_slices, 'series_slices': series_slices}
+    tmp_path = slab_sidecar_path(nifti_path) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(slab, f)
+    os.replace(tmp_path, slab_sidecar_path(nifti_path))
+    return slab
+
+
+def slab_range(localizer_nifti, series_slices, step, padding, label):
+    """(first, last) slice of the slab in the series' InstanceNumber order, or None if the localizer found no L3.
+
+    The localizer saw every step-th slice; like the full segmentation, its slices run in
+    reverse InstanceNumber order.
+    """
+    nifti = nib.load(localizer_nifti)
+    z_indices, _ = locate_label_slices(nifti, label)
+    if len(z_indices) == 0:
+        return None
+    num_sampled = nifti.shape[2]
+    sampled = [num_sampled - 1 - int(z) for z in z_indices]
+    # A sampled slice stands for the step slices up to the next sample
+    first = max(0, min(sampled) * step - padding)
+    last = min(series_slices - 1, max(sampled) * step + step - 1 + padding)
+    return first, last
+
+
+def make_localizer_scheduler(config):
+    queue_path = os.path.splitext(config['queue_path'])[0] + '_localizer.sqlite'
+    return SegmentationScheduler(queue_path,
+                                 slots=config['segmentation_slots'],
+                                 command=config['localizer_command'] or LOCALIZER_COMMAND,
+                                 max_attempts=config['segmentation_max_attempts'],
+                                 backoff=config['segmentation_backoff'])
+
+
+def remove_output(scheduler, name, nifti_path):
+    """Remove the NIfTI output of a group and queue its segmentation job again."""
+    if os.path.exists(nifti_path):
+        os.remove(nifti_path)
+    scheduler.reset_job(name)
+
+
+def prepare_slabs(config, groups, nifti_paths, scheduler):
+    """Run the localizer pass and set up the slab of every group.
+
+    groups is {group name: group folder} and nifti_paths {group name: final NIfTI path}.
+    Returns {group name: folder to segment}: the slab folder, or the whole group folder if
+    the localizer found no L3. Outputs segmented from a different slab are removed and their
+    jobs in the segmentation scheduler are reset, so they are segmented again.
+    """
+    slab_dir = config['slab_dir']
+    step = config['localizer_step']
+    localizer = make_localizer_scheduler(config)
+
+    # Pass 1: localize on every step-th slice
+    localizer_outputs = {}
+    for name, group_dir in groups.items():
+        files = get_series_order(group_dir).files
+        sampled_dir = os.path.join(slab_dir, name + '__localizer')
+        localizer_output = os.path.join(slab_dir, name + '__localizer.nii')
+        if materialize_group(files[::step], sampled_dir, 'manifest') and os.path.exists(localizer_output):
+            os.remove(localizer_output)
+        localizer.add_job(name, sampled_dir, localizer_output)
+        localizer_outputs[name] = localizer_output
+    print("localizer jobs: ", localizer.run(list(groups)))
+
+    # Pass 2: the padded slab around L3
+    inputs = {}
+    for name, group_dir in groups.items():
+        files = get_series_order(group_dir).files
+        slab = None
+        if nifti_output_valid(localizer_outputs[name]):
+            slab = slab_range(localizer_outputs[name], len(files), step, config['slab_padding'],
+                              config['vertebra_label'])
+        if slab is None:
+            print(f"{name}: no L3 found by the localizer, segmenting the whole series")
+            first, last = 0, len(files) - 1
+            inputs[name] = group_dir
+        else:
+            first, last = slab
+            inputs[name] = os.path.join(slab_dir, name)
+            materialize_group(files[first:last + 1], inputs[name], config['materialize_mode'])
+            print(f"{name}: segmenting slices {first}-{last} of {len(files)}")
+
+        nifti_path = nifti_paths[name]
+        previous = read_slab(nifti_path)
+        if previous is not None and [previous['first_slice'], previous['num_slices']] != [first, last - first + 1]:
+            remove_output(scheduler, name, nifti_path)
+        if previous is None and os.path.exists(nifti_path) and (first, last) != (0, len(files) - 1):
+            # A whole-series output from a run without slabs
+            remove_output(scheduler, name, nifti_path)
+        write_slab(nifti_path, first, last - first + 1, len(files))
+    return inputs
@@ -0,0 +1,122 @@
+# Materialization of axial series groups into their own folders.
+# Instead of copying every slice, a group folder can be made of hardlinks, symlinks or just
+# a manifest listing the source files. Every group folder carries a manifest with a fingerprint
+# of its sources, so re-runs skip groups whose sources did not change.
+import os
+import json
+import errno
+import shutil
+import hashlib
+import tempfile
+import contextlib
+
+from instrumentation import metrics
+
+GROUP_MANIFEST_FILE = 'manifest.json'
+MATERIALIZE_MODES = ('copy', 'hardlink', 'symlink', 'manifest')
+
+
+def group_fingerprint(dicom_paths):
+    """Hash of the names, sizes and mtimes of the source files of a group."""
+    digest = hashlib.sha1()
+    for dicom_path in sorted(dicom_paths):
+        stat = os.stat(dicom_path)
+        digest.update(f"{os.path.basename(dicom_path)}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+def read_group_manifest(group_dir):
+    """Return the manifest of a group folder, or None if it has none."""
+    try:
+        with open(os.path.join(group_dir, GROUP_MANIFEST_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _same_filesystem(path, directory):
+    return os.stat(path).st_dev == os.stat(directory).st_dev
+
+
+def _link_or_copy(dicom_path, destination, mode):
+    """Link dicom_path to destination, or copy it. Returns True if the file was copied."""
+    if mode == 'symlink':
+        os.symlink(os.path.abspath(dicom_path), destination)
+        return False
+    if mode == 'hardlink' and _same_filesystem(dicom_path, os.path.dirname(destination)):
+        try:
+            os.link(dicom_path, destination)
+            return False
+        except OSError as e:
+            # Some network filesystems refuse hardlinks even on the same device
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                raise
+    shutil.copy2(dicom_path, destination)
+    return True
+
+
+def materialize_group(dicom_paths, group_dir, mode='hardlink'):
+    """Make group_dir hold the DICOM files of one group.
+
+    mode is one of 'copy', 'hardlink', 'symlink' or 'manifest'. Hardlinks fall back to a copy
+    when the source lives on a different filesystem. 'manifest' only writes the list of source
+    files. Returns False if group_dir already holds the same sources and nothing was done.
+    """
+    if mode not in MATERIALIZE_MODES:
+        raise ValueError(f"Unknown materialize mode {mode!r}, expected one of {MATERIALIZE_MODES}")
+
+    fingerprint = group_fingerprint(dicom_paths)
+    manifest = read_group_manifest(group_dir)
+    if manifest is not None and manifest.get("fingerprint") == fingerprint and manifest.get("mode") == mode:
+        return False
+
+    os.makedirs(group_dir, exist_ok=True)
+    # Drop whatever a previous run left behind for this group
+    for name in os.listdir(group_dir):
+        if name.endswith('.dcm'):
+            os.remove(os.path.join(group_dir, name))
+
+    if mode != 'manifest':
+        for dicom_path in dicom_paths:
+            with metrics.timed('materialize') as measurement:
+                if _link_or_copy(dicom_path, os.path.join(group_dir, os.path.basename(dicom_path)), mode):
+                    measurement.bytes_written = os.path.getsize(dicom_path)
+
+    # The manifest is written last, so an interrupted group is redone on the next run
+    manifest = {
+        "fingerprint": fingerprint,
+        "mode": mode,
+        "sources": [os.path.abspath(dicom_path) for dicom_path in dicom_paths],
+    }
+    tmp_path = os.path.join(group_dir, GROUP_MANIFEST_FILE + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, os.path.join(group_dir, GROUP_MANIFEST_FILE))
+    return True
+
+
+def group_source_files(group_dir):
+    """Full paths of the DICOM files of a group folder, resolving manifest-only groups."""
+    files = [os.path.join(group_dir, name) for name in sorted(os.listdir(group_dir)) if name.endswith('.dcm')]
+    if files:
+        return files
+    manifest = read_group_manifest(group_dir)
+    if manifest is None:
+        return []
+    return sorted(manifest["sources"], key=os.path.basename)
+
+
+@contextlib.contextmanager
+def group_input_folder(group_dir):
+    """Yield a folder with the group's DICOM files that external tools can read.
+
+    Materialized groups are used as is. For manifest-only groups a temporary folder of
+    symlinks is created and removed again afterwards.
+    """
+    if any(name.endswith('.dcm') for name in os.listdir(group_dir)):
+        yield group_dir
+        return
+    with tempfile.TemporaryDirectory(prefix=os.path.basename(group_dir) + '_') as tmp_dir:
+        for dicom_path in group_source_files(group_dir):
+            os.symlink(dicom_path, os.path.join(tmp_dir, os.path.basename(dicom_path)))
+        yield tmp_dir
@@ -0,0 +1,314 @@
+# End-to-end runner for step1-step4.
+# The steps are stages of a DAG. Every stage lists its items (groups, segmentations, slices, cases)
+# with their input files and keeps a manifest of the content hash of each item's inputs and of the
+# outputs it produced (step1's inputs, the DICOM archive, are only compared by size and mtime). On a re-run only items whose inputs changed, or whose outputs are missing,
+# are processed again; changed outputs change the input hashes of the next stage in turn.
+#
+#   python pipeline.py [config.json] [--stages extract predict] [--force]
+#
+# With --worker, any number of nodes can run the same command on a shared filesystem: the items
+# of each stage are split between them through lease files (see sharding.py) and every node
+# waits for the others at the end of a stage.
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+from urllib.parse import quote
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from config import load_config, stage_workers
+from instrumentation import export_metrics
+from sharding import LeaseDir, claim_batch, default_worker_name
+
+# Lease held while a worker lists a stage's items or merges the part manifests
+MANIFEST_LOCK = '.manifest'
+
+Stage = namedtuple('Stage', ['name', 'module', 'depends_on'])
+
+STAGES = [
+    Stage('segment', 'step1', []),
+    Stage('extract', 'step2', ['segment']),
+    Stage('predict', 'step3', ['extract']),
+    Stage('export', 'step4', ['predict']),
+]
+# With stream_predict, step3 reads the L3 slices of the segmentations itself (no PNGs in between)
+STREAM_STAGES = [
+    Stage('segment', 'step1', []),
+    Stage('predict', 'step3', ['segment']),
+    Stage('export', 'step4', ['predict']),
+]
+
+
+def pipeline_stages(config):
+    return STREAM_STAGES if config['stream_predict'] else STAGES
+
+
+def file_digest(path, previous=None, content=True):
+    """[size, mtime_ns, sha256] of a file, reusing previous if size and mtime did not change. None if missing.
+
+    Without content the file is not read and the hash is None.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if previous is not None and previous[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return previous
+    if not content:
+        return [stat.st_size, stat.st_mtime_ns, None]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+
+
+def input_signature(inputs, previous=None, content=True):
+    """Return (hash over the contents of all inputs, {path: file digest}).
+
+    Without content the hash is over the sizes and mtimes of the inputs instead.
+    """
+    previous = previous or {}
+    digests = {path: file_digest(path, previous.get(path), content) for path in inputs}
+    combined = hashlib.sha256()
+    for path in sorted(digests):
+        digest = digests[path]
+        if digest is None:
+            key = 'missing'
+        else:
+            key = digest[2] if content else f'{digest[0]} {digest[1]}'
+        combined.update(f"{path}\0{key}\n".encode())
+    return combined.hexdigest(), digests
+
+
+def _json_default(value):
+    # numpy scalars in step4's CSV rows
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+
+class Manifest:
+    """Per-stage record of item input hashes and outputs, stored as JSON."""
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as f:
+                self.items = json.load(f)['items']
+        except (OSError, ValueError, KeyError):
+            self.items = {}
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'items': self.items}, f, default=_json_default)
+        os.replace(tmp_path, self.path)
+
+    def is_current(self, item_id, input_hash):
+        entry = self.items.get(item_id)
+        return (entry is not None and entry['input_hash'] == input_hash
+                and all(os.path.exists(path) for path in entry['outputs']))
+
+
+def _import_stage(stage):
+    return __import__(stage.module)
+
+
+def _stale_items(module, config, manifest, force):
+    """List the items of a stage. Returns (items, stale items, {item id: (input hash, digests)})."""
+    items = module.list_items(config)
+    # Items that disappeared upstream are forgotten (their outputs are left in place)
+    for item_id in set(manifest.items) - set(items):
+        del manifest.items[item_id]
+
+    # Stages can opt out of hashing the contents of their inputs (step1: the whole DICOM archive)
+    content = getattr(module, 'HASH_INPUTS', True)
+    stale = {}
+    signatures = {}
+    for item_id, inputs in items.items():
+        previous = manifest.items.get(item_id, {}).get('inputs')
+        input_hash, digests = input_signature(inputs, previous, content)
+        signatures[item_id] = (input_hash, digests)
+        if force or not manifest.is_current(item_id, input_hash):
+            stale[item_id] = inputs
+    return items, stale, signatures
+
+
+def _record(manifest, results, signatures):
+    for item_id, result in results.items():
+        input_hash, digests = signatures[item_id]
+        manifest.items[item_id] = dict(result, input_hash=input_hash, inputs=digests)
+
+
+def _write_rows(module, config, manifest):
+    # step4's results hold the rows of every case, not only of the ones that ran now
+    if hasattr(module, 'write_rows'):
+        module.write_rows(config, [manifest.items[item_id]['row'] for item_id in sorted(manifest.items)])
+
+
+def merge_parts(manifest, parts_dir):
+    """Fold the part manifests written by sharded workers into manifest, save it and delete the parts."""
+    if not os.path.isdir(parts_dir):
+        return
+    part_paths = [os.path.join(parts_dir, name) for name in sorted(os.listdir(parts_dir)) if name.endswith('.json')]
+    for part_path in part_paths:
+        manifest.items.update(Manifest(part_path).items)
+    manifest.save()
+    for part_path in part_paths:
+        os.remove(part_path)
+
+
+def run_stage(stage, config, force=False, worker=None):
+    """Run the stale items of one stage and update its manifest. Returns (items run, items up to date).
+
+    With a worker name the stage is shared with other workers running the same command,
+    see run_stage_sharded.
+    """
+    module = _import_stage(stage)
+    if worker is not None:
+        return run_stage_sharded(stage, module, config, worker)
+
+    manifest = Manifest(os.path.join(config['manifest_dir'], f'{stage.name}.json'))
+    # Parts left behind by an interrupted sharded run
+    merge_parts(manifest, os.path.join(config['manifest_dir'], f'{stage.name}.parts'))
+
+    items, stale, signatures = _stale_items(module, config, manifest, force)
+    print(f"[{stage.name}] {len(stale)} of {len(items)} items to run")
+
+    if stale:
+        results = module.run_items(config, stale, stage_workers(config, stage.name))
+        for item_id in stale:
+            manifest.items.pop(item_id, None)
+        _record(manifest, results, signatures)
+        failed = len(stale) - len(results)
+        if failed:
+            print(f"[{stage.name}] {failed} items failed and will be retried on the next run")
+    manifest.save()
+    _write_rows(module, config, manifest)
+    return len(stale), len(items) - len(stale)
+
+
+def _shards(module, stale):
+    """{shard id: item ids} of the stale items, in the order of the items."""
+    shard_key = getattr(module, 'shard_key', None)
+    shards = {}
+    for item_id in stale:
+        shards.setdefault(shard_key(item_id) if shard_key else item_id, []).append(item_id)
+    return shards
+
+
+def run_stage_sharded(stage, module, config, worker):
+    """Run the stale items of one stage together with other workers on a shared filesystem.
+
+    Items are claimed in batches of config['shard_batch_size'] shards through lease files. A
+    shard is a single item, unless the stage module groups items that must run on the same
+    worker with a shard_key(item id) function (step4 writes one SEG file per series). Each batch
+    is recorded in its own part manifest, which is merged into the stage manifest at the end.
+    Returns once no other worker holds a lease on the stage anymore, so the next stage sees
+    all outputs of this one.
+    """
+    manifest_path = os.path.join(config['manifest_dir'], f'{stage.name}.json')
+    parts_dir = os.path.join(config['manifest_dir'], f'{stage.name}.parts')
+    os.makedirs(parts_dir, exist_ok=True)
+    leases = LeaseDir(os.path.join(config['manifest_dir'], f'{stage.name}.leases'), worker, config['lease_seconds'])
+
+    num_run = 0
+    with leases.heartbeat():
+        # Listing (e.g. step1's header index update) is done by one worker at a time
+        with leases.locked(MANIFEST_LOCK) as locked_at:
+            manifest = Manifest(manifest_path)
+            merge_parts(manifest, parts_dir)
+            items, stale, signatures = _stale_items(module, config, manifest, False)
+            shards = _shards(module, stale)
+            # Done markers of earlier runs would keep shards that are stale again from being claimed.
+            # Shards other workers finished after the parts were merged above keep theirs.
+            for shard_id in shards:
+                leases.clear_done(shard_id, before=locked_at)
+        print(f"[{stage.name}] {len(stale)} of {len(items)} items to run, shared by all workers")
+
+        # A shard is done for the input hashes of all of its items
+        candidates = {shard_id: hashlib.sha1(' '.join(signatures[item_id][0] for item_id in item_ids).encode()).hexdigest()
+                      for shard_id, item_ids in shards.items()}
+        batch_number = 0
+        while True:
+            claimed = claim_batch(leases, candidates, config['shard_batch_size'])
+            if not claimed:
+                # Wait for the other workers; leases of crashed workers expire and are claimed above
+                if leases.active_leases() == 0:
+                    break
+                time.sleep(min(30.0, leases.lease_seconds / 10))
+                continue
+
+            claimed_items = [item_id for shard_id in claimed for item_id in shards[shard_id]]
+            results = module.run_items(config, {item_id: stale[item_id] for item_id in claimed_items},
+                                       stage_workers(config, stage.name))
+            part = Manifest(os.path.join(parts_dir, f'{quote(worker, safe="")}.{batch_number}.json'))
+            _record(part, results, signatures)
+            part.save()
+            batch_number += 1
+            for shard_id in claimed:
+                # Failed items are left to the other workers, or to the next run
+                succeeded = all(item_id in results for item_id in shards[shard_id])
+                leases.release(shard_id, candidates[shard_id] if succeeded else None)
+                del candidates[shard_id]
+            num_run += len(claimed_items)
+            if len(claimed_items) > len(results):
+                print(f"[{stage.name}] {len(claimed_items) - len(results)} items failed")
+
+        with leases.locked(MANIFEST_LOCK):
+            manifest = Manifest(manifest_path)
+            merge_parts(manifest, parts_dir)
+            _write_rows(module, config, manifest)
+    return num_run, len(items) - len(stale)
+
+
+def run_pipeline(config, stage_names=None, force=False, worker=None):
+    """Run the selected stages (all by default) in dependency order, as one of several workers if worker is set."""
+    selected = [stage for stage in pipeline_stages(config) if stage_names is None or stage.name in stage_names]
+    selected_names = {stage.name for stage in selected}
+    done = set()
+    pending = list(selected)
+    running = {}
+    summary = {}
+    with ThreadPoolExecutor(max_workers=config['max_parallel_stages']) as executor:
+        while pending or running:
+            # Start every stage whose selected dependencies have finished
+            for stage in list(pending):
+                if all(dep in done or dep not in selected_names for dep in stage.depends_on):
+                    pending.remove(stage)
+                    running[executor.submit(run_stage, stage, config, force, worker)] = stage
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                summary[stage.name] = future.result()
+                done.add(stage.name)
+    for name, (num_run, num_current) in summary.items():
+        print(f"{name}: {num_run} items run, {num_current} up to date")
+    export_metrics(config['metrics_dir'], 'pipeline')
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the skeletal muscle segmentation pipeline incrementally")
+    parser.add_argument('config', nargs='?', help="JSON file overriding the settings in config.py")
+    parser.add_argument('--stages', nargs='+', choices=[stage.name for stage in STAGES],
+                        help="stages to run, all by default")
+    parser.add_argument('--force', action='store_true', help="run every item, not only the stale ones")
+    parser.add_argument('--worker', nargs='?', const=default_worker_name(),
+                        help="share the stages with other workers running the same command on the shared "
+                             "filesystem, under this name (<host>-<pid> by default)")
+    args = parser.parse_args(argv)
+    if args.force and args.worker:
+        parser.error("--force can not be combined with --worker")
+
+    run_pipeline(load_config(args.config), args.stages, args.force, args.worker)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
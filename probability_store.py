@@ -0,0 +1,133 @@
+# Compact storage of the ensemble's foreground probabilities.
+# Only the foreground channel is kept, quantized to uint8 (p * 255) or stored as float16, with one
+# uncompressed .npy file per image holding all ensemble members as an array (members, height, width).
+# Files are memory-mapped on read, so each member is a contiguous chunk that is read on its own.
+#
+# Running this module compares the quantized formats with the float32 .npz outputs of step3:
+#   python probability_store.py <folder with ensemble_* folders> [--limit N]
+import os
+import sys
+import json
+import argparse
+
+import numpy as np
+
+STORE_DTYPES = ('uint8', 'float16')
+MEMBERS_FILE = 'members.json'
+
+
+def quantize(probabilities, dtype='uint8'):
+    """Convert probabilities in [0, 1] to the storage dtype."""
+    probabilities = np.asarray(probabilities, dtype=np.float32)
+    if dtype == 'uint8':
+        return np.rint(np.clip(probabilities, 0, 1) * 255).astype(np.uint8)
+    if dtype == 'float16':
+        return probabilities.astype(np.float16)
+    raise ValueError(f"Unknown probability store dtype {dtype!r}, expected one of {STORE_DTYPES}")
+
+
+def dequantize(values):
+    """Convert stored values back to float32 probabilities."""
+    if values.dtype == np.uint8:
+        return values.astype(np.float32) * np.float32(1 / 255)
+    return values.astype(np.float32)
+
+
+class ProbabilityStore:
+    """Folder of <case_id>.npy files, each holding the foreground probabilities of every ensemble member."""
+
+    def __init__(self, root, members=None, dtype='uint8'):
+        if dtype not in STORE_DTYPES:
+            raise ValueError(f"Unknown probability store dtype {dtype!r}, expected one of {STORE_DTYPES}")
+        self.root = root
+        self.dtype = dtype
+        members_path = os.path.join(root, MEMBERS_FILE)
+        if members is None:
+            with open(members_path) as f:
+                members = json.load(f)["members"]
+        else:
+            os.makedirs(root, exist_ok=True)
+            with open(members_path, 'w') as f:
+                json.dump({"members": list(members)}, f)
+        self.members = list(members)
+
+    def path(self, case_id):
+        return os.path.join(self.root, case_id + '.npy')
+
+    def case_ids(self):
+        return sorted(fn[:-len('.npy')] for fn in os.listdir(self.root) if fn.endswith('.npy'))
+
+    def __contains__(self, case_id):
+        return os.path.exists(self.path(case_id))
+
+    def write(self, case_id, foregrounds):
+        """Store the foreground probabilities of all members of one image, in the order of self.members."""
+        if len(foregrounds) != len(self.members):
+            raise ValueError(f"Expected {len(self.members)} members for {case_id}, got {len(foregrounds)}")
+        values = np.stack([quantize(np.asarray(fg).squeeze(), self.dtype) for fg in foregrounds])
+        tmp_path = self.path(case_id) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, values)
+        os.replace(tmp_path, self.path(case_id))
+
+    def read(self, case_id):
+        """Memory map of the stored values of one image, shape (members, height, width)."""
+        return np.load(self.path(case_id), mmap_mode='r')
+
+    def iter_members(self, case_id):
+        """Yield the float32 probabilities of every member of one image, reading one member at a time."""
+        values = self.read(case_id)
+        for k in range(values.shape[0]):
+            yield dequantize(values[k])
+
+
+def ensemble_statistics(foregrounds):
+    """Ensemble mean and population variance of a stack of member probabilities."""
+    stack = np.asarray(foregrounds, dtype=np.float32)
+    return stack.mean(axis=0), stack.var(axis=0)
+
+
+def measure_drift(foregrounds, dtype='uint8'):
+    """Compare ensemble mean and variance after storing foregrounds in dtype with the float32 baseline."""
+    mean, variance = ensemble_statistics(foregrounds)
+    stored = [dequantize(quantize(fg, dtype)) for fg in foregrounds]
+    stored_mean, stored_variance = ensemble_statistics(stored)
+    return {
+        "mean_max_abs_error": float(np.max(np.abs(stored_mean - mean))),
+        "mean_mean_abs_error": float(np.mean(np.abs(stored_mean - mean))),
+        "variance_max_abs_error": float(np.max(np.abs(stored_variance - variance))),
+        "variance_mean_abs_error": float(np.mean(np.abs(stored_variance - variance))),
+        # Pixels whose segmentation (mean > 0.5) changes
+        "flipped_pixels": int(np.count_nonzero((stored_mean > 0.5) != (mean > 0.5))),
+        "bytes_per_member": int(np.asarray(quantize(foregrounds[0], dtype)).nbytes),
+        "float32_bytes_per_member": int(np.asarray(foregrounds[0], dtype=np.float32).nbytes),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the drift of quantized probability storage")
+    parser.add_argument('base_dir', help="folder with the ensemble_<model>_<fold> folders written by step3")
+    parser.add_argument('--limit', type=int, default=100, help="number of images to compare")
+    args = parser.parse_args(argv)
+
+    from aggregate import load_foreground
+
+    members = sorted(name for name in os.listdir(args.base_dir) if name.startswith('ensemble_'))
+    first_member_dir = os.path.join(args.base_dir, members[0])
+    file_names = sorted(fn for fn in os.listdir(first_member_dir) if fn.endswith('.npz'))[:args.limit]
+    for dtype in STORE_DTYPES:
+        worst = {}
+        flipped = 0
+        for file_name in file_names:
+            foregrounds = [load_foreground(os.path.join(args.base_dir, member, file_name))
+                           for member in members]
+            drift = measure_drift(foregrounds, dtype)
+            flipped += drift.pop("flipped_pixels")
+            for key, value in drift.items():
+                worst[key] = max(worst.get(key, 0), value)
+        print(f"{dtype}: {len(file_names)} images, {flipped} flipped pixels, worst case {worst}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,143 @@
+# SQLite store of the step4 results.
+# One row per slice, keyed by subject, series, group and slice number (parsed from the case id),
+# so re-runs update the rows of their slices and keep everything else. Rows are buffered and
+# written in batches. Queries take a SQL WHERE clause, which SQLite evaluates on the indexed
+# table instead of the caller filtering a CSV. The CSV file can still be exported from the store.
+#
+#   python results_store.py results.sqlite --where "sm_area > ? AND study_description LIKE ?" \
+#       --params 5000 "%ABDOMEN%" [--csv selection.csv]
+import os
+import sys
+import csv
+import sqlite3
+import argparse
+
+from identifiers import parse_case_id
+
+# Columns of a result row as written by step4, with their SQLite types
+RESULT_FIELDS = [
+    ('dicom_file_path', 'TEXT'),
+    ('filename', 'TEXT'),
+    ('uncertain_pixel_count', 'INTEGER'),
+    ('mean_variance', 'REAL'),
+    ('median_variance', 'REAL'),
+    ('mean_variance_percent', 'REAL'),
+    ('median_variance_percent', 'REAL'),
+    ('sm_pixels', 'INTEGER'),
+    ('sm_area', 'REAL'),
+    ('sm_volume', 'REAL'),
+    ('sm_hu', 'REAL'),
+    ('study_description', 'TEXT'),
+    ('series_description', 'TEXT'),
+]
+KEY_FIELDS = [('subject', 'TEXT'), ('series', 'TEXT'), ('group_number', 'INTEGER'), ('slice', 'INTEGER')]
+
+
+def _plain(value):
+    """numpy scalars to python values sqlite3 can bind."""
+    return value.item() if hasattr(value, 'item') else value
+
+
+class ResultsStore:
+    """Table of step4 results with buffered, batched upserts."""
+
+    def __init__(self, db_path, batch_size=100):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self._buffer = []
+        directory = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(db_path)
+        columns = ', '.join(f'{name} {kind}' for name, kind in KEY_FIELDS + RESULT_FIELDS)
+        keys = ', '.join(name for name, _ in KEY_FIELDS)
+        self.connection.execute(f"CREATE TABLE IF NOT EXISTS results ({columns}, PRIMARY KEY ({keys}))")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS results_series ON results (series, slice)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS results_study ON results (study_description)")
+        self.connection.commit()
+
+        names = [name for name, _ in KEY_FIELDS + RESULT_FIELDS]
+        updates = ', '.join(f'{name} = excluded.{name}' for name, _ in RESULT_FIELDS)
+        self._upsert = (f"INSERT INTO results ({', '.join(names)}) VALUES ({', '.join('?' * len(names))}) "
+                        f"ON CONFLICT ({keys}) DO UPDATE SET {updates}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, row):
+        """Queue a result row (a dict with the RESULT_FIELDS). Rows of a slice already stored replace it."""
+        slice_id = parse_case_id(row['filename'])
+        self._buffer.append((slice_id.subject, slice_id.series, slice_id.group, slice_id.slice)
+                            + tuple(_plain(row.get(name)) for name, _ in RESULT_FIELDS))
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+
+    def add_rows(self, rows):
+        for row in rows:
+            self.add(row)
+
+    def flush(self):
+        """Write the queued rows in one transaction."""
+        if self._buffer:
+            with self.connection:
+                self.connection.executemany(self._upsert, self._buffer)
+            self._buffer = []
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    def query(self, where=None, params=(), columns=None, order_by='subject, series, group_number, slice'):
+        """Yield the matching rows as dicts. where is a SQL condition with ? placeholders for params."""
+        self.flush()
+        columns = columns or [name for name, _ in RESULT_FIELDS]
+        sql = f"SELECT {', '.join(columns)} FROM results"
+        if where:
+            sql += f" WHERE {where}"
+        if order_by:
+            sql += f" ORDER BY {order_by}"
+        for values in self.connection.execute(sql, params):
+            yield dict(zip(columns, values))
+
+    def count(self, where=None, params=()):
+        self.flush()
+        sql = "SELECT COUNT(*) FROM results" + (f" WHERE {where}" if where else "")
+        return self.connection.execute(sql, params).fetchone()[0]
+
+    def export_csv(self, csv_path, where=None, params=()):
+        """Write the matching rows to a CSV file with the step4 columns. Returns the number of rows."""
+        os.makedirs(os.path.dirname(os.path.abspath(csv_path)), exist_ok=True)
+        count = 0
+        tmp_path = csv_path + '.tmp'
+        with open(tmp_path, 'w', newline='') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=[name for name, _ in RESULT_FIELDS])
+            writer.writeheader()
+            for row in self.query(where, params):
+                writer.writerow(row)
+                count += 1
+        os.replace(tmp_path, csv_path)
+        return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Query the step4 results store")
+    parser.add_argument('db_path', help="results database written by step4")
+    parser.add_argument('--where', help="SQL condition, e.g. \"sm_area > ?\"")
+    parser.add_argument('--params', nargs='*', default=[], help="values for the ? placeholders of --where")
+    parser.add_argument('--csv', help="write the matching rows to this CSV file instead of printing them")
+    args = parser.parse_args(argv)
+
+    with ResultsStore(args.db_path) as store:
+        if args.csv:
+            print(f"{store.export_csv(args.csv, args.where, args.params)} rows written to {args.csv}")
+            return 0
+        writer = csv.DictWriter(sys.stdout, fieldnames=[name for name, _ in RESULT_FIELDS])
+        writer.writeheader()
+        writer.writerows(store.query(args.where, args.params))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,225 @@
+# Resumable job scheduler for the TotalSegmentator stage.
+# Jobs live in a SQLite queue, so an interrupted run picks up where it stopped. Every slot
+# (a GPU index or 'cpu') runs one job at a time; outputs that already exist and are valid are
+# skipped, failures are retried with exponential backoff and every job gets its own log file.
+# A job remembers the fingerprint of its input folder's manifest: when the input changes, or the
+# output of a finished job disappears, adding the job again queues it again.
+import os
+import json
+import time
+import sqlite3
+import threading
+import subprocess
+
+import nibabel as nib
+import numpy as np
+
+from materialize import group_input_folder, read_group_manifest
+from instrumentation import metrics
+
+# {input}, {output} and {device} are filled in per job. Any other command line with the same
+# placeholders can be used, e.g. the fake_segmenter.py script for testing without a GPU.
+TOTALSEGMENTATOR_COMMAND = ["TotalSegmentator", "-i", "{input}", "-o", "{output}", "--ml", "-d", "{device}"]
+
+
+def nifti_output_valid(output_path):
+    """Check that a NIfTI output exists, has a readable 3D header and is not truncated."""
+    if not os.path.isfile(output_path):
+        return False
+    try:
+        header = nib.load(output_path).header
+    except Exception:
+        return False
+    shape = header.get_data_shape()
+    if len(shape) != 3:
+        return False
+    if output_path.endswith('.nii'):
+        expected_size = int(header['vox_offset']) + int(np.prod(shape)) * header.get_data_dtype().itemsize
+        return os.path.getsize(output_path) >= expected_size
+    return True
+
+
+class SegmentationScheduler:
+    """Persistent queue of segmentation jobs executed by one worker per slot."""
+
+    def __init__(self, queue_path, slots=('0',), command=TOTALSEGMENTATOR_COMMAND, log_dir=None,
+                 max_attempts=3, backoff=30.0, validate=nifti_output_valid):
+        self.queue_path = queue_path
+        self.slots = list(slots)
+        self.command = list(command)
+        self.log_dir = log_dir or os.path.join(os.path.dirname(os.path.abspath(queue_path)), 'segmentation_logs')
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.validate = validate
+        os.makedirs(self.log_dir, exist_ok=True)
+
+        connection = self._connect()
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "job_id TEXT PRIMARY KEY, input_dir TEXT NOT NULL, output_path TEXT NOT NULL, "
+            "status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, not_before REAL NOT NULL DEFAULT 0, "
+            "last_error TEXT, fingerprint TEXT)"
+        )
+        connection.commit()
+        connection.close()
+
+    def _connect(self):
+        # Every worker thread uses its own connection; the timeout covers concurrent writers
+        return sqlite3.connect(self.queue_path, timeout=60, isolation_level=None)
+
+    def add_job(self, job_id, input_dir, output_path):
+        """Queue a job. Jobs that are already queued keep their state unless they are stale.
+
+        A job is stale when its input folder, output path or the fingerprint of the input's
+        manifest changed (its old output is removed then), or when it is done but its output
+        is missing or invalid.
+        """
+        manifest = read_group_manifest(input_dir)
+        fingerprint = manifest.get("fingerprint") if manifest is not None else None
+        connection = self._connect()
+        row = connection.execute("SELECT input_dir, output_path, fingerprint, status FROM jobs WHERE job_id = ?",
+                                 (job_id,)).fetchone()
+        if row is None or row[:2] != (input_dir, output_path) or row[2] != fingerprint:
+            if row is not None and os.path.exists(output_path):
+                # Segmented from other inputs
+                os.remove(output_path)
+            connection.execute("INSERT OR REPLACE INTO jobs (job_id, input_dir, output_path, status, fingerprint) "
+                               "VALUES (?, ?, ?, 'pending', ?)", (job_id, input_dir, output_path, fingerprint))
+        elif row[3] == 'done' and not self.validate(output_path):
+            connection.execute("UPDATE jobs SET status = 'pending', attempts = 0, not_before = 0, fingerprint = ? "
+                               "WHERE job_id = ?", (fingerprint, job_id))
+        else:
+            connection.execute("UPDATE jobs SET fingerprint = ? WHERE job_id = ?", (fingerprint, job_id))
+        connection.close()
+
+    def reset_job(self, job_id):
+        """Queue a job again, e.g. after its output was removed. Jobs that were never queued are left alone."""
+        connection = self._connect()
+        connection.execute("UPDATE jobs SET status = 'pending', attempts = 0, not_before = 0 WHERE job_id = ?", (job_id,))
+        connection.close()
+
+    def retry_failed(self):
+        """Put every job that ran out of attempts back into the queue."""
+        connection = self._connect()
+        connection.execute("UPDATE jobs SET status = 'pending', attempts = 0, not_before = 0 WHERE status = 'failed'")
+        connection.close()
+
+    def status(self):
+        """Number of jobs per status."""
+        connection = self._connect()
+        counts = dict(connection.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        connection.close()
+        return counts
+
+    def _claim(self, connection, job_filter):
+        """Atomically move the next runnable job to 'running'. Returns the job, or the wait time if none is ready."""
+        condition, params = job_filter
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                "SELECT job_id, input_dir, output_path, attempts FROM jobs "
+                f"WHERE status = 'pending' AND not_before <= ? {condition} ORDER BY not_before, job_id LIMIT 1",
+                (time.time(),) + params).fetchone()
+            if row is not None:
+                connection.execute("UPDATE jobs SET status = 'running' WHERE job_id = ?", (row[0],))
+                return row, None
+            waiting = connection.execute(
+                f"SELECT MIN(not_before) FROM jobs WHERE status = 'pending' {condition}", params).fetchone()[0]
+            return None, None if waiting is None else max(0.0, waiting - time.time())
+        finally:
+            connection.execute("COMMIT")
+
+    def _finish(self, connection, job_id, attempts, error):
+        if error is None:
+            connection.execute("UPDATE jobs SET status = 'done', last_error = NULL WHERE job_id = ?", (job_id,))
+        elif attempts < self.max_attempts:
+            not_before = time.time() + self.backoff * 2 ** (attempts - 1)
+            connection.execute("UPDATE jobs SET status = 'pending', attempts = ?, not_before = ?, last_error = ? "
+                               "WHERE job_id = ?", (attempts, not_before, error, job_id))
+        else:
+            connection.execute("UPDATE jobs SET status = 'failed', attempts = ?, last_error = ? WHERE job_id = ?",
+                               (attempts, error, job_id))
+
+    def _run_job(self, slot, job_id, input_dir, output_path):
+        """Run one job on a slot. Returns None on success, otherwise an error message."""
+        env = os.environ.copy()
+        if slot == 'cpu':
+            env['CUDA_VISIBLE_DEVICES'] = ''
+            device = 'cpu'
+        else:
+            env['CUDA_VISIBLE_DEVICES'] = str(slot)
+            device = 'gpu'
+
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        log_path = os.path.join(self.log_dir, job_id + '.log')
+        with open(log_path, 'a') as log, group_input_folder(input_dir) as input_folder:
+            command = [part.format(input=input_folder, output=output_path, device=device) for part in self.command]
+            log.write(f"# {time.strftime('%Y-%m-%d %H:%M:%S')} slot {slot}: {subprocess.list2cmdline(command)}\n")
+            log.flush()
+            try:
+                returncode = subprocess.call(command, stdout=log, stderr=subprocess.STDOUT, env=env)
+            except OSError as e:
+                return f"could not start segmenter: {e}"
+        if returncode != 0:
+            return f"segmenter exited with code {returncode}, see {log_path}"
+        if not self.validate(output_path):
+            return f"segmenter finished but {output_path} is missing or invalid, see {log_path}"
+        return None
+
+    def _worker(self, slot, summary, lock, job_filter):
+        connection = self._connect()
+        while True:
+            job, wait = self._claim(connection, job_filter)
+            if job is None:
+                if wait is None:
+                    break
+                # Only jobs waiting for their retry backoff are left
+                time.sleep(min(wait, 5.0))
+                continue
+
+            job_id, input_dir, output_path, attempts = job
+            if self.validate(output_path):
+                self._finish(connection, job_id, attempts, None)
+                outcome = 'skipped'
+            else:
+                print(f"[slot {slot}] segmenting {job_id} (attempt {attempts + 1})")
+                with metrics.timed('segmentation') as measurement:
+                    try:
+                        error = self._run_job(slot, job_id, input_dir, output_path)
+                    except Exception as e:
+                        # A broken job must not take its worker down with it
+                        error = f"{type(e).__name__}: {e}"
+                    if error is None:
+                        measurement.bytes_written = os.path.getsize(output_path)
+                self._finish(connection, job_id, attempts + 1, error)
+                outcome = 'done' if error is None else 'error'
+                if error is not None:
+                    print(f"[slot {slot}] {job_id} failed: {error}")
+            with lock:
+                summary[outcome] = summary.get(outcome, 0) + 1
+        connection.close()
+
+    def run(self, job_ids=None):
+        """Run all queued jobs, or only job_ids, to completion and return counts of what happened.
+
+        Restricting a run to job_ids lets several processes share one queue, each running its own jobs.
+        """
+        if job_ids is None:
+            job_filter = ("", ())
+        else:
+            job_filter = ("AND job_id IN (SELECT value FROM json_each(?))", (json.dumps(list(job_ids)),))
+        # Jobs left 'running' by an interrupted run are started again
+        connection = self._connect()
+        connection.execute(f"UPDATE jobs SET status = 'pending' WHERE status = 'running' {job_filter[0]}",
+                           job_filter[1])
+        connection.close()
+
+        summary = {}
+        lock = threading.Lock()
+        threads = [threading.Thread(target=self._worker, args=(slot, summary, lock, job_filter), name=f"slot-{slot}")
+                   for slot in self.slots]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return summary
@@ -0,0 +1,132 @@
+# Slice ordering of a DICOM series folder.
+# The order is computed once from the headers only (no pixel data) and stored in a small
+# sidecar file next to the series, or in a shared cache directory. The sidecar is reused as
+# long as the set of files in the folder (names, sizes and mtimes) does not change.
+import os
+import json
+import hashlib
+
+import pydicom
+
+from materialize import group_source_files
+
+SERIES_ORDER_FILE = '.series_order.json'
+ORDER_TAGS = ["InstanceNumber", "ImagePositionPatient", "SOPInstanceUID"]
+
+# In-process memo: folder -> SeriesOrder
+_series_orders = {}
+
+
+class SeriesOrder:
+    """Files of a series sorted by InstanceNumber, with their positions and SOPInstanceUIDs."""
+
+    def __init__(self, folder, files, instance_numbers, positions, sop_instance_uids):
+        self.folder = folder
+        self.files = files
+        self.instance_numbers = instance_numbers
+        self.positions = positions
+        self.sop_instance_uids = sop_instance_uids
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getitem__(self, k):
+        """Full path of slice k of the series."""
+        return self.files[k]
+
+    def to_dict(self):
+        return {
+            # Files of manifest-only groups live elsewhere and are stored with their full path
+            "files": [os.path.basename(path) if os.path.dirname(path) == self.folder else path
+                      for path in self.files],
+            "instance_numbers": self.instance_numbers,
+            "positions": self.positions,
+            "sop_instance_uids": self.sop_instance_uids,
+        }
+
+
+def list_series_files(folder):
+    """Full paths of the DICOM files of a series folder, in directory listing order."""
+    return group_source_files(folder)
+
+
+def _signature(files):
+    digest = hashlib.sha1()
+    for path in files:
+        stat = os.stat(path)
+        digest.update(f"{os.path.basename(path)}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+def _cache_path(folder, cache_dir):
+    if cache_dir is None:
+        return os.path.join(folder, SERIES_ORDER_FILE)
+    key = hashlib.sha1(os.path.abspath(folder).encode()).hexdigest()
+    return os.path.join(cache_dir, key + '.json')
+
+
+def _read_order(folder, files):
+    entries = []
+    for path in files:
+        ds = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=ORDER_TAGS)
+        instance_number = getattr(ds, "InstanceNumber", None)
+        position = getattr(ds, "ImagePositionPatient", None)
+        entries.append((
+            # Files without an InstanceNumber go last, in name order
+            (instance_number is None, int(instance_number or 0), os.path.basename(path)),
+            path,
+            None if instance_number is None else int(instance_number),
+            None if position is None else [float(v) for v in position],
+            str(getattr(ds, "SOPInstanceUID", "")) or None,
+        ))
+    entries.sort(key=lambda entry: entry[0])
+    return SeriesOrder(folder,
+                       [entry[1] for entry in entries],
+                       [entry[2] for entry in entries],
+                       [entry[3] for entry in entries],
+                       [entry[4] for entry in entries])
+
+
+def get_series_order(folder, cache_dir=None):
+    """Return the SeriesOrder of a series folder, reading headers only if the cached order is stale."""
+    folder = os.path.normpath(folder)
+    if folder in _series_orders:
+        return _series_orders[folder]
+
+    files = list_series_files(folder)
+    signature = _signature(files)
+    cache_path = _cache_path(folder, cache_dir)
+
+    order = None
+    try:
+        with open(cache_path) as f:
+            cached = json.load(f)
+        if cached.get("signature") == signature:
+            order = SeriesOrder(folder,
+                                [os.path.join(folder, name) for name in cached["files"]],
+                                cached["instance_numbers"],
+                                cached["positions"],
+                                cached["sop_instance_uids"])
+    except (OSError, ValueError, KeyError):
+        pass
+
+    if order is None:
+        order = _read_order(folder, files)
+        try:
+            if cache_dir is not None:
+                os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = cache_path + f'.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(dict(order.to_dict(), signature=signature), f)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            # A read-only series folder only costs us the on-disk cache
+            print(f"Could not write series order cache {cache_path}: {e}")
+
+    _series_orders[folder] = order
+    return order
+
+
+def get_series_slice(folder, k, cache_dir=None):
+    """Full path of slice k (in InstanceNumber order) of the series in folder."""
+    return get_series_order(folder, cache_dir)[k]
@@ -0,0 +1,166 @@
+# Lease files for splitting a stage over several workers on a shared filesystem.
+# A worker owns an item while its lease file exists; leases are created with O_CREAT | O_EXCL, so
+# exactly one worker gets each item. Leases are renewed by a heartbeat thread (their mtime is the
+# last renewal), and a lease that was not renewed for lease_seconds belongs to a crashed worker and
+# may be taken over. A finished item leaves a done marker holding the hash of its inputs, so no
+# other worker picks it up again in the same run. Markers of items that are stale again when a
+# stage is listed (e.g. their outputs were deleted) are cleared, so they can be claimed again, but
+# only markers older than the listing: an item another worker finished while this one was listing
+# looks stale only because its part manifest was not merged yet.
+#
+# Taking over an expired lease is not strictly atomic: two workers may both process an item whose
+# owner died. That only costs time, as every stage writes its outputs atomically. The nodes'
+# clocks must agree to well within lease_seconds.
+import os
+import time
+import socket
+import threading
+import contextlib
+from urllib.parse import quote
+
+LEASE_SUFFIX = '.lease'
+DONE_SUFFIX = '.done'
+
+
+def default_worker_name():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class LeaseDir:
+    """Lease and done marker files of the items of one stage."""
+
+    def __init__(self, directory, owner, lease_seconds=600):
+        self.directory = directory
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self._held = set()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, item_id, suffix):
+        return os.path.join(self.directory, quote(item_id, safe='') + suffix)
+
+    def is_done(self, item_id, input_hash):
+        try:
+            with open(self._path(item_id, DONE_SUFFIX)) as f:
+                return f.read() == input_hash
+        except OSError:
+            return False
+
+    def clear_done(self, item_id, before):
+        """Forget that an item was done, so it can be claimed again, if it was marked before the mtime before (ns)."""
+        path = self._path(item_id, DONE_SUFFIX)
+        with contextlib.suppress(FileNotFoundError):
+            if os.stat(path).st_mtime_ns < before:
+                os.remove(path)
+
+    def _create(self, path):
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.owner)
+        return True
+
+    def _expired(self, path):
+        try:
+            return time.time() - os.stat(path).st_mtime > self.lease_seconds
+        except FileNotFoundError:
+            return True
+
+    def _take_over(self, path):
+        """Move an expired lease out of the way. Returns False if it turned out to be alive."""
+        tombstone = f"{path}.expired.{quote(self.owner, safe='')}"
+        try:
+            os.rename(path, tombstone)
+        except FileNotFoundError:
+            return True
+        if not self._expired(tombstone):
+            # Someone else took it over and renewed it in the meantime, put it back
+            with contextlib.suppress(OSError):
+                os.link(tombstone, path)
+            os.remove(tombstone)
+            return False
+        os.remove(tombstone)
+        return True
+
+    def claim(self, item_id, input_hash=None):
+        """Try to take the lease of an item. False if it is done or another live worker holds it."""
+        if input_hash is not None and self.is_done(item_id, input_hash):
+            return False
+        path = self._path(item_id, LEASE_SUFFIX)
+        if not self._create(path):
+            if not self._expired(path) or not self._take_over(path) or not self._create(path):
+                return False
+            print(f"[{self.owner}] took over the expired lease of {item_id}")
+        with self._lock:
+            self._held.add(item_id)
+        return True
+
+    def release(self, item_id, input_hash=None):
+        """Give up the lease of an item, marking it done for input_hash if given."""
+        if input_hash is not None:
+            done_path = self._path(item_id, DONE_SUFFIX)
+            with open(done_path + '.tmp', 'w') as f:
+                f.write(input_hash)
+            os.replace(done_path + '.tmp', done_path)
+        with self._lock:
+            self._held.discard(item_id)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self._path(item_id, LEASE_SUFFIX))
+
+    def renew(self):
+        """Touch the leases this worker holds."""
+        with self._lock:
+            held = list(self._held)
+        for item_id in held:
+            with contextlib.suppress(FileNotFoundError):
+                os.utime(self._path(item_id, LEASE_SUFFIX))
+
+    def active_leases(self):
+        """Number of lease files that are not expired, this worker's included."""
+        paths = [entry.path for entry in os.scandir(self.directory) if entry.name.endswith(LEASE_SUFFIX)]
+        return sum(not self._expired(path) for path in paths)
+
+    @contextlib.contextmanager
+    def locked(self, name, poll=1.0):
+        """Hold the lease name as a lock, waiting for it if another worker holds it.
+
+        Yields the mtime (ns) of the lease file when the lock was taken, a timestamp of the shared
+        filesystem's clock that file mtimes can be compared with.
+        """
+        while not self.claim(name):
+            time.sleep(poll)
+        try:
+            yield os.stat(self._path(name, LEASE_SUFFIX)).st_mtime_ns
+        finally:
+            self.release(name)
+
+    @contextlib.contextmanager
+    def heartbeat(self):
+        """Renew the held leases in the background while the block runs."""
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(self.lease_seconds / 3):
+                self.renew()
+
+        thread = threading.Thread(target=beat, name='lease-heartbeat', daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+
+def claim_batch(leases, candidates, batch_size):
+    """Claim up to batch_size items of candidates, {item id: input hash}. Returns the claimed ids."""
+    claimed = []
+    for item_id, input_hash in candidates.items():
+        if leases.claim(item_id, input_hash):
+            claimed.append(item_id)
+            if len(claimed) >= batch_size:
+                break
+    return claimed
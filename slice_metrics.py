@@ -0,0 +1,112 @@
+# Batched per-slice metrics of step4.
+# The ensemble mean and variance maps of many slices are stacked into (slices, rows, columns)
+# arrays and every statistic is computed for all of them at once instead of slice by slice:
+# one pass over the stack selects the uncertain pixels, and their per-slice count, sum, minimum
+# and maximum are segment reductions (np.ufunc.reduceat) over the compressed values. Only the
+# medians partition each slice's values on their own, which is linear in their number.
+#
+# Degenerate slices do not raise or warn: statistics of an empty set (no uncertain pixels, no
+# muscle) are NaN, which the results store keeps as NULL, and normalizing values that are all
+# equal gives 0 instead of dividing by zero.
+import numpy as np
+
+
+def _scale(low, high, top):
+    """Factor mapping [low, high] to [0, top], 0 where high == low."""
+    span = high - low
+    scale = np.zeros_like(span)
+    np.divide(top, span, out=scale, where=span > 0)
+    return scale
+
+
+def normalize_images(images, top=255):
+    """Scale every image of a stack from its own [min, max] to [0, top], truncated to uint8.
+
+    Constant images become 0. The arithmetic is done in the dtype of images, the same way
+    step4 always computed it per slice.
+    """
+    flat = images.reshape(len(images), -1)
+    low = flat.min(axis=1)
+    scale = _scale(low, flat.max(axis=1), top)
+    return ((flat - low[:, None]) * scale[:, None]).astype(np.uint8).reshape(images.shape)
+
+
+def uncertainty_metrics(variances, threshold):
+    """Statistics of the pixels whose ensemble variance is above threshold, for a stack of variance maps.
+
+    Percentages are the variances of those pixels scaled to 0-100 within each slice and
+    truncated to integers. Returns {result field: array with one value per slice}.
+    """
+    num_slices = len(variances)
+    flat = variances.reshape(num_slices, -1)
+    mask = (flat > threshold) & (flat != 0)
+    counts = np.count_nonzero(mask, axis=1)
+    # The uncertain pixels of all slices, slice after slice
+    values = flat[mask]
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    found = counts > 0
+
+    low = np.zeros(num_slices, dtype=values.dtype)
+    high = np.zeros(num_slices, dtype=values.dtype)
+    total = np.zeros(num_slices)
+    # The segments of the slices with uncertain pixels follow each other without gaps, so each
+    # one runs from its start to the start of the next (reduceat cannot express empty segments)
+    segment_starts = starts[found]
+    if len(values):
+        low[found] = np.minimum.reduceat(values, segment_starts)
+        high[found] = np.maximum.reduceat(values, segment_starts)
+        total[found] = np.add.reduceat(values, segment_starts, dtype=np.float64)
+    scale = _scale(low, high, 100)
+    percent = ((values - np.repeat(low, counts)) * np.repeat(scale, counts)).astype(np.uint8)
+    percent_total = np.zeros(num_slices)
+    if len(values):
+        percent_total[found] = np.add.reduceat(percent, segment_starts, dtype=np.int64)
+
+    # The two middle values of every slice; the percentages are a non-decreasing function of
+    # the variances, so their middle values are the percentages of these
+    middle = np.zeros((num_slices, 2), dtype=values.dtype)
+    for k in np.flatnonzero(found):
+        segment = values[starts[k]:ends[k]]
+        kth = [(counts[k] - 1) // 2, counts[k] // 2]
+        middle[k] = np.partition(segment, kth)[kth]
+    middle_percent = ((middle - low[:, None]) * scale[:, None]).astype(np.uint8)
+
+    nan = np.full(num_slices, np.nan)
+    return {
+        'uncertain_pixel_count': counts,
+        'mean_variance': np.divide(total, counts, out=nan.copy(), where=found),
+        'median_variance': np.where(found, middle.mean(axis=1), np.nan),
+        'mean_variance_percent': np.divide(percent_total, counts, out=nan.copy(), where=found),
+        'median_variance_percent': np.where(found, middle_percent.mean(axis=1), np.nan),
+    }
+
+
+def muscle_metrics(masks, hu_images, pixel_spacings, slice_thicknesses):
+    """Size and mean HU of the predicted muscle of a stack of slices.
+
+    pixel_spacings is (slices, 2) in mm and slice_thicknesses (slices,) in mm.
+    Returns {result field: array with one value per slice}.
+    """
+    pixel_spacings = np.asarray(pixel_spacings, dtype=np.float64)
+    pixels = np.count_nonzero(masks, axis=(1, 2))
+    area = pixels * pixel_spacings[:, 0] * pixel_spacings[:, 1]
+    hu_total = np.where(masks, hu_images, 0).sum(axis=(1, 2), dtype=np.int64)
+    return {
+        'sm_pixels': pixels,
+        'sm_area': area,
+        'sm_volume': area * np.asarray(slice_thicknesses, dtype=np.float64),
+        'sm_hu': np.divide(hu_total, pixels, out=np.full(len(pixels), np.nan), where=pixels > 0),
+    }
+
+
+def batch_metrics(means, variances, hu_images, pixel_spacings, slice_thicknesses, threshold):
+    """All step4 metrics of a stack of equally sized slices.
+
+    means and variances are the ensemble maps (slices, rows, columns), hu_images the slices in HU.
+    Returns (muscle masks, variance maps scaled to uint8 0-255, {result field: per-slice values}).
+    """
+    masks = means > 0.5
+    columns = uncertainty_metrics(variances, threshold)
+    columns.update(muscle_metrics(masks, hu_images, pixel_spacings, slice_thicknesses))
+    return masks, normalize_images(variances), columns
@@ -1,73 +1,187 @@
-# STEP 1: Reads dicom folders and identifies axial series and groups the files based on their attributes. 
+# STEP 1: Reads dicom folders and identifies axial series and groups the files based on their attributes.
 # Created new folders for each axial series group.
 # Passes the grouped dicom files to the Total Segmentator to get nifti files with all organs identified.
 # Nifti files are saved in the specified output folder.
+# With lumbar_slab set, a localizer pass finds L3 first and only the slices around it are segmented.
+# Groups with the same SOPInstanceUIDs as another group are segmented once (see dedup.py).
+# Usage: python step1.py [config.json]
 import os
-import pydicom
-import csv
-import pandas as pd
-import subprocess
-import tempfile
-import shutil
+import sys
 from collections import defaultdict
 from utils import *
+from config import load_config
+from dicom_index import DicomIndex
+from materialize import materialize_group
+from scheduler import SegmentationScheduler, TOTALSEGMENTATOR_COMMAND, nifti_output_valid
+from identifiers import GroupId, group_name, parse_group_name, nifti_name
+from instrumentation import export_metrics
+from lumbar_slab import prepare_slabs, read_slab, remove_output, slab_sidecar_path
+from dedup import find_duplicates, read_duplicates, write_duplicates, aliases_of, link_alias
 
-# Specify the directory containing the CT scans
-directory = '/share/dept_machinelearning/Faculty/Rasool, Ghulam/Shared Resources/Pancreatic Cancer Image Data/10R23000239/SUBJECTS'
-output_directory = '/share/dept_machinelearning/Faculty/Rasool, Ghulam/Shared Resources/Pancreatic Cancer Image Data/result_files/axial_series_groups_all folders'
+# The pipeline compares the source DICOM files of a group by size and mtime, like materialize_group
+# and the DICOM index do, instead of reading the whole archive again to hash it
+HASH_INPUTS = False
 
-# Iterate over all folders in the directory
-for dir in os.listdir(directory):
-    # Construct the full path of the folder
-    folder_path = os.path.join(directory, dir)
 
-    # Iterate over all subfolders
-    for root, dirs, files in os.walk(folder_path):
-        for sub_dir in dirs:
-            # Construct the full path of the subfolder
-            sub_folder_path = os.path.join(root, sub_dir)
+def collect_groups(config):
+    """Return {group name: (GroupId, DICOM paths sorted by z, their SOPInstanceUIDs)} for every axial group below subjects_dir."""
+    directory = config['subjects_dir']
+    collected = {}
+    # Series folders per (subject, series folder name), which is all a group name is made of
+    series_folders = defaultdict(set)
+    # Persistent DICOM header index, re-runs only parse new or changed files
+    with DicomIndex(config['index_path']) as index:
+        # Parse all new or changed headers of the cohort in one process pool
+        num_parsed, num_removed = index.update(directory)
+        print(f"parsed {num_parsed} DICOM headers, removed {num_removed} stale index entries")
 
-            # Count the number of DICOM files in the subfolder
-            num_dicom_files = sum([1 for file in os.listdir(sub_folder_path) if file.endswith('.dcm')])
-
-            # Only process the subfolder if it contains more than 8 DICOM files
-            if num_dicom_files <= 8:
+        # Iterate over all folders in the directory
+        for dir in sorted(os.listdir(directory)):
+            # Construct the full path of the folder
+            folder_path = os.path.join(directory, dir)
+            if not os.path.isdir(folder_path):
                 continue
 
-            # Group the DICOM files in the subfolder
-            groups = group_dicom_files(sub_folder_path)
+            # Iterate over all subfolders
+            for root, dirs, files in os.walk(folder_path):
+                for sub_dir in dirs:
+                    # Construct the full path of the subfolder
+                    sub_folder_path = os.path.join(root, sub_dir)
+
+                    # Count the number of DICOM files in the subfolder
+                    num_dicom_files = sum([1 for file in os.listdir(sub_folder_path) if file.endswith('.dcm')])
+
+                    # Only process the subfolder if it contains more than min_dicom_files DICOM files
+                    if num_dicom_files <= config['min_dicom_files']:
+                        continue
+
+                    # Group the DICOM files in the subfolder
+                    groups = group_dicom_files(sub_folder_path, index=index)
+
+                    for i, group in enumerate(groups.values()):
+                        # Identify the group by subject, series folder and group index, e.g. SUBJ__3__group1
+                        split_path = sub_folder_path.split(os.sep)
+                        group_id = GroupId(split_path[-5], split_path[-1], i + 1)
+                        try:
+                            name = group_name(group_id)
+                        except ValueError as e:
+                            # Folder names that can not be part of an identifier, e.g. with a '__'
+                            print(f"skipping {sub_folder_path}: {e}")
+                            break
+                        dicom_paths = [dicom_path for _, dicom_path in group]
+                        sop_instance_uids = [(index.lookup(dicom_path) or {}).get("SOPInstanceUID")
+                                             for dicom_path in dicom_paths]
+                        collected[name] = (group_id, dicom_paths, sop_instance_uids)
+                        series_folders[group_id.subject, group_id.series].add(sub_folder_path)
+
+    # Folders that would get the same group names, e.g. series folders of the same name in two
+    # studies of a subject, are reported and skipped rather than overwriting each other
+    for (subject, series), folders in series_folders.items():
+        if len(folders) > 1:
+            print(f"Ambiguous series {series} of subject {subject}, skipping: {sorted(folders)}")
+            for name, (group_id, _, _) in list(collected.items()):
+                if (group_id.subject, group_id.series) == (subject, series):
+                    del collected[name]
+    return collected
+
+
+def make_scheduler(config):
+    """Persistent TotalSegmentator job queue. One worker runs per slot: a GPU index or 'cpu'."""
+    return SegmentationScheduler(config['queue_path'],
+                                 slots=config['segmentation_slots'],
+                                 command=config['segmenter_command'] or TOTALSEGMENTATOR_COMMAND,
+                                 max_attempts=config['segmentation_max_attempts'],
+                                 backoff=config['segmentation_backoff'])
+
+
+def link_aliases(config, nifti_path, aliases):
+    """Point the NIfTI outputs (and slab sidecars) of the alias groups at nifti_path. Returns the links."""
+    links = []
+    for alias in aliases:
+        alias_path = os.path.join(config['nifti_dir'], nifti_name(parse_group_name(alias)))
+        link_alias(nifti_path, alias_path)
+        links.append(alias_path)
+        if os.path.exists(slab_sidecar_path(nifti_path)):
+            link_alias(slab_sidecar_path(nifti_path), slab_sidecar_path(alias_path))
+            links.append(slab_sidecar_path(alias_path))
+    return links
+
+
+def list_items(config):
+    """Pipeline items of this stage: {group name: source DICOM paths}.
+
+    With deduplicate set, groups holding the same images as another group are recorded as its
+    aliases in duplicates.json and are not items of their own.
+    """
+    collected = collect_groups(config)
+    duplicates = {}
+    if config['deduplicate']:
+        # Keep groups that already have a segmentation as the canonical ones
+        segmented = [name for name, (group_id, _, _) in collected.items()
+                     if os.path.isfile(os.path.join(config['nifti_dir'], nifti_name(group_id)))
+                     and not os.path.islink(os.path.join(config['nifti_dir'], nifti_name(group_id)))]
+        canonical = find_duplicates({name: uids for name, (_, _, uids) in collected.items()}, segmented)
+        duplicates = {alias: {'canonical': name, 'source_dir': os.path.dirname(collected[alias][1][0])}
+                      for alias, name in canonical.items()}
+        print(f"{len(duplicates)} duplicate groups")
+        # New aliases of groups that are segmented already are linked right away
+        for name, aliases in aliases_of(duplicates).items():
+            nifti_path = os.path.join(config['nifti_dir'], nifti_name(collected[name][0]))
+            if nifti_output_valid(nifti_path):
+                link_aliases(config, nifti_path, aliases)
+    write_duplicates(config['group_dir'], duplicates)
+    return {name: dicom_paths for name, (_, dicom_paths, _) in collected.items() if name not in duplicates}
+
 
-            for i, group in enumerate(groups.values()):
-                # Extract new folder name from the complete file path
-                split_path = sub_folder_path.split(os.sep)
-                new_folder_name = "_".join([split_path[-5], split_path[-1], f"group{i+1}"])
-              
-                # Create a directory for this group in the output directory
-                group_dir = os.path.join(output_directory, new_folder_name)
-                os.makedirs(group_dir, exist_ok=True)
+def run_items(config, items, workers=None):
+    """Materialize and segment the given groups. Returns {group name: {'outputs': [...]}} for the groups that succeeded."""
+    scheduler = make_scheduler(config)
+    group_dirs = {}
+    output_paths = {}
+    for name, dicom_paths in items.items():
+        # Link (or copy) the DICOM files for this group into their own directory.
+        # Groups whose source files did not change since the last run are left alone.
+        group_dir = os.path.join(config['group_dir'], name)
+        if not materialize_group(dicom_paths, group_dir, config['materialize_mode']):
+            print("unchanged group: ", name)
+        group_dirs[name] = group_dir
+        output_paths[name] = os.path.join(config['nifti_dir'], nifti_name(parse_group_name(name)))
 
-                # Copy the DICOM files for this group to the new directory
-                for _, dicom_path in group:
-                    shutil.copy2(dicom_path, group_dir)
+    if config['lumbar_slab']:
+        os.makedirs(config['nifti_dir'], exist_ok=True)
+        input_dirs = prepare_slabs(config, group_dirs, output_paths, scheduler)
+    else:
+        input_dirs = group_dirs
+        for name, output_path in output_paths.items():
+            # Outputs of an earlier run with lumbar_slab only cover the slab
+            if read_slab(output_path) is not None:
+                os.remove(slab_sidecar_path(output_path))
+                remove_output(scheduler, name, output_path)
 
-                # Set the output_name based on the path to the subfolder and the group index
-                split_name = sub_folder_path.split('/')
-                output_name = f"nnUNet_total_seg_l3_{split_name[-5]}_{split_name[-1]}_group{i+1}"
+    outputs = {}
+    for name, group_dir in group_dirs.items():
+        # Queue the TotalSegmentator run, outputs that already exist are skipped
+        output_path = output_paths[name]
+        scheduler.add_job(name, input_dirs[name], output_path)
+        outputs[name] = [group_dir, output_path]
+        if config['lumbar_slab']:
+            outputs[name].append(slab_sidecar_path(output_path))
 
-                # Set the output_string
-                output_string = '/share/dept_machinelearning/Faculty/Rasool, Ghulam/Shared Resources/Pancreatic Cancer Image Data/result_files/nifti_files_all_folders/' + output_name
+    # Run the segmentations of these groups (other processes may share the queue)
+    summary = scheduler.run(list(group_dirs))
+    print("segmentation jobs: ", summary, "queue status: ", scheduler.status())
+    # Aliases of a group point to its segmentation
+    aliases = aliases_of(read_duplicates(config['group_dir']))
+    for name, paths in outputs.items():
+        if nifti_output_valid(paths[1]):
+            paths.extend(link_aliases(config, paths[1], aliases.get(name, [])))
+    return {name: {'outputs': paths} for name, paths in outputs.items() if nifti_output_valid(paths[1])}
 
-                # The command to run the TotalSegmentator
-                command = f"TotalSegmentator -i \"{group_dir}\" -o \"{output_string}\" --ml"
 
-                # Set the CUDA_VISIBLE_DEVICES environment variable
-                env = os.environ.copy()
-                env['CUDA_VISIBLE_DEVICES'] = '0'  # Use the first GPU
+def main(config):
+    run_items(config, list_items(config))
+    export_metrics(config['metrics_dir'], 'step1')
 
-                # Use subprocess to run the command and capture the output
-                process = subprocess.Popen(command, stdout=subprocess.PIPE, shell=True, env=env)
-                out, err = process.communicate()
 
-                # Print the output file name
-                print("file_name: ", output_name)
-                print(out.decode('utf-8'))
+if __name__ == '__main__':
+    main(load_config(sys.argv[1] if len(sys.argv) > 1 else None))
@@ -1,65 +1,188 @@
 # STEP 2: Identify L3 slices in the segmented niftii files created in step2 and converts to png.
 # PNG files are saved in a new specified folder
-import pydicom
+# With stream_predict set, step3 takes the slices from iter_l3_slices in memory instead.
+# Usage: python step2.py [config.json]
 from PIL import Image
-import pandas as pd
 import nibabel as nib
-import numpy as np
 import os
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from utils import *
+from config import load_config, stage_workers
+from series_order import get_series_order
+from materialize import GROUP_MANIFEST_FILE
+from identifiers import GroupIndex, SliceId, AmbiguousMatchError, parse_nifti_name, group_name, case_id
+from instrumentation import metrics, export_metrics
+from lumbar_slab import read_slab, slab_sidecar_path
+from dedup import read_duplicates
 
-png_folder = '/share/dept_machinelearning/Faculty/Rasool, Ghulam/Shared Resources/Pancreatic Cancer Image Data/result_files/png_slices_L3_additional_unprocessed'
-os.makedirs(png_folder, exist_ok=True)
 
-axial_series_dir = '/share/dept_machinelearning/Faculty/Rasool, Ghulam/Shared Resources/Pancreatic Cancer Image Data/result_files/axial_series_groups_unprocessed'
+def read_l3_slices(config, nifti_file, group_index):
+    """Return the slices of one segmentation that contain the vertebra, or None if it cannot be used.
 
-output_folder = '/share/dept_machinelearning/Faculty/Rasool, Ghulam/Shared Resources/Pancreatic Cancer Image Data/result_files/nifti_files_additional_unprocessed/'
-output_files = [f for f in os.listdir(output_folder) if f.endswith('.nii') or f.endswith('.nii.gz')]
-vertebra_value = 29 # index for L3 vertebra
-
-# Generate the dicom_path_dict
-dicom_path_dict = generate_dicom_path_dict(axial_series_dir)
-
-# Load the nifti file
-for nifti_file in output_files:
+    Each slice is (case id, uint8 image of the muscle window, (row, column) pixel spacing in mm),
+    the image encoded with config['input_encoding'] (see WINDOW_ENCODINGS).
+    """
     print("nifti file: ", nifti_file)
+    vertebra_value = config['vertebra_label'] # index for L3 vertebra
     try:
-        nifti = nib.load(os.path.join(output_folder, nifti_file))
-        nifti_data = nifti.get_fdata()
-        first_slice_shape = nifti_data[:,:,0].shape
-        for slice_index in range(1, nifti_data.shape[2]):
-            assert nifti_data[:,:,slice_index].shape == first_slice_shape, f"Invalid shape: {nifti_data[:,:,slice_index].shape} for slice {slice_index}. Expected {first_slice_shape}."
-    except AssertionError as e:
+        nifti_path = os.path.join(config['nifti_dir'], nifti_file)
+        with metrics.timed('locate_l3') as measurement:
+            nifti = nib.load(nifti_path)
+            # find all slices containing the vertebra in one pass over the memory-mapped labels
+            l3_slices, l3_voxel_counts = locate_label_slices(nifti, vertebra_value)
+            measurement.bytes_read = os.path.getsize(nifti_path)
+    except ValueError as e:
         print(e)
-        continue
-    nifti_transposed_data = np.transpose(nifti_data, (2,0,1))
-    print("nifti data shape: ", nifti_data.shape)
-    for slice_ in range(nifti_data.shape[2]):
-        # check if the slice contains this vertebra value:
-        if vertebra_value in nifti_transposed_data[slice_, :, :]:
-        # get the corresponding DICOM folder
-            nifti_parts = '_'.join(nifti_file.split('_')[4:8]).replace('.nii', '')
-            dicom_folder = get_dicom_path(nifti_parts, dicom_path_dict)
-            if dicom_folder is None:
-                print(f"No matching DICOM folder for NIfTI file {nifti_file}")
-                continue
-            # get a sorted list of DICOM files in the folder based on their Instance Number or Slice Location
-            dicom_files = sorted(os.listdir(dicom_folder), key=lambda x: pydicom.dcmread(os.path.join(dicom_folder, x)).InstanceNumber)
-            # get the corresponding DICOM file. The slices in the nifti_data are in reverse order compared to dicom files in the dicom folder
-            slice_num = (nifti_data.shape[2]) - 1 - slice_
-            dicom_file = dicom_files[slice_num]
-            dicom_data = pydicom.dcmread(os.path.join(dicom_folder, dicom_file))
-            # convert the DICOM slice to png format
-            dicom_image = get_pixels_hu(dicom_data) # convert the DICOM slice to Hounsfield units
-            muscle_window = np.array(dicom_image)
-            muscle_window[muscle_window < -29] = -29
-            muscle_window[muscle_window > 150] = 150
-            image = np.uint8(muscle_window)
-            image_data = Image.fromarray(image)
-            # derive the filename from the nifti_file name
-            base_name = nifti_file.split('_')[4] + 'd' + nifti_file.split('_')[5] + 's' + nifti_file.split('_')[6] + nifti_file.split('_')[7]
-            base_name = base_name.replace('.nii', '')
-            png_filename = f"{base_name}_{slice_num:04d}_0000.png"
-            png_path = os.path.join(png_folder, png_filename)
-            # save the DICOM slice as a PNG file
+        return None
+    num_slices = nifti.shape[2]
+    print("nifti data shape: ", nifti.shape)
+    # a segmentation of the lumbar slab only starts at first_slice of the series
+    slab = read_slab(nifti_path)
+    first_slice = slab['first_slice'] if slab is not None else 0
+    # get the corresponding DICOM folder
+    try:
+        group_id = parse_nifti_name(nifti_file)
+        dicom_folder = group_index.resolve(group_id)
+    except (ValueError, KeyError, AmbiguousMatchError) as e:
+        print(f"No unique DICOM folder for NIfTI file {nifti_file}: {e}")
+        return None
+    # get the DICOM files in the folder sorted by Instance Number (headers are read once per series)
+    dicom_files = get_series_order(dicom_folder)
+    # get the corresponding DICOM files. The slices in the nifti_data are in reverse order compared to dicom files in the dicom folder
+    slice_nums = [first_slice + num_slices - 1 - int(slice_) for slice_ in l3_slices]
+    if any(not 0 <= slice_num < len(dicom_files) for slice_num in slice_nums):
+        # e.g. a NIfTI segmented from another version of the series
+        print(f"NIfTI file {nifti_file} has {num_slices} slices from slice {first_slice}, "
+              f"which do not fit the {len(dicom_files)} DICOM files in {dicom_folder}")
+        return None
+    slice_files = [dicom_files[slice_num] for slice_num in slice_nums]
+    if not slice_files:
+        return []
+    # decode all L3 slices at once, converted to Hounsfield units and clipped to the muscle window
+    with metrics.timed('dicom_read', items=len(slice_files)) as measurement:
+        images, datasets = load_hu_volume(slice_files, window=MUSCLE_WINDOW, encoding=config['input_encoding'])
+        measurement.bytes_read = sum(os.path.getsize(dicom_file) for dicom_file in slice_files)
+    # name the slices after their identifier, <subject>__<series>__group<n>__<slice>
+    return [(case_id(SliceId(*group_id, slice_num)), image, tuple(float(v) for v in ds.get('PixelSpacing', (1, 1))))
+            for slice_num, image, ds in zip(slice_nums, images, datasets)]
+
+
+def save_png_slices(png_dir, slices):
+    """Save slices returned by read_l3_slices as nnUNet input PNGs, <case id>_0000.png. Returns their paths."""
+    png_paths = []
+    for slice_case_id, image, _ in slices:
+        image_data = Image.fromarray(image)
+        png_path = os.path.join(png_dir, f"{slice_case_id}_0000.png")
+        # save the DICOM slice as a PNG file
+        with metrics.timed('png_write') as measurement:
             image_data.save(png_path)
+            measurement.bytes_written = os.path.getsize(png_path)
+        png_paths.append(png_path)
+    return png_paths
+
+
+def extract_l3_slices(config, nifti_file, group_index):
+    """Save the slices of one segmentation that contain the vertebra as PNGs and return their paths."""
+    slices = read_l3_slices(config, nifti_file, group_index)
+    if slices is None:
+        return None
+    return save_png_slices(config['png_dir'], slices)
+
+
+def list_items(config):
+    """Pipeline items of this stage: {nifti file: [nifti path, manifest of its group folder]}.
+
+    Aliases of duplicate groups are skipped, step4 copies the rows of their canonical group.
+    """
+    duplicates = read_duplicates(config['group_dir'])
+    items = {}
+    for nifti_file in sorted(os.listdir(config['nifti_dir'])):
+        if not (nifti_file.endswith('.nii') or nifti_file.endswith('.nii.gz')):
+            continue
+        try:
+            if group_name(parse_nifti_name(nifti_file)) in duplicates:
+                continue
+        except ValueError:
+            pass
+        inputs = [os.path.join(config['nifti_dir'], nifti_file),
+                  slab_sidecar_path(os.path.join(config['nifti_dir'], nifti_file))]
+        try:
+            inputs.append(os.path.join(config['group_dir'], group_name(parse_nifti_name(nifti_file)), GROUP_MANIFEST_FILE))
+        except ValueError:
+            pass
+        items[nifti_file] = inputs
+    return items
+
+
+# Set in every worker process by init_worker
+worker_config = None
+worker_group_index = None
+
+
+def init_worker(config, group_index):
+    global worker_config, worker_group_index
+    worker_config = config
+    worker_group_index = group_index
+
+
+def process_nifti(nifti_file):
+    # The metrics of the worker process travel back with the result
+    return extract_l3_slices(worker_config, nifti_file, worker_group_index), metrics.drain()
+
+
+def read_nifti_slices(nifti_file):
+    return read_l3_slices(worker_config, nifti_file, worker_group_index), metrics.drain()
+
+
+def iter_l3_slices(config, nifti_files, workers=None):
+    """Yield (nifti file, read_l3_slices(...)) in order, read by worker processes.
+
+    At most config['stream_queue_size'] segmentations are read ahead of the consumer, so the
+    slices stream to it without piling up in memory.
+    """
+    group_index = GroupIndex(config['group_dir'])
+    workers = workers or stage_workers(config, 'extract')
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(config, group_index)) as executor:
+        pending = deque()
+        for nifti_file in nifti_files:
+            pending.append((nifti_file, executor.submit(read_nifti_slices, nifti_file)))
+            while len(pending) > config['stream_queue_size']:
+                nifti_file, future = pending.popleft()
+                slices, worker_metrics = future.result()
+                metrics.merge(worker_metrics)
+                yield nifti_file, slices
+        while pending:
+            nifti_file, future = pending.popleft()
+            slices, worker_metrics = future.result()
+            metrics.merge(worker_metrics)
+            yield nifti_file, slices
+
+
+def run_items(config, items, workers=None):
+    """Extract the L3 slices of the given segmentations. Returns {nifti file: {'outputs': png paths}}."""
+    os.makedirs(config['png_dir'], exist_ok=True)
+    # Index the group folders by their identifier once
+    group_index = GroupIndex(config['group_dir'])
+    for ambiguous_id, paths in group_index.ambiguous.items():
+        print(f"Ambiguous group {ambiguous_id}: {paths}")
+
+    nifti_files = list(items)
+    workers = workers or stage_workers(config, 'extract')
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(config, group_index)) as executor:
+        results = {}
+        for nifti_file, (png_paths, worker_metrics) in zip(nifti_files, executor.map(process_nifti, nifti_files)):
+            metrics.merge(worker_metrics)
+            if png_paths is not None:
+                results[nifti_file] = {'outputs': png_paths}
+        return results
+
+
+def main(config):
+    run_items(config, list_items(config))
+    export_metrics(config['metrics_dir'], 'step2')
+
+
+if __name__ == '__main__':
+    main(load_config(sys.argv[1] if len(sys.argv) > 1 else None))
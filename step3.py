@@ -1,54 +1,159 @@
 # Step 3: Load the trained model and make predictions on all generated png images
-# Saves the generated files (.pkl, .npz, and .png) in a a new specified folder.
- 
+# Saves the generated probability maps of every ensemble member in a new specified folder.
+# All fold checkpoints are loaded once and every image is preprocessed once per model.
+# With stream_predict set, the items are step2's segmentations instead: their L3 slices are read
+# by worker processes and go to the models as in-memory arrays, without the PNG round-trip. The
+# PNGs are then only written with debug_png set.
+# Usage: python step3.py [config.json]
+
 import os
-import torch
-import numpy as np
-from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
-from nnunetv2.training.nnUNetTrainer import nnUNetTrainer
-from nnunetv2.imageio.simpleitk_reader_writer import SimpleITKIO
-from batchgenerators.utilities.file_and_folder_operations import join
-
-gpu_index = 0
-
-# define the input and output directories
-input_dir = '/share/dept_machinelearning/Faculty/Rasool, Ghulam/Shared Resources/Pancreatic Cancer Image Data/result_files/png_slices_L3_additional_unprocessed'
-
-# instantiate the nnUNetPredictor
-predictor = nnUNetPredictor(
-    tile_step_size=0.5,
-    use_gaussian=True,
-    use_mirroring=True,
-    perform_everything_on_device=True,
-    device=torch.device(type='cuda', index=gpu_index),
-    verbose=False,
-    verbose_preprocessing=False,
-    allow_tqdm=True
-)
-prob_sm_list = []
-for j in range(1,3):
-    # define the directory containing trained model weights
-    dir = '/home/80024222/projects/nnUNet_results/Dataset50{}_NatGeSM_/nnUNetTrainer__nnUNetPlans__2d'.format(j)
-    for i in range(0, 5):
-        output_dir = '/share/dept_machinelearning/Faculty/Rasool, Ghulam/Shared Resources/Pancreatic Cancer Image Data/result_files/nn_unet_sm_additional_unprocessed/ensemble_{}_{}'.format(j,i)        
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-
-        # initialize the network architecture and load the checkpoint
-        predictor.initialize_from_trained_model_folder(dir,
-        use_folds=(i,),
-        checkpoint_name='checkpoint_final.pth',
-        )
-
-        # predict segmentations for all files in the input directory
-        predictor.predict_from_files(
-            input_dir,
-            output_dir,
-            save_probabilities=True,
-            overwrite=True,
-            num_processes_preprocessing=1,
-            num_processes_segmentation_export=1,
-            folder_with_segs_from_prev_stage=None,
-            num_parts=1,
-            part_id=0
-        )
+import sys
+from config import load_config, stage_workers
+from ensemble import (EnsemblePredictor, NnUNetModel, StandInModel, read_png_image, slice_image,
+                      save_member_probabilities)
+from probability_store import ProbabilityStore
+from instrumentation import metrics, export_metrics
+import step2
+
+
+def build_predictor(config):
+    """Load the folds of all trained models once (or the stand-in models for testing)."""
+    if config['stand_in_models']:
+        return EnsemblePredictor([StandInModel(name, folds=config['folds'], seed=10 * k)
+                                  for k, (name, _) in enumerate(config['model_dirs'])])
+
+    import torch
+    # run on the GPU if there is one, the CPU otherwise
+    if torch.cuda.is_available():
+        device = torch.device(type='cuda', index=config['gpu_index'])
+    else:
+        device = torch.device(type='cpu')
+    # define the directories containing trained model weights
+    return EnsemblePredictor([NnUNetModel(model_dir, name=name, folds=config['folds'], device=device)
+                              for name, model_dir in config['model_dirs']])
+
+
+def probability_store(config, predictor=None):
+    """The probability store step3 writes to and step4 reads from."""
+    root = os.path.join(config['prediction_dir'], 'probabilities')
+    if predictor is None:
+        return ProbabilityStore(root)
+    return ProbabilityStore(root, members=[f'ensemble_{name}' for name in predictor.member_names],
+                            dtype=config['probability_format'])
+
+
+def list_items(config):
+    """Pipeline items of this stage: {case id: [png path]}. nnUNet input files are named <case>_0000.png.
+
+    With stream_predict set, the items of step2: {nifti file: [its input files]}.
+    """
+    if config['stream_predict']:
+        return step2.list_items(config)
+    input_dir = config['png_dir']
+    return {fn[:-len('_0000.png')]: [os.path.join(input_dir, fn)]
+            for fn in sorted(os.listdir(input_dir)) if fn.endswith('_0000.png')}
+
+
+def predict_batch(config, predictor, store, case_ids, images, properties):
+    """Predict one batch of images with every ensemble member and store the probabilities.
+
+    Returns {case id: {'outputs': [...]}}.
+    """
+    output_dir = config['prediction_dir']
+    results = {}
+    if config['probability_format'] == 'npz':
+        # predict with every ensemble member and save the probabilities as ensemble_<model>_<fold>/<case>.npz
+        # (prediction is lazy, so the timing includes writing the files)
+        with metrics.timed('predict', items=len(case_ids)):
+            for member_name, probabilities in predictor.predict(images, properties):
+                save_member_probabilities(output_dir, case_ids, member_name, probabilities)
+        for case_id in case_ids:
+            results[case_id] = {'outputs': [os.path.join(output_dir, f'ensemble_{name}', case_id + '.npz')
+                                            for name in predictor.member_names]}
+    else:
+        # collect the foreground channel of every member, then store each image once
+        foregrounds = {case_id: [] for case_id in case_ids}
+        with metrics.timed('predict', items=len(case_ids)):
+            for member_name, probabilities in predictor.predict(images, properties):
+                for case_id, probs in zip(case_ids, probabilities):
+                    foregrounds[case_id].append(probs[1])
+        for case_id in case_ids:
+            with metrics.timed('probability_write') as measurement:
+                store.write(case_id, foregrounds[case_id])
+                measurement.bytes_written = os.path.getsize(store.path(case_id))
+            results[case_id] = {'outputs': [store.path(case_id)]}
+    return results
+
+
+def run_items(config, items, workers=None):
+    """Predict the given cases with every ensemble member. Returns {case id: {'outputs': [...]}}."""
+    if config['stream_predict']:
+        return run_stream(config, items)
+    predictor = build_predictor(config)
+    store = probability_store(config, predictor) if config['probability_format'] != 'npz' else None
+
+    case_ids = list(items)
+    batch_size = config['batch_size']
+    results = {}
+    for start in range(0, len(case_ids), batch_size):
+        batch_ids = case_ids[start:start + batch_size]
+        images = []
+        properties = []
+        with metrics.timed('png_read', items=len(batch_ids)) as measurement:
+            for case_id in batch_ids:
+                image, props = read_png_image(items[case_id][0])
+                images.append(image)
+                properties.append(props)
+                measurement.bytes_read += os.path.getsize(items[case_id][0])
+        results.update(predict_batch(config, predictor, store, batch_ids, images, properties))
+        print(f"predicted {start + len(batch_ids)} of {len(case_ids)} images")
+    return results
+
+
+def run_stream(config, items):
+    """Extract the L3 slices of the given segmentations and predict them in memory.
+
+    Returns {nifti file: {'outputs': probability files of its slices (and debug PNGs)}}.
+    """
+    predictor = build_predictor(config)
+    store = probability_store(config, predictor) if config['probability_format'] != 'npz' else None
+    if config['debug_png']:
+        os.makedirs(config['png_dir'], exist_ok=True)
+
+    batch_size = config['batch_size']
+    case_outputs = {}
+    nifti_cases = {}
+    nifti_pngs = {}
+    batch = []
+
+    def flush():
+        case_ids, images, properties = zip(*batch)
+        for case_id, result in predict_batch(config, predictor, store, case_ids, images, properties).items():
+            case_outputs[case_id] = result['outputs']
+        print(f"predicted {len(case_outputs)} images")
+        batch.clear()
+
+    for nifti_file, slices in step2.iter_l3_slices(config, list(items), stage_workers(config, 'extract')):
+        if slices is None:
+            continue
+        nifti_cases[nifti_file] = [case_id for case_id, _, _ in slices]
+        nifti_pngs[nifti_file] = step2.save_png_slices(config['png_dir'], slices) if config['debug_png'] else []
+        for case_id, pixels, pixel_spacing in slices:
+            image, props = slice_image(pixels, pixel_spacing)
+            batch.append((case_id, image, props))
+            if len(batch) >= batch_size:
+                flush()
+    if batch:
+        flush()
+    return {nifti_file: {'outputs': [path for case_id in case_ids for path in case_outputs[case_id]]
+                         + nifti_pngs[nifti_file]}
+            for nifti_file, case_ids in nifti_cases.items()}
+
+
+def main(config):
+    run_items(config, list_items(config))
+    export_metrics(config['metrics_dir'], 'step3')
+
+
+if __name__ == '__main__':
+    main(load_config(sys.argv[1] if len(sys.argv) > 1 else None))
@@ -1,182 +1,280 @@
 # Step 4: Collect the results from all ensembles saved as .npz in step3 and generate the final segmentation output along with uncertainty map for each image.
-# A csv file is also generated and all the outputs are saved in a new specified folder.
-# Mask saved in DICOM format added
+# The results are stored in a SQLite results store (and exported as CSV), all the outputs are saved in a new specified folder.
+# The masks of every series are saved as one DICOM SEG file.
+# The ensemble members are aggregated as a running mean/variance and the images are spread over a process pool
+# in batches, whose metrics are computed at once (see slice_metrics.py).
+# Output files are written by a bounded pool of background writer threads in the main process.
+# Usage: python step4.py [config.json]
 
-%matplotlib inline
 import os
+import sys
 import numpy as np
 from PIL import Image
-import matplotlib.pyplot as plt
-import csv
-import pandas as pd
+import io
 import pydicom
-from pydicom.encaps import encapsulate
-import datetime
+from concurrent.futures import ProcessPoolExecutor
 from utils import *
+from config import load_config, stage_workers
+from series_order import get_series_order
+from aggregate import ensemble_members, aggregate_members, aggregate_store
+from probability_store import ProbabilityStore
+from materialize import GROUP_MANIFEST_FILE
+from identifiers import GroupIndex, AmbiguousMatchError, parse_case_id, slice_group, group_name
+from instrumentation import metrics, export_metrics
+from writer_pool import WriterPool
+from dicom_seg import pack_mask, export_series_segmentation
+from results_store import ResultsStore, RESULT_FIELDS
+from dedup import read_duplicates, with_alias_rows
+from slice_metrics import batch_metrics
 
-# User defined threshold
-threshold = 50
-
-# Define the base directory where the ensemble folders are located
-base_dir = '/share/dept_machinelearning/Faculty/Rasool, Ghulam/Shared Resources/Pancreatic Cancer Image Data/result_files/nn_unet_sm_additional_unprocessed'
-
-# Specify the directory containing the DICOM folders
-dicom_directory = '/share/dept_machinelearning/Faculty/Rasool, Ghulam/Shared Resources/Pancreatic Cancer Image Data/result_files/axial_series_groups_unprocessed'
-
-# Get a list of all directories in the specified directory
-dicom_folders = [f.path for f in os.scandir(dicom_directory) if f.is_dir()]
-
-# Get the list of files in the first ensemble folder
-first_ensemble_dir = os.path.join(base_dir, 'ensemble_1_0')
-file_names = [fn for fn in os.listdir(first_ensemble_dir) if fn.endswith('.npz')]
-
-# if final_output folder does not exist
-if not os.path.exists(os.path.join(base_dir, 'final_output_HU_refined')):
-    os.makedirs(os.path.join(base_dir, 'final_output_HU_refined'))
-
-
-# Open the CSV file
-with open('/share/dept_machinelearning/Faculty/Rasool, Ghulam/Shared Resources/Pancreatic Cancer Image Data/result_files/nn_unet_sm_additional_unprocessed/final_output_HU_refined/PancreaticCancer_L3_results_add_unprocessed.csv', 'w', newline='') as csvfile:
-    fieldnames = ['dicom_file_path', 'filename', 'uncertain_pixel_count', 'mean_variance', 'median_variance', 'mean_variance_percent', 
-                  'median_variance_percent', 'sm_pixels', 'sm_area', 'sm_volume', 'sm_hu', 'study_description', 'series_description']
-    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-
-    writer.writeheader()
-    k = 0
-    # Loop over each file
-    for file_name in file_names:
-        k = k+1
-        # Initialize a list to store the image data from each ensemble
-        ensemble_data = []
-        # Loop over each ensemble folder
-        for j in range(1,3):
-            for i in range(5):
-                # Define the path to the current ensemble folder
-                ensemble_dir = os.path.join(base_dir, f'ensemble_{j}_{i}')
-
-                # Define the path to the current file
-                file_path = os.path.join(ensemble_dir, file_name)
-
-                # Check if the file is a .npz file
-                if file_path.endswith('.npz'):
-                    # Load the file as a numpy array
-                    file_data = np.load(file_path)
-                    data = file_data['probabilities']
-                    background = data[0].squeeze()
-                    sm_seg = data[1].squeeze()
-                    # Add the data to the list
-                    ensemble_data.append(sm_seg)
-                           
-        # Compute the average and variance of the ensemble data
-        ensemble_average = np.mean(ensemble_data, axis=0)
-        ensemble_variance = np.var(ensemble_data, axis=0)
-        predicted_sm = np.where(ensemble_average > 0.5, 1, 0)
-       
-        filename = file_name.split('.')[0]
-        print("file name: ", filename)
-
-        # Get dicom series from filename
-        # Replace 's', 'd', and 'groupgroup' with '_'
-        filename = filename.replace('s', '_')
-        filename = filename.replace('groupgroup', '_group')
-        filename = filename.replace('d', '_')
-        # split on last '_' and keep the part before the last '_'
-        filename_parts = filename.rsplit('_', 1)
-        print('Filename parts:', filename_parts)
-        # Get the slice number from the filename. The slice number is the part after the last '_'
-        slice = filename.rsplit('_', 1)[1]
-
-        # Get the file_path that contains this filename from dicom_folder
-        dicom_file_path = None
-        for folder in dicom_folders:
-            if filename_parts[0] in folder:
-                dicom_file_path = folder
-                break
-        print('DICOM file path:', dicom_file_path)
-
-        # Read the DICOM files and sort them by the InstanceNumber attribute
-        if dicom_file_path is not None:
-            files = sorted(os.listdir(dicom_file_path), key=lambda x: pydicom.dcmread(os.path.join(dicom_file_path, x)).InstanceNumber)
-        else:
-            print("Skipping this file due to invalid filename.")
-            continue
+fieldnames = [name for name, _ in RESULT_FIELDS]
 
-        # Convert slice to integer
-        slice_number = int(slice)
 
-        # Get the DICOM file corresponding to the slice
-        if slice_number <= len(files):
-            dicomslice_file = files[slice_number]
-        else:
-            print("Slice number is greater than the number of DICOM files.")
-            dicomslice_file = None
-          
-        # Check if dicomslice_file is not None before constructing the file path
-        if dicomslice_file is not None:
-            # Construct the full file path
-            dicomslice_file_path = os.path.join(dicom_file_path, dicomslice_file)
-            # Load the DICOM file
-            dicom_file = pydicom.dcmread(dicomslice_file_path)
+# Set in every worker process by init_worker, so they are not sent along with every file
+worker_config = None
+worker_group_index = None
+worker_store = None
+
+
+def init_worker(config, group_index):
+    global worker_config, worker_group_index, worker_store
+    worker_config = config
+    worker_group_index = group_index
+    if config['probability_format'] != 'npz':
+        worker_store = ProbabilityStore(os.path.join(config['prediction_dir'], 'probabilities'))
+
+
+def encode_png(image):
+    buffer = io.BytesIO()
+    Image.fromarray(image).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def load_case(filename):
+    """Aggregate the ensemble of one image (by case id) and read its DICOM slice.
+
+    Returns (slice id, DICOM folder, DICOM dataset, ensemble mean, ensemble variance), or None
+    if the case is skipped.
+    """
+    config = worker_config
+    # The case id is <subject>__<series>__group<n>__<slice>
+    # Get the dicom series folder of this case from the group index
+    try:
+        slice_id = parse_case_id(filename)
+        dicom_file_path = worker_group_index.resolve(slice_id)
+    except (ValueError, KeyError, AmbiguousMatchError) as e:
+        print(filename, "Skipping this file:", e)
+        return None
+
+    # Get the DICOM files sorted by the InstanceNumber attribute (headers are read once per series)
+    files = get_series_order(dicom_file_path)
+    slice_number = slice_id.slice
+
+    # Get the DICOM file corresponding to the slice
+    if slice_number < len(files):
+        dicomslice_file = files[slice_number]
+    else:
+        print(filename, "Slice number is greater than the number of DICOM files.")
+        dicomslice_file = None
+
+    # Check if dicomslice_file is not None before constructing the file path
+    if dicomslice_file is not None:
+        # Load the DICOM file
+        dicom_file = pydicom.dcmread(dicomslice_file)
+    else:
+        print(filename, "Skipping this file due to invalid slice number.")
+        return None  # Skip the rest of the work for this file
+
+    # Compute the average and variance of the ensemble data, one member at a time
+    with metrics.timed('aggregate'):
+        if config['probability_format'] == 'npz':
+            members = ensemble_members(config)
+            ensemble_average, ensemble_variance, num_members = aggregate_members(config['prediction_dir'], filename + '.npz',
+                                                                                 members)
+            if 0 < num_members < len(members):
+                print(f"{filename}: only {num_members} of {len(members)} ensemble members found")
         else:
-            print("Skipping this file due to invalid slice number.")
-            continue  # Skip the rest of the loop for this file
-
-        # Get the pixel dimension field data from the DICOM file header
-        pixel_spacing = getattr(dicom_file, 'PixelSpacing', [0.0001, 0.0001])
-        slice_thickness = getattr(dicom_file, 'SliceThickness', 0.0001)
-        study_description = getattr(dicom_file, 'StudyDescription', 'No_StudyDescription')
-        series_description = getattr(dicom_file, 'SeriesDescription', 'No_SeriesDescription')
-        sm_area = np.sum(predicted_sm) * pixel_spacing[0] * pixel_spacing[1]
-        sm_pixels = np.sum(predicted_sm)
-        sm_volume = sm_area * slice_thickness
-        print('Skeletal Muscle Area:', sm_area, 'mm^2')
-        print('Skeletal Muscle Volume:', sm_volume, 'mm^3')
-        # get the average hounsefield of the segmented area
-        dicom_img_hu = get_pixels_hu(dicom_file)
-        sm_hu = np.mean(dicom_img_hu[predicted_sm == 1])
-        print("min sm hu value", np.min(dicom_img_hu[predicted_sm == 1]), "max sm hu value", np.max(dicom_img_hu[predicted_sm == 1]))
-        print("min HU: ", np.min(dicom_img_hu), "max HU: ", np.max(dicom_img_hu))
-        print('Avg Skeletal Muscle HU:', sm_hu)
-
-        # Threshold the variance to identify uncertain pixels
-        var_threshold = np.where(ensemble_variance > threshold, ensemble_variance, 0)
-        non_zero_values = var_threshold[np.nonzero(var_threshold)]
-        print('Count of values greater than: ', threshold, 'is', len(non_zero_values))
-        print('mean variance: ', np.mean(non_zero_values), 'median variance: ', np.median(non_zero_values))
-
-         # Normalize the thresholded variance to the range [0, 100]
-        ensemble_variance_percent = ((non_zero_values - non_zero_values.min()) 
-                            * (100 / (non_zero_values.max() - non_zero_values.min()))).astype(np.uint8)     
-        print('mean variance percent: ', np.mean(ensemble_variance_percent), 'median variance percent: ', np.median(ensemble_variance_percent))
-                
-        count = len(non_zero_values)
-        mean_variance = np.mean(non_zero_values)
-        median_variance = np.median(non_zero_values)
-        mean_variance_percent = np.mean(ensemble_variance_percent)
-        median_variance_percent = np.median(ensemble_variance_percent)
-        
-        # Write a row to the CSV file
-        writer.writerow({'dicom_file_path': dicom_file_path, 'filename': filename,'uncertain_pixel_count': count, 
-                            'mean_variance': mean_variance, 
-                            'median_variance': median_variance,
-                            'mean_variance_percent': mean_variance_percent,
-                            'median_variance_percent': median_variance_percent,
-                            'sm_pixels': sm_pixels,
-                            'sm_area': sm_area, 'sm_volume': sm_volume, 'sm_hu': sm_hu,
-                            'study_description': study_description, 'series_description': series_description})
-
-        predicted_sm_ = np.uint8(predicted_sm) * 255
-        # Normalize the variance to the range [0, 255]
-        ensemble_variance_norm = ((ensemble_variance - ensemble_variance.min()) 
-                            * (255 / (ensemble_variance.max() - ensemble_variance.min()))).astype(np.uint8)  
-       
-        # Save the average and variance as images
-        Image.fromarray(predicted_sm_).save(os.path.join(base_dir, 'final_output_HU_refined', f'prediction_{filename}.png'))
-        Image.fromarray(ensemble_variance_norm).save(os.path.join(base_dir, 'final_output_HU_refined', f'uncertainty_{filename}.png'))
-        
-        # Save the predicted mask as a DICOM file
-        dicom_output_path = os.path.join(base_dir, 'final_output_HU_refined', f'prediction_{filename}.dcm')
-        save_dicom(predicted_sm, dicom_file, dicom_output_path) 
-
-        # Clear the ensemble_data list for the next ensemble
-        ensemble_data.clear()    
+            ensemble_average, ensemble_variance, num_members = aggregate_store(worker_store, filename)
+    if num_members == 0:
+        print("No ensemble outputs for", filename)
+        return None
+    return slice_id, dicom_file_path, dicom_file, ensemble_average, ensemble_variance
+
+
+def process_files(filenames):
+    """Aggregate the ensembles of a batch of images (by case id) and encode their outputs.
+
+    The metrics of all images of the same size are computed at once (see slice_metrics.py).
+    Returns a list with (CSV row, {output path: PNG bytes}, bit-packed mask), or None if the
+    case is skipped, for every case.
+    """
+    config = worker_config
+    # User defined threshold
+    threshold = config['variance_threshold']
+    output_dir = config['output_dir']
+    cases = [load_case(filename) for filename in filenames]
+
+    # Stack the slices of each image size
+    by_shape = {}
+    for k, case in enumerate(cases):
+        if case is not None:
+            by_shape.setdefault(np.shape(case[3]), []).append(k)
+
+    results = [None] * len(filenames)
+    for indices in by_shape.values():
+        batch = [cases[k] for k in indices]
+        datasets = [case[2] for case in batch]
+        with metrics.timed('slice_metrics', items=len(batch)):
+            # Get the pixel dimension field data from the DICOM file headers
+            pixel_spacings = [[float(v) for v in getattr(ds, 'PixelSpacing', [0.0001, 0.0001])] for ds in datasets]
+            slice_thicknesses = [float(getattr(ds, 'SliceThickness', 0.0001)) for ds in datasets]
+            # the HU of the slices, for the average hounsfield of the segmented area
+            hu_images = np.stack([get_pixels_hu(ds) for ds in datasets])
+            masks, uncertainty_images, columns = batch_metrics(
+                np.stack([case[3] for case in batch]), np.stack([case[4] for case in batch]),
+                hu_images, pixel_spacings, slice_thicknesses, threshold)
+
+        for n, k in enumerate(indices):
+            filename = filenames[k]
+            slice_id, dicom_file_path, dicom_file = cases[k][:3]
+            row = {'dicom_file_path': dicom_file_path, 'filename': filename}
+            row.update((name, values[n]) for name, values in columns.items())
+            row['study_description'] = getattr(dicom_file, 'StudyDescription', 'No_StudyDescription')
+            row['series_description'] = getattr(dicom_file, 'SeriesDescription', 'No_SeriesDescription')
+            print(f"{filename}: sm_area {row['sm_area']} mm^2, sm_volume {row['sm_volume']} mm^3, "
+                  f"sm_hu {row['sm_hu']}, {row['uncertain_pixel_count']} values greater than {threshold}")
+
+            # Encode the average and variance as images, they are written by the main process
+            with metrics.timed('encode_png', items=2):
+                png_files = {os.path.join(output_dir, f'prediction_{filename}.png'): encode_png(np.uint8(masks[n]) * 255),
+                             os.path.join(output_dir, f'uncertainty_{filename}.png'): encode_png(uncertainty_images[n])}
+            results[k] = row, png_files, pack_mask(masks[n])
+    return results
+
+
+def list_items(config):
+    """Pipeline items of this stage: {case id: [probability files, manifest of its group folder]}."""
+    prediction_dir = config['prediction_dir']
+    items = {}
+    if config['probability_format'] == 'npz':
+        # Get the list of cases from the first ensemble folder
+        members = ensemble_members(config)
+        first_ensemble_dir = os.path.join(prediction_dir, members[0])
+        for fn in sorted(os.listdir(first_ensemble_dir)):
+            if fn.endswith('.npz'):
+                items[fn[:-len('.npz')]] = [os.path.join(prediction_dir, member, fn) for member in members]
+    else:
+        store = ProbabilityStore(os.path.join(prediction_dir, 'probabilities'))
+        for case_id in store.case_ids():
+            items[case_id] = [store.path(case_id)]
+    for case_id, inputs in items.items():
+        try:
+            inputs.append(os.path.join(config['group_dir'], group_name(slice_group(parse_case_id(case_id))), GROUP_MANIFEST_FILE))
+        except ValueError:
+            pass
+    return items
+
+
+def shard_key(case_id):
+    """Cases of the same series group run on the same worker with pipeline.py --worker, as they share a SEG file."""
+    try:
+        return group_name(slice_group(parse_case_id(case_id)))
+    except ValueError:
+        return case_id
+
+
+def process_files_in_worker(filenames):
+    # The metrics of the worker process travel back with the results
+    return process_files(filenames), metrics.drain()
+
+
+def segmentation_path(config, group_id):
+    """DICOM SEG file holding the masks of one series group."""
+    return os.path.join(config['output_dir'], f'segmentation_{group_name(group_id)}.dcm')
+
+
+def iter_rows(config, case_ids, workers=None):
+    """Process the given cases on a process pool and yield (case id, CSV row or None) in order.
+
+    PNGs are queued to the writer pool as they come in. Cases are sorted by series, so the
+    SEG file of a series is queued as soon as the cases of the next series start.
+    """
+    # Index all group folders in the specified directory by their identifier
+    group_index = GroupIndex(config['group_dir'])
+    for ambiguous_id, paths in group_index.ambiguous.items():
+        print(f"Ambiguous group {ambiguous_id}: {paths}")
+
+    # if final_output folder does not exist
+    os.makedirs(config['output_dir'], exist_ok=True)
+
+    workers = workers or stage_workers(config, 'export')
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(config, group_index)) as executor:
+        # Each worker computes the metrics of a batch of cases at once
+        batch_size = max(1, min(config['metrics_batch_size'], len(case_ids) // (4 * workers)))
+        batches = [case_ids[start:start + batch_size] for start in range(0, len(case_ids), batch_size)]
+        with WriterPool(config['export_writers'], config['export_queue_size']) as writer:
+            # SEG file, DICOM folder and {slice number: packed mask} of the series currently coming in
+            seg_path, dicom_folder, frames = None, None, {}
+            for batch, (batch_results, worker_metrics) in zip(batches, executor.map(process_files_in_worker, batches)):
+                metrics.merge(worker_metrics)
+                for case_id, result in zip(batch, batch_results):
+                    if result is None:
+                        yield case_id, None
+                        continue
+                    row, png_files, packed_mask = result
+                    for path, data in png_files.items():
+                        writer.write(path, data, 'export_png')
+
+                    slice_id = parse_case_id(case_id)
+                    case_seg_path = segmentation_path(config, slice_group(slice_id))
+                    if case_seg_path != seg_path:
+                        if frames:
+                            writer.submit(export_series_segmentation, seg_path, dicom_folder, frames)
+                        seg_path, dicom_folder, frames = case_seg_path, row['dicom_file_path'], {}
+                    frames[slice_id.slice] = packed_mask
+                    yield case_id, row
+            if frames:
+                writer.submit(export_series_segmentation, seg_path, dicom_folder, frames)
+
+
+def output_files(config, case_id):
+    """Files step4 writes for one case (the SEG file is shared with the other slices of the series)."""
+    output_dir = config['output_dir']
+    return [os.path.join(output_dir, f'prediction_{case_id}.png'),
+            os.path.join(output_dir, f'uncertainty_{case_id}.png'),
+            segmentation_path(config, slice_group(parse_case_id(case_id)))]
+
+
+def run_items(config, items, workers=None):
+    """Process the given cases. Returns {case id: {'outputs': [...], 'row': CSV row}}."""
+    return {case_id: {'outputs': output_files(config, case_id), 'row': row}
+            for case_id, row in iter_rows(config, list(items), workers) if row is not None}
+
+
+def write_rows(config, rows):
+    """Upsert result rows into the results store, then export the CSV file if config['csv_path'] is set.
+
+    Every alias of a duplicate group gets a copy of the rows of its canonical group.
+    """
+    with ResultsStore(config['results_path'], config['results_batch_size']) as store:
+        store.add_rows(with_alias_rows(rows, read_duplicates(config['group_dir'])))
+        if config['csv_path']:
+            store.export_csv(config['csv_path'])
+
+
+def main(config):
+    case_ids = list(list_items(config))
+
+    # Rows come back in the order of the cases and are written to the results store in batches
+    def rows():
+        for k, (case_id, row) in enumerate(iter_rows(config, case_ids)):
+            print(f"processed {k + 1} of {len(case_ids)} files")
+            if row is not None:
+                yield row
+
+    write_rows(config, rows())
+    export_metrics(config['metrics_dir'], 'step4')
+
+
+if __name__ == '__main__':
+    main(load_config(sys.argv[1] if len(sys.argv) > 1 else None))
@@ -0,0 +1,107 @@
+# Synthetic test data for every pipeline stage, so the pipeline can be exercised without patient data:
+# DICOM series, TotalSegmentator-like label volumes with an L3 band and step3 fold probabilities.
+import os
+
+import nibabel as nib
+import numpy as np
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import CTImageStorage, ExplicitVRLittleEndian, generate_uid
+
+from fake_segmenter import fake_segmentation
+from probability_store import ProbabilityStore
+
+# ImageOrientationPatient of the three standard planes
+ORIENTATIONS = {
+    'axial': [1, 0, 0, 0, 1, 0],
+    'coronal': [1, 0, 0, 0, 0, -1],
+    'sagittal': [0, 1, 0, 0, 0, -1],
+}
+
+
+def make_dicom_series(folder, num_slices=40, size=512, orientation='axial', slice_thickness=2.5,
+                      rescale_slope=1, rescale_intercept=-1024, seed=0, study_uid=None, series_uid=None):
+    """Write a CT series of num_slices single-frame DICOM files of size x size pixels. Returns the paths."""
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    study_uid = study_uid or generate_uid()
+    series_uid = series_uid or generate_uid()
+    frame_of_reference_uid = generate_uid()
+    # A disc of soft tissue in air, with noise
+    y, x = np.mgrid[:size, :size]
+    body = (x - size / 2) ** 2 + (y - size / 2) ** 2 < (0.4 * size) ** 2
+    paths = []
+    for k in range(num_slices):
+        sop_instance_uid = generate_uid()
+        file_meta = FileMetaDataset()
+        file_meta.MediaStorageSOPClassUID = CTImageStorage
+        file_meta.MediaStorageSOPInstanceUID = sop_instance_uid
+        file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+        ds = Dataset()
+        ds.file_meta = file_meta
+        ds.SOPClassUID = CTImageStorage
+        ds.SOPInstanceUID = sop_instance_uid
+        ds.StudyInstanceUID = study_uid
+        ds.SeriesInstanceUID = series_uid
+        ds.FrameOfReferenceUID = frame_of_reference_uid
+        ds.Modality = 'CT'
+        ds.StudyDescription = 'SYNTHETIC ABDOMEN'
+        ds.SeriesDescription = f'SYNTHETIC {orientation.upper()}'
+        ds.SeriesNumber = 2
+        ds.AcquisitionNumber = 1
+        ds.InstanceNumber = k + 1
+        ds.ImageOrientationPatient = ORIENTATIONS[orientation]
+        ds.ImagePositionPatient = [-0.5 * size, -0.5 * size, -k * slice_thickness]
+        ds.SliceThickness = slice_thickness
+        ds.PixelSpacing = [0.75, 0.75]
+        ds.Rows = size
+        ds.Columns = size
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 1
+        ds.RescaleIntercept = rescale_intercept
+        ds.RescaleSlope = rescale_slope
+        pixels = np.where(body, 1064, 24) + rng.normal(0, 20, (size, size))
+        ds.PixelData = np.clip(pixels, 0, 4095).astype(np.int16).tobytes()
+
+        path = os.path.join(folder, f'IM{k + 1:05d}.dcm')
+        ds.save_as(path, enforce_file_format=True)
+        paths.append(path)
+    return paths
+
+
+def make_label_volume(path, num_slices=40, size=512, l3_fraction=0.5):
+    """Write a uint8 multilabel NIfTI with lumbar vertebrae, L3 (29) around l3_fraction of the volume."""
+    data = fake_segmentation(num_slices, size, size, l3_fraction=l3_fraction)
+    nib.save(nib.Nifti1Image(data, np.eye(4)), path)
+    return path
+
+
+def make_member_probabilities(num_members=10, size=512, seed=0):
+    """Foreground probabilities of an ensemble: a disc with member dependent noise, shape (members, size, size)."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[:size, :size]
+    disc = ((x - size / 2) ** 2 + (y - size / 2) ** 2 < (0.3 * size) ** 2).astype(np.float32)
+    noise = rng.normal(0, 0.15, (num_members, size, size)).astype(np.float32)
+    return np.clip(disc[None] * 0.9 + 0.05 + noise, 0, 1)
+
+
+def make_fold_probabilities(prediction_dir, case_ids, members, size=512, probability_format='npz', seed=0):
+    """Write step3 outputs for case_ids: ensemble_<member>/<case>.npz files or a probability store."""
+    store = None
+    if probability_format != 'npz':
+        store = ProbabilityStore(os.path.join(prediction_dir, 'probabilities'), members=members,
+                                 dtype=probability_format)
+    for k, case_id in enumerate(case_ids):
+        foregrounds = make_member_probabilities(len(members), size, seed + k)
+        if store is not None:
+            store.write(case_id, foregrounds)
+            continue
+        for member, foreground in zip(members, foregrounds):
+            member_dir = os.path.join(prediction_dir, member)
+            os.makedirs(member_dir, exist_ok=True)
+            probabilities = np.stack([1 - foreground, foreground])[:, None]
+            np.savez_compressed(os.path.join(member_dir, case_id + '.npz'), probabilities=probabilities)
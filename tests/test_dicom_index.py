@@ -0,0 +1,16 @@
+# Incremental updates of the DICOM header index.
+import synthetic
+from dicom_index import DicomIndex
+
+
+def test_folders_differing_in_case_are_separate(tmp_path):
+    for k, subject in enumerate(['ABC', 'abc', 'ABC_2']):
+        synthetic.make_dicom_series(str(tmp_path / subject / 'S1'), 4, size=16, seed=k)
+    with DicomIndex(str(tmp_path / 'index.sqlite'), num_workers=1) as index:
+        assert index.update(str(tmp_path / 'ABC')) == (4, 0)
+        assert index.update(str(tmp_path / 'abc')) == (4, 0)
+        assert index.update(str(tmp_path / 'ABC')) == (0, 0)
+        assert index.update(str(tmp_path / 'abc')) == (0, 0)
+        assert index.update(str(tmp_path / 'ABC_2')) == (4, 0)
+        assert len(list(index.records(str(tmp_path / 'ABC')))) == 4
+        assert all('/abc/' in path for path, _ in index.records(str(tmp_path / 'abc')))
@@ -0,0 +1,22 @@
+# Identifier parts that could not be parsed back are rejected.
+import pytest
+
+from identifiers import GroupId, SliceId, group_name, parse_group_name, case_id, parse_case_id
+
+
+@pytest.mark.parametrize('subject, series', [('A__B', '3'), ('A_', '3'), ('A', '_3'), ('', '3'), ('A', 'x/y')])
+def test_invalid_parts_are_rejected(subject, series):
+    with pytest.raises(ValueError):
+        group_name(GroupId(subject, series, 1))
+
+
+@pytest.mark.parametrize('name', ['A___3__group1', 'A__3___group1', 'A__3__group'])
+def test_ambiguous_names_do_not_parse(name):
+    with pytest.raises(ValueError):
+        parse_group_name(name)
+
+
+def test_names_parse_back():
+    slice_id = SliceId('SUBJ_01', 'ser_3', 2, 17)
+    assert parse_case_id(case_id(slice_id)) == slice_id
+    assert parse_group_name(group_name(slice_id)) == GroupId('SUBJ_01', 'ser_3', 2)
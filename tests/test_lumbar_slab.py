@@ -0,0 +1,31 @@
+# Re-segmenting groups whose lumbar slab changed, with fake_segmenter.py as segmenter and localizer.
+import os
+import sys
+
+from config import load_config
+from lumbar_slab import prepare_slabs, read_slab
+from scheduler import nifti_output_valid
+
+from test_scheduler import FAKE_SEGMENTER, make_group, make_scheduler
+
+
+def test_changed_slab_is_segmented_again(tmp_path):
+    _, group_dir = make_group(tmp_path, num_slices=60)
+    output_path = str(tmp_path / 'nifti' / 'A.nii')
+    config = load_config(queue_path=str(tmp_path / 'jobs.sqlite'), slab_dir=str(tmp_path / 'slabs'),
+                         segmentation_slots=['cpu'], segmentation_backoff=0, materialize_mode='copy',
+                         localizer_command=[sys.executable, FAKE_SEGMENTER, '-i', '{input}', '-o', '{output}'])
+    scheduler = make_scheduler(tmp_path)
+    os.makedirs(os.path.dirname(output_path))
+
+    input_dirs = prepare_slabs(config, {'A': group_dir}, {'A': output_path}, scheduler)
+    scheduler.add_job('A', input_dirs['A'], output_path)
+    assert scheduler.run() == {'done': 1}
+    first_slab = read_slab(output_path)
+
+    config['slab_padding'] += 5
+    input_dirs = prepare_slabs(config, {'A': group_dir}, {'A': output_path}, scheduler)
+    assert read_slab(output_path) != first_slab
+    scheduler.add_job('A', input_dirs['A'], output_path)
+    assert scheduler.run() == {'done': 1}
+    assert nifti_output_valid(output_path)
@@ -0,0 +1,79 @@
+# Sharing a stage between workers: every item runs once, however long a worker's listing takes.
+import os
+import time
+import threading
+from collections import Counter
+
+import pipeline
+from config import load_config
+
+NUM_ITEMS = 3
+
+
+class SlowStage:
+    """Stage whose items take a while, and whose second listing lasts until all items are marked done."""
+
+    def __init__(self, tmp_path, leases_dir):
+        self.tmp_path = tmp_path
+        self.leases_dir = leases_dir
+        self.runs = Counter()
+        self.listings = 0
+        self.lock = threading.Lock()
+
+    def list_items(self, config):
+        with self.lock:
+            self.listings += 1
+            first = self.listings == 1
+        if not first:
+            # The other worker finishes its items while this one lists
+            while len([name for name in os.listdir(self.leases_dir) if name.endswith('.done')]) < NUM_ITEMS:
+                time.sleep(0.05)
+        items = {}
+        for k in range(NUM_ITEMS):
+            input_path = self.tmp_path / f'item{k}.txt'
+            input_path.write_text(str(k))
+            items[f'item{k}'] = [str(input_path)]
+        return items
+
+    def run_items(self, config, items, workers=None):
+        results = {}
+        for item_id, inputs in items.items():
+            time.sleep(0.5)
+            with self.lock:
+                self.runs[item_id] += 1
+            output_path = self.tmp_path / f'{item_id}.out'
+            output_path.write_text(item_id)
+            results[item_id] = {'outputs': [str(output_path)]}
+        return results
+
+
+def test_workers_run_each_item_once(tmp_path):
+    config = load_config(manifest_dir=str(tmp_path / 'manifests'), shard_batch_size=1, lease_seconds=20)
+    stage = pipeline.Stage('slow', None, [])
+    module = SlowStage(tmp_path, os.path.join(config['manifest_dir'], 'slow.leases'))
+    workers = [threading.Thread(target=pipeline.run_stage_sharded, args=(stage, module, config, name))
+               for name in ('A', 'B')]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert module.runs == {f'item{k}': 1 for k in range(NUM_ITEMS)}
+    assert set(pipeline.Manifest(os.path.join(config['manifest_dir'], 'slow.json')).items) == set(module.runs)
+
+
+def test_signature_without_content_compares_size_and_mtime(tmp_path):
+    path = tmp_path / 'slice.dcm'
+    path.write_bytes(b'abcd')
+    paths = [str(path)]
+    stat = os.stat(path)
+    hashes = {content: pipeline.input_signature(paths, content=content)[0] for content in (True, False)}
+
+    # Same size and mtime, other bytes: only the content hash sees it
+    path.write_bytes(b'abce')
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert pipeline.input_signature(paths, content=True)[0] != hashes[True]
+    assert pipeline.input_signature(paths, content=False)[0] == hashes[False]
+    assert pipeline.input_signature(paths, content=False)[1][str(path)][2] is None
+
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert pipeline.input_signature(paths, content=False)[0] != hashes[False]
@@ -0,0 +1,62 @@
+# Re-running segmentation jobs whose output or input changed, with fake_segmenter.py as the segmenter.
+import os
+import sys
+
+import synthetic
+from materialize import materialize_group
+from scheduler import SegmentationScheduler, nifti_output_valid
+
+FAKE_SEGMENTER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fake_segmenter.py')
+
+
+def make_group(tmp_path, num_slices=12):
+    dicom_paths = synthetic.make_dicom_series(str(tmp_path / 'source'), num_slices, size=32)
+    group_dir = str(tmp_path / 'groups' / 'A__1__group1')
+    materialize_group(dicom_paths, group_dir, 'copy')
+    return dicom_paths, group_dir
+
+
+def make_scheduler(tmp_path):
+    return SegmentationScheduler(str(tmp_path / 'jobs.sqlite'), slots=['cpu'], backoff=0,
+                                 command=[sys.executable, FAKE_SEGMENTER, '-i', '{input}', '-o', '{output}'])
+
+
+def test_unchanged_job_is_not_run_again(tmp_path):
+    _, group_dir = make_group(tmp_path)
+    output_path = str(tmp_path / 'nifti' / 'A.nii')
+    scheduler = make_scheduler(tmp_path)
+    scheduler.add_job('A', group_dir, output_path)
+    assert scheduler.run() == {'done': 1}
+    scheduler.add_job('A', group_dir, output_path)
+    assert scheduler.run() == {}
+
+
+def test_deleted_output_is_segmented_again(tmp_path):
+    _, group_dir = make_group(tmp_path)
+    output_path = str(tmp_path / 'nifti' / 'A.nii')
+    scheduler = make_scheduler(tmp_path)
+    scheduler.add_job('A', group_dir, output_path)
+    assert scheduler.run() == {'done': 1}
+
+    os.remove(output_path)
+    scheduler.add_job('A', group_dir, output_path)
+    assert scheduler.run() == {'done': 1}
+    assert nifti_output_valid(output_path)
+    assert scheduler.status() == {'done': 1}
+
+
+def test_changed_input_is_segmented_again(tmp_path):
+    dicom_paths, group_dir = make_group(tmp_path)
+    output_path = str(tmp_path / 'nifti' / 'A.nii')
+    scheduler = make_scheduler(tmp_path)
+    scheduler.add_job('A', group_dir, output_path)
+    assert scheduler.run() == {'done': 1}
+    first_mtime = os.stat(output_path).st_mtime_ns
+
+    # A source file changes, so the group is materialized again
+    stat = os.stat(dicom_paths[0])
+    os.utime(dicom_paths[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert materialize_group(dicom_paths, group_dir, 'copy')
+    scheduler.add_job('A', group_dir, output_path)
+    assert scheduler.run() == {'done': 1}
+    assert os.stat(output_path).st_mtime_ns != first_mtime
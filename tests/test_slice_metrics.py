@@ -0,0 +1,55 @@
+# batch_metrics against the per-slice code step4 used before, on stacks mixing empty and uncertain slices.
+import itertools
+
+import numpy as np
+
+from benchmark import _per_slice_metrics
+from slice_metrics import batch_metrics
+
+FIELDS = ['uncertain_pixel_count', 'mean_variance', 'median_variance', 'mean_variance_percent',
+          'median_variance_percent', 'sm_pixels', 'sm_area', 'sm_volume', 'sm_hu']
+THRESHOLD = 0.01
+SIZE = 16
+
+
+def make_slice(kind, seed):
+    """Ensemble mean, variance and HU image of one slice; 'empty' slices have no uncertain pixels."""
+    rng = np.random.default_rng(seed)
+    mean = rng.random((SIZE, SIZE), dtype=np.float32)
+    variance = rng.random((SIZE, SIZE), dtype=np.float32) * np.float32(0.005)
+    if kind == 'uncertain':
+        variance[rng.random((SIZE, SIZE)) < 0.2] += np.float32(0.01 + 0.1 * seed)
+    hu = rng.integers(-200, 300, (SIZE, SIZE)).astype(np.int16)
+    return mean, variance, hu
+
+
+def check(kinds):
+    slices = [make_slice(kind, seed) for seed, kind in enumerate(kinds)]
+    means, variances, hu_images = (np.stack(arrays) for arrays in zip(*slices))
+    masks, uncertainty_images, columns = batch_metrics(means, variances, hu_images, [[0.7, 0.8]] * len(kinds),
+                                                       [2.5] * len(kinds), THRESHOLD)
+    for k, (kind, (mean, variance, hu)) in enumerate(zip(kinds, slices)):
+        variance_norm = ((variance - variance.min()) * (255 / (variance.max() - variance.min()))).astype(np.uint8)
+        assert (uncertainty_images[k] == variance_norm).all()
+        if kind == 'empty':
+            # The per-slice code cannot handle slices without uncertain pixels
+            assert columns['uncertain_pixel_count'][k] == 0
+            assert np.isnan(columns['mean_variance'][k]) and np.isnan(columns['median_variance_percent'][k])
+            continue
+        expected = _per_slice_metrics(mean, variance, hu, [0.7, 0.8], 2.5, THRESHOLD)
+        for field, value in zip(FIELDS, expected):
+            assert np.isclose(columns[field][k], value, rtol=1e-6), (kinds, k, field)
+
+
+def test_batches_mixing_empty_and_uncertain_slices():
+    for kinds in itertools.product(['empty', 'uncertain'], repeat=4):
+        check(kinds)
+
+
+def test_metrics_do_not_depend_on_the_batch():
+    single = batch_metrics(*(array[None] for array in make_slice('uncertain', 3)), [[1, 1]], [1], THRESHOLD)[2]
+    empty = make_slice('empty', 0)
+    stacked = [np.stack([a, b]) for a, b in zip(make_slice('uncertain', 3), empty)]
+    batched = batch_metrics(*stacked, [[1, 1]] * 2, [1] * 2, THRESHOLD)[2]
+    for field in FIELDS:
+        assert batched[field][0] == single[field][0], field
@@ -0,0 +1,27 @@
+# Collecting the axial groups of a cohort.
+import synthetic
+import step1
+from config import load_config
+
+
+def make_series(tmp_path, *folders):
+    for k, folder in enumerate(folders):
+        synthetic.make_dicom_series(str(tmp_path.joinpath('subjects', *folder)), 12, size=32, seed=k)
+
+
+def collect(tmp_path):
+    config = load_config(subjects_dir=str(tmp_path / 'subjects'), index_path=str(tmp_path / 'index.sqlite'),
+                         min_dicom_files=8)
+    return step1.collect_groups(config)
+
+
+def test_groups_are_named_after_subject_and_series(tmp_path):
+    make_series(tmp_path, ('SUBJ1', 'studyA', 'x', 'y', 'S3'), ('SUBJ2', 'studyA', 'x', 'y', 'S3'))
+    assert sorted(collect(tmp_path)) == ['SUBJ1__S3__group1', 'SUBJ2__S3__group1']
+
+
+def test_series_with_the_same_name_are_skipped(tmp_path, capsys):
+    make_series(tmp_path, ('SUBJ1', 'studyA', 'x', 'y', 'S3'), ('SUBJ1', 'studyB', 'x', 'y', 'S3'),
+                ('SUBJ1', 'studyB', 'x', 'y', 'S4'))
+    assert sorted(collect(tmp_path)) == ['SUBJ1__S4__group1']
+    assert 'Ambiguous series S3 of subject SUBJ1' in capsys.readouterr().out
@@ -0,0 +1,36 @@
+# Reading the L3 slices of a segmentation that does not match its DICOM series.
+import os
+
+import nibabel as nib
+import numpy as np
+
+import synthetic
+import step2
+from config import load_config
+from fake_segmenter import fake_segmentation
+from identifiers import GroupId, GroupIndex, group_name, nifti_name
+from materialize import materialize_group
+
+
+def make_case(tmp_path, num_dicom_slices, num_nifti_slices):
+    group_id = GroupId('A', '1', 1)
+    dicom_paths = synthetic.make_dicom_series(str(tmp_path / 'source'), num_dicom_slices, size=32)
+    group_dir = tmp_path / 'groups'
+    materialize_group(dicom_paths, str(group_dir / group_name(group_id)), 'copy')
+    nifti_dir = tmp_path / 'nifti'
+    os.makedirs(nifti_dir)
+    labels = fake_segmentation(num_nifti_slices, 32, 32)
+    nib.save(nib.Nifti1Image(labels, np.eye(4)), str(nifti_dir / nifti_name(group_id)))
+    config = load_config(nifti_dir=str(nifti_dir), group_dir=str(group_dir))
+    return config, nifti_name(group_id), GroupIndex(str(group_dir))
+
+
+def test_l3_slices_are_read(tmp_path):
+    config, nifti_file, group_index = make_case(tmp_path, 40, 40)
+    slices = step2.read_l3_slices(config, nifti_file, group_index)
+    assert slices and all(image.shape == (32, 32) for _, image, _ in slices)
+
+
+def test_segmentation_deeper_than_series_is_skipped(tmp_path):
+    config, nifti_file, group_index = make_case(tmp_path, 10, 40)
+    assert step2.read_l3_slices(config, nifti_file, group_index) is None
@@ -0,0 +1,16 @@
+# Listing the step3 outputs of the configured ensemble members.
+import synthetic
+import step4
+from config import load_config
+
+
+def test_npz_members_follow_the_configured_models_and_folds(tmp_path):
+    config = load_config(prediction_dir=str(tmp_path / 'pred'), group_dir=str(tmp_path / 'groups'),
+                         probability_format='npz', model_dirs=[['a', 'a_dir'], ['b', 'b_dir']], folds=[0, 2])
+    case_ids = ['A__1__group1__0003', 'A__1__group1__0004']
+    members = ['ensemble_a_0', 'ensemble_a_2', 'ensemble_b_0', 'ensemble_b_2']
+    synthetic.make_fold_probabilities(config['prediction_dir'], case_ids, members, size=16)
+
+    items = step4.list_items(config)
+    assert sorted(items) == case_ids
+    assert [path.split('/')[-2] for path in items[case_ids[0]][:-1]] == members
@@ -0,0 +1,12 @@
+# Legacy uint8 window encoding of rescaled pixels.
+import numpy as np
+
+from utils import rescale_to_hu, MUSCLE_WINDOW
+
+
+def test_legacy_encoding_wraps_negative_values_for_any_slope():
+    pixels = np.arange(0, 2400, 7, dtype=np.int16).reshape(1, -1)
+    for slope, intercept in [(1, -1024), (2, -2048), (0.5, -512)]:
+        hu = np.clip(np.trunc(pixels * np.float64(slope)).astype(np.int32) + intercept, *MUSCLE_WINDOW)
+        expected = hu.astype(np.int32).astype(np.uint8)
+        np.testing.assert_array_equal(rescale_to_hu(pixels, slope, intercept, window=MUSCLE_WINDOW), expected)
@@ -1,15 +1,41 @@
+import os
+from collections import defaultdict
+
+import nibabel as nib
+import numpy as np
+import pydicom
+
+from instrumentation import metrics
+
+# Only the header tags needed to classify and group a slice. Passing these to
+# dcmread as specific_tags skips parsing everything else in the header.
+DICOM_HEADER_TAGS = [
+    "StudyInstanceUID",
+    "SeriesInstanceUID",
+    "SOPInstanceUID",
+    "ImageOrientationPatient",
+    "ImagePositionPatient",
+    "SliceThickness",
+    "SpacingBetweenSlices",
+    "FrameOfReferenceUID",
+    "SeriesNumber",
+    "AcquisitionNumber",
+    "InstanceNumber",
+]
+
 def read_dicom_attributes(dicom_path):
     """Read necessary DICOM attributes from a single DICOM file and determine orientation."""
     if not dicom_path.endswith('.dcm'):
         return None
 
-    try:
-        ds = pydicom.dcmread(dicom_path, stop_before_pixels=True)
-    except pydicom.errors.InvalidDicomError:
-        # This file is not a valid DICOM file
-        return None
-    
-    ds = pydicom.dcmread(dicom_path, stop_before_pixels=True)
+    with metrics.timed('read_header') as measurement:
+        try:
+            with open(dicom_path, 'rb') as f:
+                ds = pydicom.dcmread(f, stop_before_pixels=True, specific_tags=DICOM_HEADER_TAGS)
+                measurement.bytes_read = f.tell()
+        except pydicom.errors.InvalidDicomError:
+            # This file is not a valid DICOM file
+            return None
 
     # Initialize default values for attributes that might be missing
     default_orientation = ("unknown",) * 6  # Default for ImageOrientationPatient
@@ -46,92 +72,160 @@ def read_dicom_attributes(dicom_path):
         "FrameOfReferenceUID": getattr(ds, "FrameOfReferenceUID", "UnknownFrameOfReference"),
         "Series Number": getattr(ds, "SeriesNumber", "UnknownSeriesNumber"),
         "Acquisition Number": getattr(ds, "AcquisitionNumber", "UnknownAcquisitionNumber"),
+        "SOPInstanceUID": getattr(ds, "SOPInstanceUID", None),
+        "InstanceNumber": getattr(ds, "InstanceNumber", None),
     }
     return attributes
 
-def group_dicom_files(directory):
-    """Group DICOM files based on specific attributes, considering only axial orientation."""
-    groups = defaultdict(list)
+def iter_dicom_attributes(directory):
+    """Walk a directory and yield (dicom_path, attributes) for every readable DICOM file."""
     for root, _, files in os.walk(directory):
         for file in files:
             dicom_path = os.path.join(root, file)
             attrs = read_dicom_attributes(dicom_path)
-            if attrs is None or attrs["ImageOrientationPatient"] != "axial":
-                continue
-            if attrs["ImageOrientationPatient"] == "axial":
-                group_key = (root, attrs["StudyInstanceUID"], attrs["SeriesInstanceUID"],
-                             attrs["SliceThickness"], attrs["SpacingBetweenSlices"],
-                             attrs["FrameOfReferenceUID"], attrs["Series Number"], attrs["Acquisition Number"])
-                groups[group_key].append((attrs["ImagePositionPatient"][2], dicom_path))  # Sort by Z position
+            if attrs is not None:
+                yield dicom_path, attrs
+
+def group_dicom_files(directory, index=None):
+    """Group DICOM files based on specific attributes, considering only axial orientation.
+
+    If a DicomIndex is given the attributes are taken from the index instead of
+    parsing every header again. The index must have been updated for directory.
+    """
+    groups = defaultdict(list)
+    if index is not None:
+        records = index.records(directory)
+    else:
+        records = iter_dicom_attributes(directory)
+    for dicom_path, attrs in records:
+        if attrs["ImageOrientationPatient"] != "axial":
+            continue
+        root = os.path.dirname(dicom_path)
+        group_key = (root, attrs["StudyInstanceUID"], attrs["SeriesInstanceUID"],
+                     attrs["SliceThickness"], attrs["SpacingBetweenSlices"],
+                     attrs["FrameOfReferenceUID"], attrs["Series Number"], attrs["Acquisition Number"])
+        groups[group_key].append((attrs["ImagePositionPatient"][2], dicom_path))  # Sort by Z position
 
     for group in groups.values():
         group.sort()
 
     return groups
 
-def generate_dicom_path_dict(axial_series_dir):
-    dicom_path_dict = {}
-    for root, dirs, files in os.walk(axial_series_dir):
-        for dir in dirs:
-            dicom_path_dict[dir] = os.path.join(root, dir)
-    return dicom_path_dict
-
-def get_dicom_path(nifti_parts, dicom_path_dict):
-    return dicom_path_dict.get(nifti_parts)
-
-def get_pixels_hu(scans):
-    image = scans.pixel_array
-    # Convert to int16 (from sometimes int16), 
-    # should be possible as values should always be low enough (<32k)
-    image = image.astype(np.int16)
-
-    # Set outside-of-scan pixels to 1
-    # The intercept is usually -1024, so air is approximately 0
-    image[image == -2000] = 0
-    
-    # Convert to Hounsfield units (HU)
-    intercept = scans.RescaleIntercept
-    slope = scans.RescaleSlope
-    
+# TotalSegmentator label of the L3 vertebra
+L3_LABEL = 29
+
+def load_label_volume(nifti):
+    """Return the raw label array of a NIfTI image without converting it to float64.
+
+    For uncompressed .nii files the array is a read-only memory map of the file.
+    """
+    dataobj = nifti.dataobj
+    if nib.is_proxy(dataobj) and dataobj.slope == 1 and dataobj.inter == 0:
+        return dataobj.get_unscaled()
+    # Scaled label volumes are rare, fall back to nibabel's own scaling
+    return np.asanyarray(dataobj)
+
+def locate_label_slices(nifti, label=L3_LABEL, chunk_size=64):
+    """Find the z indices of a label volume that contain label.
+
+    Returns (z_indices, voxel_counts): the indices in ascending order and the number of
+    voxels with that label in each of those slices. The volume is reduced in slabs of
+    chunk_size slices, so only one slab is ever held in memory.
+    """
+    data = load_label_volume(nifti)
+    if data.ndim != 3:
+        raise ValueError(f"Expected a 3D label volume, got shape {data.shape}")
+    counts = np.empty(data.shape[2], dtype=np.int64)
+    for z0 in range(0, data.shape[2], chunk_size):
+        slab = np.asarray(data[:, :, z0:z0 + chunk_size])
+        if slab.dtype.kind == 'f':
+            slab = slab.astype(np.uint8)
+        counts[z0:z0 + slab.shape[2]] = np.count_nonzero(slab == label, axis=(0, 1))
+    z_indices = np.flatnonzero(counts)
+    return z_indices, counts[z_indices]
+
+# Stored value some scanners use for pixels outside of the scan
+PADDING_VALUE = -2000
+# Muscle window used for the PNG slices in step2
+MUSCLE_WINDOW = (-29, 150)
+INT16_RANGE = (np.iinfo(np.int16).min, np.iinfo(np.int16).max)
+# uint8 encodings of a window: 'legacy' is np.uint8 of the clipped HU (what the models were
+# trained on, negative values wrap around), 'linear' maps the window onto 0-255
+WINDOW_ENCODINGS = ('legacy', 'linear')
+
+
+def rescale_to_hu(pixels, slope=1, intercept=0, window=None, out=None, encoding='legacy'):
+    """Convert stored pixel values to Hounsfield units in one vectorized pass.
+
+    The result is written to out (int16, or uint8 when a window is given) and returned. Values
+    are computed in int32 (float64 if slope != 1, back in int32 once clipped) and clipped, so
+    they saturate instead of wrapping around. window=(low, high) clips to the window in the same pass and encodes it as
+    uint8 (see WINDOW_ENCODINGS): 'legacy' keeps the encoding step2 has always used, 'linear'
+    scales the window to 0-255.
+    """
+    if encoding not in WINDOW_ENCODINGS:
+        raise ValueError(f"Unknown window encoding {encoding!r}, expected one of {WINDOW_ENCODINGS}")
+    if out is None:
+        out = np.empty(pixels.shape, dtype=np.int16 if window is None else np.uint8)
     if slope != 1:
-        image = slope * image.astype(np.float64)
-        image = image.astype(np.int16)
-        
-    image += np.int16(intercept)
-    
-    return np.array(image, dtype=np.int16)
-
-def save_dicom(predicted_mask, dicom_file, output_path):
-    # Create a new DICOM file based on the original DICOM file
-    new_dicom = dicom_file.copy()
-
-    # Ensure the pixel data is in the correct format and scale it properly
-    predicted_mask = (predicted_mask * 255).astype(np.uint8)  # Scale to 0-255 for visibility
-
-    # Update the pixel data with the predicted mask
-    new_dicom.PixelData = predicted_mask.tobytes()
-
-    # Update necessary metadata fields to match the predicted mask
-    new_dicom.Rows, new_dicom.Columns = predicted_mask.shape
-    new_dicom.BitsAllocated = 8  # Set BitsAllocated to match uint8 data
-    new_dicom.SamplesPerPixel = 1  # Grayscale image
-    new_dicom.PhotometricInterpretation = "MONOCHROME2"
-
-    # Update SOPInstanceUID to make it unique
-    new_dicom.SOPInstanceUID = pydicom.uid.generate_uid()
-    new_dicom.SeriesInstanceUID = pydicom.uid.generate_uid()
-    new_dicom.InstanceNumber = 1
-    new_dicom.SeriesDescription = "Predicted Mask"
-    new_dicom.ImageType = ["DERIVED", "PRIMARY"]
-    new_dicom.ContentDate = datetime.datetime.now().strftime('%Y%m%d')
-    new_dicom.ContentTime = datetime.datetime.now().strftime('%H%M%S')
-
-    # Set window center and window width to ensure the mask is visible
-    new_dicom.WindowCenter = 128
-    new_dicom.WindowWidth = 256
-
-    # Ensure the correct transfer syntax
-    new_dicom.file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
-
-    # Save the new DICOM file
-    new_dicom.save_as(output_path)
+        scratch = pixels * np.float64(slope)
+        np.trunc(scratch, out=scratch)
+    else:
+        scratch = pixels.astype(np.int32)
+    # Set outside-of-scan pixels to 0
+    # The intercept is usually -1024, so air is approximately 0
+    if pixels.dtype.kind == 'i':
+        scratch[pixels == PADDING_VALUE] = 0
+    scratch += int(intercept)
+    low, high = INT16_RANGE if window is None else window
+    np.clip(scratch, low, high, out=scratch)
+    if scratch.dtype.kind == 'f':
+        # Casting negative floats to uint8 is undefined, the legacy wraparound needs integers
+        scratch = scratch.astype(np.int32)
+    if window is not None and encoding == 'linear':
+        # Rounded (value - low) * 255 / (high - low)
+        scratch -= low
+        scratch *= 255
+        scratch += (high - low) // 2
+        scratch //= high - low
+    np.copyto(out, scratch, casting='unsafe')
+    return out
+
+
+def _stored_pixels(ds):
+    """The stored pixel values of a dataset, as a view of the pixel data if it is uncompressed 16 bit."""
+    if (not ds.file_meta.TransferSyntaxUID.is_compressed and ds.file_meta.TransferSyntaxUID.is_little_endian
+            and ds.get('SamplesPerPixel', 1) == 1 and ds.get('NumberOfFrames', 1) in (1, None)
+            and ds.BitsAllocated == 16 and ds.BitsStored == 16):
+        dtype = np.int16 if ds.PixelRepresentation == 1 else np.uint16
+        return np.frombuffer(ds.PixelData, dtype=dtype, count=ds.Rows * ds.Columns).reshape(ds.Rows, ds.Columns)
+    return ds.pixel_array
+
+
+def get_pixels_hu(scans, window=None, out=None, encoding='legacy'):
+    """Pixel data of one DICOM slice in Hounsfield units (see rescale_to_hu)."""
+    return rescale_to_hu(_stored_pixels(scans), getattr(scans, 'RescaleSlope', 1),
+                         getattr(scans, 'RescaleIntercept', 0), window=window, out=out, encoding=encoding)
+
+
+def load_hu_volume(dicom_files, window=None, out=None, memmap_path=None, encoding='legacy'):
+    """Decode an ordered list of DICOM slices into one (slices, rows, columns) array of HU.
+
+    The array is allocated once, as int16 (uint8 with a window, see rescale_to_hu), or memory
+    mapped to a .npy file at memmap_path, and every slice is converted straight into it.
+    Returns the array and the list of datasets (their pixel data is not kept).
+    """
+    datasets = []
+    for k, dicom_file in enumerate(dicom_files):
+        ds = pydicom.dcmread(dicom_file)
+        if out is None:
+            shape = (len(dicom_files), ds.Rows, ds.Columns)
+            dtype = np.int16 if window is None else np.uint8
+            if memmap_path is None:
+                out = np.empty(shape, dtype=dtype)
+            else:
+                out = np.lib.format.open_memmap(memmap_path, mode='w+', dtype=dtype, shape=shape)
+        get_pixels_hu(ds, window=window, out=out[k], encoding=encoding)
+        del ds.PixelData
+        datasets.append(ds)
+    return out, datasets
@@ -0,0 +1,66 @@
+# Bounded background writer pool.
+# Output files are handed to a few threads so encoding and computing the next item does not wait
+# on the disk. At most max_pending writes are queued; submit() blocks beyond that, so a slow disk
+# slows the producer down instead of piling up data in memory.
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from instrumentation import metrics
+
+
+def write_file(path, data, stage='file_write'):
+    """Write bytes to path atomically (via a temporary file next to it)."""
+    with metrics.timed(stage, bytes_written=len(data)):
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+
+class WriterPool:
+    """Run write tasks on background threads, with at most max_pending tasks in flight."""
+
+    def __init__(self, max_workers=2, max_pending=32):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='writer')
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._errors = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue fn(*args, **kwargs). Blocks while max_pending tasks are queued or running."""
+        self._raise_errors()
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(self._done)
+        return future
+
+    def write(self, path, data, stage='file_write'):
+        """Queue writing bytes to path."""
+        return self.submit(write_file, path, data, stage)
+
+    def _done(self, future):
+        self._slots.release()
+        if future.exception() is not None:
+            with self._lock:
+                self._errors.append(future.exception())
+
+    def _raise_errors(self):
+        with self._lock:
+            if self._errors:
+                raise self._errors[0]
+
+    def close(self):
+        """Wait for all queued writes and raise the first error, if any."""
+        self._executor.shutdown(wait=True)
+        self._raise_errors()